@@ -0,0 +1,341 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from ark.utils import io_utils, misc_utils
+
+
+class CellTableSink(object):
+    """Base class for writing the size normalized and arcsinh transformed cell tables to disk
+    piece by piece, as each fov or batch of fovs is quantified.
+
+    Sinks can be used as context managers, which makes sure they get closed once quantification
+    is done. Subclasses implement `_write_table` and optionally `close`.
+
+    Args:
+        save_dir (str):
+            directory to write the cell tables to
+        extension (str):
+            file extension of the written tables
+        overwrite (bool):
+            whether existing cell tables in save_dir can be replaced
+    """
+
+    def __init__(self, save_dir, extension, overwrite=False):
+        if not os.path.isdir(save_dir):
+            raise ValueError("Invalid value for save_dir: %s is not a directory" % save_dir)
+
+        self.paths = {
+            'size_normalized': os.path.join(save_dir, 'cell_table_size_normalized' + extension),
+            'arcsinh_transformed': os.path.join(save_dir,
+                                                'cell_table_arcsinh_transformed' + extension)
+        }
+
+        for path in self.paths.values():
+            if os.path.exists(path):
+                if not overwrite:
+                    raise ValueError("Cell table %s already exists, set overwrite=True to "
+                                     "replace it" % path)
+                os.remove(path)
+
+        # the columns of the first table written, which every later table must match
+        self._columns = {}
+
+    def write(self, cell_table_size_normalized, cell_table_arcsinh_transformed):
+        """Append rows to the size normalized and arcsinh transformed cell tables
+
+        Args:
+            cell_table_size_normalized (pandas.DataFrame):
+                size normalized rows to append
+            cell_table_arcsinh_transformed (pandas.DataFrame):
+                arcsinh transformed rows to append
+        """
+
+        tables = {
+            'size_normalized': cell_table_size_normalized,
+            'arcsinh_transformed': cell_table_arcsinh_transformed
+        }
+
+        for name, table in tables.items():
+            if name not in self._columns:
+                self._columns[name] = list(table.columns)
+            elif list(table.columns) != self._columns[name]:
+                raise ValueError("The columns of the %s table don't match those already "
+                                 "written to %s" % (name, self.paths[name]))
+
+            self._write_table(name, table)
+
+    def _write_table(self, name, table):
+        """Append rows to one of the cell tables
+
+        Args:
+            name (str):
+                either 'size_normalized' or 'arcsinh_transformed'
+            table (pandas.DataFrame):
+                rows to append
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        """Finish writing the cell tables"""
+
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CSVCellTableSink(CellTableSink):
+    """Writes the cell tables as CSV files, appending rows in chunks as they are computed
+
+    Args:
+        save_dir (str):
+            directory to write cell_table_size_normalized.csv and
+            cell_table_arcsinh_transformed.csv to
+        overwrite (bool):
+            whether existing cell tables in save_dir can be replaced
+        chunksize (int):
+            number of rows written at a time
+    """
+
+    def __init__(self, save_dir, overwrite=False, chunksize=100000):
+        super().__init__(save_dir, '.csv', overwrite=overwrite)
+        self.chunksize = chunksize
+
+    def _write_table(self, name, table):
+        # only write the header the first time
+        write_header = not os.path.exists(self.paths[name])
+
+        table.to_csv(self.paths[name], mode='a', header=write_header, index=False,
+                     chunksize=self.chunksize)
+
+
+class ParquetCellTableSink(CellTableSink):
+    """Writes the cell tables as Parquet files, adding a row group for each write.
+
+    Requires the optional `pyarrow` package.
+
+    Args:
+        save_dir (str):
+            directory to write cell_table_size_normalized.parquet and
+            cell_table_arcsinh_transformed.parquet to
+        overwrite (bool):
+            whether existing cell tables in save_dir can be replaced
+    """
+
+    def __init__(self, save_dir, overwrite=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow must be installed to write cell tables as Parquet")
+
+        super().__init__(save_dir, '.parquet', overwrite=overwrite)
+        self._pyarrow = pyarrow
+        self._writers = {}
+
+    def _write_table(self, name, table):
+        if name not in self._writers:
+            schema = self._pyarrow.Schema.from_pandas(table, preserve_index=False)
+            self._writers[name] = self._pyarrow.parquet.ParquetWriter(self.paths[name], schema)
+
+        writer = self._writers[name]
+        writer.write_table(self._pyarrow.Table.from_pandas(table, schema=writer.schema,
+                                                           preserve_index=False))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+def _to_json_value(value):
+    """Convert a parameter json can't serialize into a value which is the same for equal
+    parameters of a later run
+
+    Numpy values are converted into their python equivalents, functions are recorded by name,
+    and other objects by their type and a hash of their pickled state.
+    """
+
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+
+    if callable(value) and hasattr(value, '__qualname__'):
+        return '%s.%s' % (value.__module__, value.__qualname__)
+
+    try:
+        digest = hashlib.sha1(pickle.dumps(value, protocol=4)).hexdigest()
+    except Exception:
+        raise TypeError("Cannot record %r in a checkpoint manifest" % (value,))
+
+    return '%s.%s:%s' % (type(value).__module__, type(value).__qualname__, digest)
+
+
+class CellTableCheckpoint(object):
+    """Checkpoint directory holding the finished cell tables of each fov in a run, so that an
+    interrupted run can be resumed without recomputing them.
+
+    The directory holds a manifest recording the parameters of the run, the columns of the cell
+    tables and the fovs which are done. Each fov's tables are written atomically before the fov
+    is added to the manifest, so a crash never leaves a partial fov behind.
+
+    Args:
+        checkpoint_dir (str):
+            directory to write the checkpoint to, created if it doesn't exist
+        parameters (dict):
+            parameters of the run, which must match those of the run the checkpoint was created
+            by. Functions are compared by name, and other values json can't serialize by their
+            pickled state, see `_to_json_value`
+    """
+
+    manifest_name = 'manifest.json'
+
+    def __init__(self, checkpoint_dir, parameters):
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        self.checkpoint_dir = checkpoint_dir
+        self.manifest_path = os.path.join(checkpoint_dir, self.manifest_name)
+
+        # round trip the parameters, so they compare equal to those read back from disk
+        parameters = json.loads(json.dumps(parameters, default=_to_json_value))
+
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+            if self.manifest['parameters'] != parameters:
+                raise ValueError("The checkpoint in %s was created with different parameters, "
+                                 "use another checkpoint_dir to start a new run" % checkpoint_dir)
+        else:
+            self.manifest = {'parameters': parameters, 'columns': None, 'completed_fovs': []}
+            self._write_manifest()
+
+    @property
+    def completed_fovs(self):
+        """list: fovs whose cell tables are in the checkpoint"""
+
+        return list(self.manifest['completed_fovs'])
+
+    def _write_manifest(self):
+        def write_manifest(path):
+            with open(path, 'w') as manifest_file:
+                json.dump(self.manifest, manifest_file, indent=4)
+
+        io_utils.write_atomic(self.manifest_path, write_manifest)
+
+    def _get_paths(self, fov):
+        return [os.path.join(self.checkpoint_dir, '%s_%s.csv' % (fov, name))
+                for name in ['size_normalized', 'arcsinh_transformed']]
+
+    def _get_qc_path(self, fov):
+        return os.path.join(self.checkpoint_dir, '%s_qc_stats.csv' % fov)
+
+    def write(self, fovs, cell_table_size_normalized, cell_table_arcsinh_transformed,
+              qc_stats=None):
+        """Save the finished cell tables of some fovs and mark them as completed
+
+        Args:
+            fovs (list):
+                the fovs the tables hold, including those without any cells
+            cell_table_size_normalized (pandas.DataFrame):
+                size normalized data of the fovs
+            cell_table_arcsinh_transformed (pandas.DataFrame):
+                arcsinh transformed data of the fovs
+            qc_stats (pandas.DataFrame):
+                optional quality control summary of the fovs, with a fov column
+        """
+
+        # fovs without any cells may give tables without any columns
+        if len(cell_table_size_normalized.columns) > 0:
+            columns = list(cell_table_size_normalized.columns)
+
+            if self.manifest['columns'] is None:
+                self.manifest['columns'] = columns
+            elif columns != self.manifest['columns']:
+                raise ValueError("The columns of the cell tables don't match those already "
+                                 "written to the checkpoint in %s" % self.checkpoint_dir)
+
+        for fov in fovs:
+            for table, path in zip([cell_table_size_normalized, cell_table_arcsinh_transformed],
+                                   self._get_paths(fov)):
+                if len(table.columns) > 0:
+                    table = table[table['fov'] == fov]
+
+                io_utils.write_atomic(path, lambda tmp_path: table.to_csv(tmp_path, index=False))
+
+            if qc_stats is not None:
+                fov_qc_stats = qc_stats[qc_stats['fov'] == fov]
+                io_utils.write_atomic(self._get_qc_path(fov),
+                                      lambda tmp_path: fov_qc_stats.to_csv(tmp_path, index=False))
+
+            if fov not in self.manifest['completed_fovs']:
+                self.manifest['completed_fovs'].append(fov)
+
+        self._write_manifest()
+
+    def read(self, fov):
+        """Read back the cell tables of a completed fov
+
+        Args:
+            fov (str):
+                the fov to read
+
+        Returns:
+            tuple (pandas.DataFrame, pandas.DataFrame):
+            - size normalized data
+            - arcsinh transformed data
+            - the quality control summary, if it was saved with the tables
+        """
+
+        misc_utils.verify_in_list(fov=fov, completed_fovs=self.manifest['completed_fovs'])
+
+        tables = []
+        for path in self._get_paths(fov):
+            try:
+                tables.append(pd.read_csv(path, dtype={'fov': str},
+                                          float_precision='round_trip'))
+            except pd.errors.EmptyDataError:
+                # fov without any cells or columns
+                tables.append(pd.DataFrame())
+
+        if os.path.exists(self._get_qc_path(fov)):
+            tables.append(pd.read_csv(self._get_qc_path(fov), dtype={'fov': str, 'channel': str},
+                                      float_precision='round_trip'))
+
+        return tuple(tables)
+
+
+def read_cell_tables(save_dir, file_format='csv'):
+    """Read back the cell tables written by a CellTableSink
+
+    Args:
+        save_dir (str):
+            directory the cell tables were written to
+        file_format (str):
+            either 'csv' or 'parquet'
+
+    Returns:
+        tuple (pandas.DataFrame, pandas.DataFrame):
+        - size normalized data
+        - arcsinh transformed data
+    """
+
+    if file_format == 'csv':
+        read_func = pd.read_csv
+    elif file_format == 'parquet':
+        read_func = pd.read_parquet
+    else:
+        raise ValueError("Invalid value for file_format: must be one of ['csv', 'parquet']")
+
+    return tuple(
+        read_func(os.path.join(save_dir, 'cell_table_%s.%s' % (name, file_format)))
+        for name in ['size_normalized', 'arcsinh_transformed']
+    )
@@ -0,0 +1,146 @@
+import os
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ark.segmentation import cell_table_sinks
+from ark.utils import segmentation_utils
+
+
+def _make_tables(fov, num_cells):
+    normalized = pd.DataFrame({'cell_size': np.arange(num_cells, dtype='float'),
+                               'chan0': np.random.rand(num_cells),
+                               'label': np.arange(1, num_cells + 1, dtype='float')})
+    normalized['fov'] = fov
+
+    arcsinh = normalized.copy()
+    arcsinh['chan0'] = np.arcsinh(arcsinh['chan0'] * 100)
+
+    return normalized, arcsinh
+
+
+def test_csv_cell_table_sink():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tables = [_make_tables('fov0', 5), _make_tables('fov1', 3)]
+
+        with cell_table_sinks.CSVCellTableSink(temp_dir, chunksize=2) as sink:
+            for normalized, arcsinh in tables:
+                sink.write(normalized, arcsinh)
+
+        normalized, arcsinh = cell_table_sinks.read_cell_tables(temp_dir)
+
+        pd.testing.assert_frame_equal(
+            normalized, pd.concat([table[0] for table in tables], ignore_index=True)
+        )
+        pd.testing.assert_frame_equal(
+            arcsinh, pd.concat([table[1] for table in tables], ignore_index=True)
+        )
+
+        # existing tables are only replaced if asked for
+        with pytest.raises(ValueError):
+            cell_table_sinks.CSVCellTableSink(temp_dir)
+
+        with cell_table_sinks.CSVCellTableSink(temp_dir, overwrite=True) as sink:
+            sink.write(*tables[1])
+
+            # later tables must have the same columns
+            with pytest.raises(ValueError):
+                sink.write(tables[1][0].drop(columns='chan0'), tables[1][1])
+
+        normalized, _ = cell_table_sinks.read_cell_tables(temp_dir)
+        assert normalized.shape[0] == 3
+
+    with pytest.raises(ValueError):
+        cell_table_sinks.CSVCellTableSink(os.path.join(temp_dir, 'not_a_dir'))
+
+
+def test_parquet_cell_table_sink():
+    pytest.importorskip('pyarrow')
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tables = [_make_tables('fov0', 5), _make_tables('fov1', 3)]
+
+        with cell_table_sinks.ParquetCellTableSink(temp_dir) as sink:
+            for normalized, arcsinh in tables:
+                sink.write(normalized, arcsinh)
+
+        normalized, arcsinh = cell_table_sinks.read_cell_tables(temp_dir, file_format='parquet')
+
+        pd.testing.assert_frame_equal(
+            normalized, pd.concat([table[0] for table in tables], ignore_index=True)
+        )
+        pd.testing.assert_frame_equal(
+            arcsinh, pd.concat([table[1] for table in tables], ignore_index=True)
+        )
+
+    with pytest.raises(ValueError):
+        cell_table_sinks.read_cell_tables(temp_dir, file_format='hdf')
+
+
+def test_cell_table_checkpoint():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parameters = {'extraction': 'total_intensity', 'threshold': np.arange(3)}
+        checkpoint = cell_table_sinks.CellTableCheckpoint(temp_dir, parameters)
+
+        assert checkpoint.completed_fovs == []
+
+        # fov names which look like numbers are kept as strings
+        tables = [_make_tables('001', 5), _make_tables('002', 3)]
+        checkpoint.write(['001', '002'], *(pd.concat(table) for table in zip(*tables)))
+        checkpoint.write(['003'], pd.DataFrame(), pd.DataFrame())
+
+        # the checkpoint can be picked up again with the same parameters
+        checkpoint = cell_table_sinks.CellTableCheckpoint(temp_dir, parameters)
+        assert checkpoint.completed_fovs == ['001', '002', '003']
+
+        for fov, (normalized, arcsinh) in zip(['001', '002'], tables):
+            normalized_read, arcsinh_read = checkpoint.read(fov)
+            pd.testing.assert_frame_equal(normalized_read, normalized)
+            pd.testing.assert_frame_equal(arcsinh_read, arcsinh)
+
+        assert all(table.empty for table in checkpoint.read('003'))
+
+        with pytest.raises(ValueError):
+            checkpoint.read('004')
+
+        # the columns of later fovs must match
+        with pytest.raises(ValueError):
+            checkpoint.write(['004'], tables[0][0].drop(columns='chan0'), tables[0][1])
+
+        with pytest.raises(ValueError):
+            cell_table_sinks.CellTableCheckpoint(temp_dir, dict(parameters, threshold=1))
+
+
+def test_cell_table_checkpoint_objects():
+    cell_labels = np.array([[0, 1, 1], [2, 2, 0]])
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # functions are recorded by name, and other objects by their contents
+        label_index = segmentation_utils.LabelIndex(cell_labels)
+        parameters = {'extraction': _make_tables, 'label_indices': {'whole_cell': label_index}}
+        cell_table_sinks.CellTableCheckpoint(temp_dir, parameters)
+
+        # looking labels up fills in lookups, which don't change the parameters
+        label_index.get_pixel_indices(1)
+        cell_table_sinks.CellTableCheckpoint(temp_dir, parameters)
+
+        cell_table_sinks.CellTableCheckpoint(temp_dir, dict(
+            parameters, label_indices={'whole_cell': segmentation_utils.LabelIndex(cell_labels)}
+        ))
+
+        with pytest.raises(ValueError):
+            cell_table_sinks.CellTableCheckpoint(temp_dir, dict(parameters, extraction=len))
+
+        with pytest.raises(ValueError):
+            cell_table_sinks.CellTableCheckpoint(temp_dir, dict(
+                parameters, label_indices={'whole_cell': segmentation_utils.LabelIndex(
+                    cell_labels[::-1])}
+            ))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # values which can't be hashed can't be checkpointed
+        with pytest.raises(TypeError):
+            cell_table_sinks.CellTableCheckpoint(temp_dir, {'lock': threading.Lock()})
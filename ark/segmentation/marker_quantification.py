@@ -1,54 +1,190 @@
+import collections
 import copy
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
 
 import xarray as xr
 
-from skimage.measure import regionprops_table
+from scipy.sparse import coo_matrix
 
-from ark.utils import io_utils, load_utils, misc_utils, segmentation_utils
-from ark.segmentation.signal_extraction import extraction_function
+from ark.utils import io_utils, load_utils, misc_utils, segmentation_utils, tiff_utils
+from ark.segmentation import cell_table_sinks, signal_extraction
+from ark.segmentation.morphology import regionprops_table
+from ark.segmentation.morphology_cache import LabelMorphology
 
 import ark.settings as settings
 
 
-def compute_marker_counts(input_images, segmentation_labels, nuclear_counts=False,
-                          regionprops_features=None, split_large_nuclei=False,
-                          extraction='total_intensity', **kwargs):
-    """Extract single cell protein expression data from channel TIFs for a single fov
+def _get_channel_sums(image_data, pixel_indices):
+    """Sum the signal of each channel over the whole image, and over the given pixels
 
     Args:
-        input_images (xarray.DataArray):
+        image_data (xarray.DataArray):
             rows x columns x channels matrix of imaging data
-        segmentation_labels (numpy.ndarray):
-            rows x columns x compartment matrix of masks
-        nuclear_counts (bool):
-            boolean flag to determine whether nuclear counts are returned
-        regionprops_features (list):
-            morphology features for regionprops to extract for each cell
-        split_large_nuclei (bool):
-            controls whether nuclei which have portions outside of the cell will get relabeled
-        extraction (str):
-            extraction function used to compute marker counts.
+        pixel_indices (numpy.ndarray):
+            flat indices of the pixels to sum over, e.g. those of every cell
+
+    Returns:
+        numpy.ndarray:
+            2 x channels matrix of the total signal, and the signal of the given pixels
+    """
+
+    channel_matrix = signal_extraction._get_channel_matrix(image_data)
+
+    return np.stack((
+        channel_matrix.sum(axis=0, dtype='float64'),
+        [channel_matrix[pixel_indices, chan].sum(dtype='float64')
+         for chan in range(channel_matrix.shape[1])]
+    ))
+
+
+def _extract_channel_counts(input_images, label_sets, extraction, engine='numpy',
+                            intensity_stats=None, channel_sums=False, **kwargs):
+    """Extract the signal of each set of labels from either all channels at once, or one channel
+    plane at a time
+
+    Args:
+        input_images (xarray.DataArray or iterable):
+            rows x columns x channels matrix of imaging data, or an iterable of rows x columns x 1
+            xarrays holding one channel each, which are only read one at a time
+        label_sets (list):
+            tuples of (label image, sorted label ids, centroids, label positions) to extract the
+            signal of
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        engine (str):
+            engine running the extraction function, either 'numpy' or 'numba'
+        intensity_stats (list):
+            optional per-label statistics of the pixel values to compute from the same channel
+            data, see `signal_extraction.intensity_stats_fov_extraction`
+        channel_sums (bool):
+            whether to also sum each channel over the whole image and over the labels of the
+            first label set, see `_get_channel_sums`
         **kwargs:
             arbitrary keyword arguments
+
     Returns:
-        xarray.DataArray:
-            xarray containing segmented data of cells x markers
+        tuple (numpy.ndarray, list, list, numpy.ndarray):
+        - the names of the channels
+        - labels x channels matrix of counts for each label set
+        - stats x labels x channels matrix of intensity statistics for each label set, None if
+          no intensity_stats are given
+        - 2 x channels matrix of the channel sums, None if channel_sums isn't set
     """
 
-    misc_utils.verify_in_list(
-        extraction=extraction,
-        extraction_options=list(extraction_function.keys())
-    )
+    extraction_func = signal_extraction.get_fov_extraction_function(extraction, engine)
+
+    if isinstance(input_images, xr.DataArray):
+        label_set_counts = [
+            extraction_func(label_image, input_images, label_ids,
+                            **dict(kwargs, centroid=centroids, label_positions=label_positions))
+            for label_image, label_ids, centroids, label_positions in label_sets
+        ]
+
+        label_set_stats = None
+        if intensity_stats:
+            label_set_stats = [
+                signal_extraction.intensity_stats_fov_extraction(
+                    label_image, input_images, label_ids, intensity_stats,
+                    label_positions=label_positions
+                )
+                for label_image, label_ids, _, label_positions in label_sets
+            ]
+
+        sums = None
+        if channel_sums:
+            sums = _get_channel_sums(input_images, label_sets[0][3][0])
+
+        return input_images.channels.values, label_set_counts, label_set_stats, sums
+
+    channel_names = []
+    label_set_counts = [[] for _ in label_sets]
+    label_set_stats = [[] for _ in label_sets]
+    plane_sums = []
+
+    # the compiled engine goes through the pixels of each label in turn, which are grouped once
+    # for all the planes
+    label_set_pixels = [None] * len(label_sets)
+    if engine == 'numba':
+        label_set_pixels = [
+            signal_extraction.group_label_pixels(label_image, label_ids, label_positions)
+            for label_image, label_ids, _, label_positions in label_sets
+        ]
+
+    # only hold a single plane at a time, adding its counts to those of the previous planes
+    for channel_index, channel_plane in enumerate(input_images):
+        channel_names.extend(channel_plane.channels.values)
+
+        if channel_sums:
+            plane_sums.append(_get_channel_sums(channel_plane, label_sets[0][3][0]))
+
+        # channel specific thresholds need to be matched to the current plane
+        channel_kwargs = dict(kwargs)
+        if np.ndim(kwargs.get('threshold', 0)) > 0:
+            channel_kwargs['threshold'] = kwargs['threshold'][channel_index]
+
+        for counts, stats, (label_image, label_ids, centroids, label_positions), label_pixels \
+                in zip(label_set_counts, label_set_stats, label_sets, label_set_pixels):
+            counts.append(
+                extraction_func(label_image, channel_plane, label_ids,
+                                **dict(channel_kwargs, centroid=centroids,
+                                       label_positions=label_positions,
+                                       label_pixels=label_pixels))
+            )
+
+            if intensity_stats:
+                stats.append(signal_extraction.intensity_stats_fov_extraction(
+                    label_image, channel_plane, label_ids, intensity_stats,
+                    label_positions=label_positions
+                ))
+
+    label_set_counts = [
+        np.concatenate(counts, axis=1) if len(counts) > 0 else np.zeros((len(label_ids), 0))
+        for counts, (_, label_ids, _, _) in zip(label_set_counts, label_sets)
+    ]
+
+    if intensity_stats:
+        label_set_stats = [
+            np.concatenate(stats, axis=2) if len(stats) > 0
+            else np.zeros((len(intensity_stats), len(label_ids), 0))
+            for stats, (_, label_ids, _, _) in zip(label_set_stats, label_sets)
+        ]
+    else:
+        label_set_stats = None
+
+    sums = None
+    if channel_sums:
+        sums = np.concatenate(plane_sums, axis=1) if len(plane_sums) > 0 \
+            else np.zeros((2, 0))
+
+    return np.array(channel_names), label_set_counts, label_set_stats, sums
+
+
+def _get_regionprops_features(regionprops_features=None):
+    """Add the features which are always needed to the requested regionprops features
+
+    Args:
+        regionprops_features (list):
+            morphology features for regionprops to extract for each cell, if None the default
+            features are used
+
+    Returns:
+        tuple (list, list):
+        - the regionprops features to compute
+        - the names of the columns regionprops returns for them
+    """
 
     if regionprops_features is None:
         regionprops_features = ['label', 'area', 'eccentricity', 'major_axis_length',
                                 'minor_axis_length', 'perimeter', 'centroid']
 
-    if 'coords' not in regionprops_features:
-        regionprops_features.append('coords')
+    # coords are not needed for extraction, which is done over the whole fov at once
+    regionprops_features = [rpf for rpf in regionprops_features if rpf != 'coords']
 
     # labels are required
     if 'label' not in regionprops_features:
@@ -66,110 +202,1208 @@ def compute_marker_counts(input_images, segmentation_labels, nuclear_counts=Fals
 
     # create variable to hold names of returned columns only
     regionprops_names = copy.copy(regionprops_features)
-    regionprops_names.remove('coords')
 
     # centroid returns two columns, need to modify names
     if np.isin('centroid', regionprops_names):
         regionprops_names.remove('centroid')
         regionprops_names += ['centroid-0', 'centroid-1']
 
-    unique_cell_ids = np.unique(segmentation_labels[..., 0].values)
-    unique_cell_ids = unique_cell_ids[np.nonzero(unique_cell_ids)]
+    # bbox returns four columns, named the same way
+    if np.isin('bbox', regionprops_names):
+        bbox_index = regionprops_names.index('bbox')
+        regionprops_names[bbox_index:bbox_index + 1] = ['bbox-%d' % i for i in range(4)]
+
+    return regionprops_features, regionprops_names
+
+
+def _get_label_morphology(label_image, regionprops_features, morphology_cache=None,
+                          label_index=None):
+    """Compute the ids, sizes, regionprops and pixel positions of every label in a label image,
+    or look them up in the morphology cache
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of labels
+        regionprops_features (list):
+            morphology features for regionprops to extract for each label
+        morphology_cache (ark.segmentation.morphology_cache.MorphologyCache):
+            optional cache to look up and store the morphology in
+        label_index (ark.utils.segmentation_utils.LabelIndex):
+            optional prebuilt index of label_image
+
+    Returns:
+        tuple (ark.segmentation.morphology_cache.LabelMorphology,
+        ark.utils.segmentation_utils.LabelIndex):
+        - the morphology of every label, sorted by label
+        - the index of label_image, which is only built from the image if the morphology isn't
+          cached
+    """
+
+    if morphology_cache is not None:
+        morphology = morphology_cache.get(label_image, regionprops_features)
+        if morphology is not None:
+            if label_index is None:
+                label_index = segmentation_utils.LabelIndex.from_positions(
+                    label_image.shape, morphology.label_ids, morphology.label_sizes,
+                    morphology.pixel_indices, morphology.positions
+                )
+
+            return morphology, label_index
+
+    if label_index is None:
+        label_index = segmentation_utils.LabelIndex(label_image)
+
+    label_ids, label_sizes = label_index.label_ids, label_index.label_sizes
+
+    # regionprops are sorted by label like label_ids
+    props = pd.DataFrame(regionprops_table(label_image, regionprops_features,
+                                           label_index=label_index))
+
+    pixel_indices, positions = label_index.get_positions()
+
+    morphology = LabelMorphology(label_ids=label_ids, label_sizes=label_sizes, props=props,
+                                 pixel_indices=pixel_indices, positions=positions)
+
+    if morphology_cache is not None:
+        morphology_cache.put(label_image, regionprops_features, morphology)
+
+    return morphology, label_index
+
+
+def _assemble_marker_counts(compartments, channel_names, regionprops_names, cell_data,
+                            nuc_data=None, nuclear_overlap=None, derived_data=None):
+    """Combine the sizes, marker counts and morphology of the cells (and their nuclei) into the
+    compartments x cells x features array
+
+    Args:
+        compartments (xarray.DataArray):
+            the compartments coordinate of the segmentation labels
+        channel_names (numpy.ndarray):
+            the names of the channels
+        regionprops_names (list):
+            the names of the regionprops columns
+        cell_data (tuple):
+            sorted cell ids, cell sizes, cells x channels counts and regionprops table
+        nuc_data (tuple):
+            the same for the nuclei, if nuclear counts are computed
+        nuclear_overlap (ark.utils.segmentation_utils.NuclearOverlap):
+            overlap of the cells and nuclei in nuc_data, if nuclear counts are computed
+        derived_data (list):
+            tuples of compartment name, sizes, counts and regionprops table of each derived
+            compartment of the cells, ordered as the cells. They are added after compartments
+
+    Returns:
+        xarray.DataArray:
+            xarray containing segmented data of cells x markers
+    """
+
+    unique_cell_ids, cell_sizes, cell_counts, cell_props = cell_data
 
     # create labels for array holding channel counts and morphology metrics
-    feature_names = np.concatenate((np.array(settings.PRE_CHANNEL_COL), input_images.channels,
+    feature_names = np.concatenate((np.array(settings.PRE_CHANNEL_COL), channel_names,
                                     regionprops_names), axis=None)
 
+    if derived_data is None:
+        derived_data = []
+
+    compartment_names = list(compartments.values) + [data[0] for data in derived_data]
+
     # create np.array to hold compartment x cell x feature info
-    marker_counts_array = np.zeros((len(segmentation_labels.compartments), len(unique_cell_ids),
+    marker_counts_array = np.zeros((len(compartment_names), len(unique_cell_ids),
                                     len(feature_names)))
 
-    marker_counts = xr.DataArray(copy.copy(marker_counts_array),
-                                 coords=[segmentation_labels.compartments,
+    # fill in cell size, marker counts and morphology metrics positionally
+    cell_index = compartment_names.index('whole_cell')
+    marker_counts_array[cell_index, :, 0] = cell_sizes
+    marker_counts_array[cell_index, :, 1:] = np.concatenate(
+        (cell_counts, cell_props[regionprops_names].values), axis=1
+    )
+
+    if nuc_data is not None:
+        unique_nuc_ids, nuc_sizes, nuc_counts, nuc_props = nuc_data
+
+        # get id of the nucleus corresponding to each cell
+        nuc_ids = nuclear_overlap.get_nuclear_label_ids(unique_cell_ids)
+
+        # only cells with a corresponding nucleus get nuclear features
+        cell_rows = np.flatnonzero(nuc_ids)
+        nuc_rows = np.searchsorted(unique_nuc_ids, nuc_ids[cell_rows])
+
+        nuc_index = compartment_names.index('nuclear')
+        marker_counts_array[nuc_index, cell_rows, 0] = nuc_sizes[nuc_rows]
+        marker_counts_array[nuc_index, cell_rows, 1:] = np.concatenate(
+            (nuc_counts[nuc_rows], nuc_props[regionprops_names].values[nuc_rows]),
+            axis=1
+        )
+
+    for compartment, sizes, counts, props in derived_data:
+        derived_index = compartment_names.index(compartment)
+        marker_counts_array[derived_index, :, 0] = sizes
+        marker_counts_array[derived_index, :, 1:] = np.concatenate(
+            (counts, props[regionprops_names].values), axis=1
+        )
+
+    marker_counts = xr.DataArray(marker_counts_array,
+                                 coords=[compartment_names,
                                          unique_cell_ids.astype('int'),
                                          feature_names],
                                  dims=['compartments', 'cell_id', 'features'])
 
-    # get regionprops for each cell
-    cell_props = pd.DataFrame(regionprops_table(segmentation_labels.loc[:, :, 'whole_cell'].values,
-                                                properties=regionprops_features))
+    return marker_counts
+
+
+def _add_intensity_stats(props, stat_names, label_stats):
+    """Add the intensity statistics of each label to its regionprops
+
+    Args:
+        props (pandas.DataFrame):
+            the regionprops table of the labels
+        stat_names (list):
+            names of the statistics columns, ordered by statistic then channel
+        label_stats (numpy.ndarray):
+            stats x labels x channels matrix of intensity statistics
+
+    Returns:
+        pandas.DataFrame:
+            a copy of props with the statistics columns added
+    """
+
+    label_stats = np.transpose(label_stats, (1, 0, 2)).reshape(label_stats.shape[1], -1)
+
+    return pd.concat((props.reset_index(drop=True),
+                      pd.DataFrame(label_stats, columns=stat_names)), axis=1)
+
+
+def _get_qc_stats(channel_names, channel_sums, cell_sizes):
+    """Summarize the signal of each channel and the cells of a fov, for quality control
+
+    Args:
+        channel_names (numpy.ndarray):
+            the names of the channels
+        channel_sums (numpy.ndarray):
+            2 x channels matrix of the total signal and the signal inside cells, as returned by
+            `_get_channel_sums`
+        cell_sizes (numpy.ndarray):
+            the size of each cell
+
+    Returns:
+        pandas.DataFrame:
+            a row for each channel, with its total signal, the signal inside and outside of cells
+            and the fraction inside cells, along with the number of cells and the mean, median,
+            min and max of their sizes
+    """
+
+    total_intensity, cell_intensity = channel_sums
+
+    qc_stats = pd.DataFrame({
+        'channel': channel_names,
+        'total_intensity': total_intensity,
+        'cell_intensity': cell_intensity,
+        'background_intensity': total_intensity - cell_intensity,
+        'cell_fraction': np.divide(cell_intensity, total_intensity,
+                                   out=np.zeros(len(channel_names)),
+                                   where=total_intensity != 0),
+        'cell_count': len(cell_sizes)
+    })
+
+    for stat, stat_func in [('mean', np.mean), ('median', np.median), ('min', np.min),
+                            ('max', np.max)]:
+        qc_stats['cell_size_' + stat] = stat_func(cell_sizes) if len(cell_sizes) > 0 else 0
+
+    return qc_stats
+
+
+def compute_marker_counts(input_images, segmentation_labels, nuclear_counts=False,
+                          regionprops_features=None, split_large_nuclei=False,
+                          extraction='total_intensity', morphology_cache=None,
+                          label_indices=None, engine='numpy', intensity_stats=None,
+                          derived_compartments=None, qc_stats=False, **kwargs):
+    """Extract single cell protein expression data from channel TIFs for a single fov
+
+    Args:
+        input_images (xarray.DataArray or iterable):
+            rows x columns x channels matrix of imaging data. Can also be an iterable of
+            rows x columns x 1 xarrays holding one channel each, e.g. from
+            `load_utils.iter_imgs_from_tree`, in which case only one channel is held at a time
+        segmentation_labels (numpy.ndarray):
+            rows x columns x compartment matrix of masks
+        nuclear_counts (bool):
+            boolean flag to determine whether nuclear counts are returned
+        regionprops_features (list):
+            morphology features for regionprops to extract for each cell
+        split_large_nuclei (bool):
+            controls whether nuclei which have portions outside of the cell will get relabeled
+        extraction (str or dict):
+            extraction function used to compute marker counts. Custom methods can be added with
+            `signal_extraction.register_extraction`. Can also map channel names to their own
+            extraction function, with the channels not in it using
+            `signal_extraction.DEFAULT_EXTRACTION`, all computed from a single index of the
+            pixels of each cell
+        morphology_cache (ark.segmentation.morphology_cache.MorphologyCache):
+            optional on-disk cache of the morphology of each label image, so that quantifying
+            the same segmentation again skips regionprops
+        label_indices (dict):
+            optional prebuilt `segmentation_utils.LabelIndex` of the labels of each compartment,
+            by compartment name. Any missing index is built once here and shared by every step
+        engine (str):
+            engine running the extraction function, either 'numpy' or 'numba', which compiles
+            it and extracts the signal of the cells in parallel. Requires the optional `numba`
+            package, falling back to 'numpy' if it isn't installed
+        intensity_stats (list):
+            optional statistics of the pixel values of each cell to add for every channel, out
+            of 'mean', 'median', 'var' and percentiles given as e.g. 'p90'. They are added after
+            the regionprops features as columns named e.g. 'chan0_median', so they aren't size
+            normalized or arcsinh transformed
+        derived_compartments (list):
+            optional compartments of each cell to extract the signal of, out of 'cytoplasm',
+            the cell outside of any nucleus, and e.g. 'membrane2', the ring of the cell within 2
+            pixels of its boundary, see `segmentation_utils.get_membrane_width`. Their pixels
+            are filtered from those of each cell, and they are added after the compartments of
+            segmentation_labels, with the morphology of their cell
+        qc_stats (bool):
+            whether to summarize each channel and the cells from the images already being
+            extracted, see `_get_qc_stats`. The summary is kept in the `qc_stats` attribute of
+            the returned xarray
+        **kwargs:
+            arbitrary keyword arguments
+    Returns:
+        xarray.DataArray:
+            xarray containing segmented data of cells x markers
+    """
+
+    signal_extraction.verify_extraction(extraction)
+    misc_utils.verify_in_list(engine=engine, engine_options=signal_extraction.EXTRACTION_ENGINES)
+
+    if intensity_stats is not None:
+        for stat in intensity_stats:
+            signal_extraction.get_intensity_stat_percentile(stat)
+
+    if derived_compartments is None:
+        derived_compartments = []
+
+    for compartment in derived_compartments:
+        if segmentation_utils.get_membrane_width(compartment) is None:
+            misc_utils.verify_in_list(
+                nuclear_label='nuclear',
+                compartment_names=segmentation_labels.compartments.values
+            )
+
+    regionprops_features, regionprops_names = _get_regionprops_features(regionprops_features)
+
+    if label_indices is None:
+        label_indices = {}
+
+    cell_labels = segmentation_labels.loc[:, :, 'whole_cell'].values
+
+    # get ids, sizes and regionprops for each cell, sorted by label
+    cell_morphology, cell_index = _get_label_morphology(
+        cell_labels, regionprops_features, morphology_cache,
+        label_index=label_indices.get('whole_cell')
+    )
+    unique_cell_ids = cell_morphology.label_ids
+    cell_sizes = cell_morphology.label_sizes
+    cell_props = cell_morphology.props
+
+    # each set of labels the signal gets extracted from, along with their centroids and pixels
+    label_sets = [(cell_labels, unique_cell_ids, cell_props[['centroid-0', 'centroid-1']].values,
+                   (cell_morphology.pixel_indices, cell_morphology.positions))]
 
     if nuclear_counts:
         nuc_labels = segmentation_labels.loc[:, :, 'nuclear'].values
+        nuc_index = label_indices.get('nuclear')
 
         if split_large_nuclei:
-            cell_labels = segmentation_labels.loc[:, :, 'whole_cell'].values
+            if nuc_index is None:
+                nuc_index = segmentation_utils.LabelIndex(nuc_labels)
+
+            unsplit_overlap = segmentation_utils.NuclearOverlap(
+                cell_segmentation_labels=cell_labels, nuc_segmentation_labels=nuc_labels,
+                cell_index=cell_index, nuc_index=nuc_index
+            )
+
             nuc_labels = \
                 segmentation_utils.split_large_nuclei(cell_segmentation_labels=cell_labels,
                                                       nuc_segmentation_labels=nuc_labels,
-                                                      cell_ids=unique_cell_ids)
+                                                      cell_ids=unique_cell_ids,
+                                                      nuclear_overlap=unsplit_overlap,
+                                                      cell_index=cell_index,
+                                                      nuc_index=nuc_index)
 
-        nuc_props = pd.DataFrame(regionprops_table(nuc_labels, properties=regionprops_features))
+            # the relabeled nuclei need a new index
+            nuc_index = None
 
-    # TODO: There's some repeated code here, maybe worth refactoring? Maybe not
-    # loop through each cell in mask
-    for cell_id in cell_props['label']:
-        # get coords corresponding to current cell.
-        cell_coords = cell_props.loc[cell_props['label'] == cell_id, 'coords'].values[0]
+        nuc_morphology, nuc_index = _get_label_morphology(nuc_labels, regionprops_features,
+                                                          morphology_cache, label_index=nuc_index)
 
-        # get centroid corresponding to current cell
-        kwargs['centroid'] = np.array((
-            cell_props.loc[cell_props['label'] == cell_id, 'centroid-0'].values,
-            cell_props.loc[cell_props['label'] == cell_id, 'centroid-1'].values
-        )).T
+        nuclear_overlap = segmentation_utils.NuclearOverlap(
+            cell_segmentation_labels=cell_labels, nuc_segmentation_labels=nuc_labels,
+            cell_index=cell_index, nuc_index=nuc_index
+        )
+        unique_nuc_ids = nuc_morphology.label_ids
+        nuc_sizes = nuc_morphology.label_sizes
+        nuc_props = nuc_morphology.props
 
-        # calculate the total signal intensity within cell
-        cell_counts = extraction_function[extraction](cell_coords, input_images, **kwargs)
+        label_sets.append(
+            (nuc_labels, unique_nuc_ids, nuc_props[['centroid-0', 'centroid-1']].values,
+             (nuc_morphology.pixel_indices, nuc_morphology.positions))
+        )
 
-        # get morphology metrics
-        current_cell_props = cell_props.loc[cell_props['label'] == cell_id, regionprops_names]
+    # the derived compartments are extracted from a subset of the pixels of each cell
+    derived_start = len(label_sets)
+    if len(derived_compartments) > 0:
+        unsplit_nuc_labels = None
+        if 'nuclear' in segmentation_labels.compartments.values:
+            unsplit_nuc_labels = segmentation_labels.loc[:, :, 'nuclear'].values
+
+        for compartment in derived_compartments:
+            derived_positions = segmentation_utils.get_derived_compartment_positions(
+                compartment, cell_labels, label_sets[0][3], nuc_labels=unsplit_nuc_labels
+            )
+            label_sets.append((cell_labels, unique_cell_ids, label_sets[0][2], derived_positions))
+
+    # extract the signal of every cell (and nucleus) at once
+    channel_names, label_set_counts, label_set_stats, channel_sums = _extract_channel_counts(
+        input_images, label_sets, extraction, engine=engine, intensity_stats=intensity_stats,
+        channel_sums=qc_stats, **kwargs
+    )
 
-        # combine marker counts and morphology metrics together
-        cell_features = np.concatenate((cell_counts, current_cell_props), axis=None)
+    if isinstance(extraction, dict):
+        misc_utils.verify_in_list(extraction_channels=list(extraction),
+                                  image_channels=channel_names)
 
-        # add counts of each marker to appropriate column
-        marker_counts.loc['whole_cell', cell_id, marker_counts.features[1]:] = cell_features
+    if intensity_stats:
+        # the statistics are kept alongside the morphology, one column per stat and channel
+        stat_names = ['%s_%s' % (chan, stat) for stat in intensity_stats for chan in channel_names]
+        regionprops_names = regionprops_names + stat_names
 
-        # add cell size to first column
-        marker_counts.loc['whole_cell', cell_id, marker_counts.features[0]] = cell_coords.shape[0]
+    derived_data = []
+    for i, compartment in enumerate(derived_compartments, derived_start):
+        derived_props = cell_props
+        if intensity_stats:
+            derived_props = _add_intensity_stats(cell_props, stat_names, label_set_stats[i])
 
+        derived_data.append((compartment,
+                             np.bincount(label_sets[i][3][1], minlength=len(unique_cell_ids)),
+                             label_set_counts[i], derived_props))
+
+    if intensity_stats:
+        cell_props = _add_intensity_stats(cell_props, stat_names, label_set_stats[0])
         if nuclear_counts:
-            # get id of corresponding nucleus
-            nuc_id = segmentation_utils.find_nuclear_label_id(nuc_segmentation_labels=nuc_labels,
-                                                              cell_coords=cell_coords)
+            nuc_props = _add_intensity_stats(nuc_props, stat_names, label_set_stats[1])
+
+    marker_counts = _assemble_marker_counts(
+        segmentation_labels.compartments, channel_names, regionprops_names,
+        cell_data=(unique_cell_ids, cell_sizes, label_set_counts[0], cell_props),
+        nuc_data=(unique_nuc_ids, nuc_sizes, label_set_counts[1], nuc_props)
+        if nuclear_counts else None,
+        nuclear_overlap=nuclear_overlap if nuclear_counts else None,
+        derived_data=derived_data
+    )
+
+    if qc_stats:
+        marker_counts.attrs['qc_stats'] = _get_qc_stats(channel_names, channel_sums, cell_sizes)
 
-            if nuc_id is not None:
-                # get coordinates of corresponding nucleus
-                nuc_coords = nuc_props.loc[nuc_props['label'] == nuc_id, 'coords'].values[0]
+    return marker_counts
 
-                # get nuclear centroid
-                kwargs['centroid'] = np.array((
-                    nuc_props.loc[nuc_props['label'] == nuc_id, 'centroid-0'].values,
-                    nuc_props.loc[nuc_props['label'] == nuc_id, 'centroid-1'].values
-                )).T
 
-                # extract nuclear signal
-                nuc_counts = extraction_function[extraction](nuc_coords, input_images, **kwargs)
+# the per-label statistics gathered from each tile, combined over tiles with these reductions
+_LABEL_STAT_REDUCTIONS = [np.add, np.add, np.add, np.minimum, np.maximum, np.minimum, np.maximum]
 
-                # get morphology metrics
-                current_nuc_props = nuc_props.loc[
-                    nuc_props['label'] == nuc_id, regionprops_names]
 
-                # combine marker counts and morphology metrics together
-                nuc_features = np.concatenate((nuc_counts, current_nuc_props), axis=None)
+def _group_label_keys(keys):
+    """Sort rows of label keys so that equal keys are contiguous
 
-                # add counts of each marker to appropriate column
-                marker_counts.loc['nuclear', cell_id, marker_counts.features[1]:] = nuc_features
+    Args:
+        keys (numpy.ndarray):
+            n x k matrix of labels, e.g. the cell label, or cell and nuclear labels, of each pixel
 
-                # add cell size to first column
-                marker_counts.loc['nuclear', cell_id, marker_counts.features[0]] = \
-                    nuc_coords.shape[0]
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - order sorting the keys, which keeps equal keys in their original order
+        - index into the sorted keys of the first row of each distinct key
+    """
 
-    return marker_counts
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+
+    starts = np.flatnonzero(
+        np.concatenate(([True], np.any(sorted_keys[1:] != sorted_keys[:-1], axis=1)))
+    )
+
+    return order, starts
+
+
+def _get_label_stats(keys, rows, cols):
+    """Compute the size, coordinate sums and bounding box of every distinct key
+
+    Args:
+        keys (numpy.ndarray):
+            n x k matrix of the labels of each pixel
+        rows (numpy.ndarray):
+            row of each pixel
+        cols (numpy.ndarray):
+            column of each pixel
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - the distinct keys, sorted
+        - keys x 7 matrix of the pixel count, row sum, column sum, min row, max row, min column
+          and max column of each key
+    """
+
+    if len(keys) == 0:
+        return keys, np.zeros((0, len(_LABEL_STAT_REDUCTIONS)), dtype='int64')
+
+    order, starts = _group_label_keys(keys)
+    rows, cols = rows[order].astype('int64'), cols[order].astype('int64')
+
+    # pixels are in row major order within each key, so the first and last have the extreme rows
+    ends = np.append(starts[1:], len(keys)) - 1
+
+    stats = np.stack([ends - starts + 1,
+                      np.add.reduceat(rows, starts), np.add.reduceat(cols, starts),
+                      rows[starts], rows[ends],
+                      np.minimum.reduceat(cols, starts), np.maximum.reduceat(cols, starts)],
+                     axis=1)
+
+    return keys[order][starts], stats
+
+
+def _combine_label_stats(keys, stats):
+    """Combine the statistics of keys which appear more than once, e.g. in several tiles
+
+    Args:
+        keys (numpy.ndarray):
+            n x k matrix of keys
+        stats (numpy.ndarray):
+            n x 7 matrix of statistics, as returned by `_get_label_stats`
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - the distinct keys, sorted
+        - their combined statistics
+    """
+
+    if len(keys) == 0:
+        return keys, stats
+
+    order, starts = _group_label_keys(keys)
+    stats = stats[order]
+
+    combined_stats = np.stack([reduction.reduceat(stats[:, i], starts)
+                               for i, reduction in enumerate(_LABEL_STAT_REDUCTIONS)], axis=1)
+
+    return keys[order][starts], combined_stats
+
+
+def _compute_tile_label_stats(label_tile, tile_offset, nuclear_counts=False):
+    """Compute the label statistics of one tile of the segmentation labels
+
+    Args:
+        label_tile (xarray.DataArray):
+            rows x columns x compartment tile of the segmentation labels
+        tile_offset (tuple):
+            row and column of the tile's first pixel in the full label image
+        nuclear_counts (bool):
+            whether to also compute the statistics of each pair of cell and nuclear labels
+
+    Returns:
+        tuple:
+        - cell keys and statistics
+        - (cell, nucleus) keys and statistics of the nuclear pixels, or None
+    """
+
+    cell_labels = label_tile.loc[:, :, 'whole_cell'].values
+
+    rows, cols = np.nonzero(cell_labels)
+    cell_stats = _get_label_stats(cell_labels[rows, cols][:, np.newaxis],
+                                  rows + tile_offset[0], cols + tile_offset[1])
+
+    pair_stats = None
+    if nuclear_counts:
+        nuc_labels = label_tile.loc[:, :, 'nuclear'].values
+
+        # every nuclear pixel is keyed by the cell it lies in, 0 if it's outside of every cell
+        rows, cols = np.nonzero(nuc_labels)
+        pair_stats = _get_label_stats(
+            np.stack((cell_labels[rows, cols], nuc_labels[rows, cols]), axis=1),
+            rows + tile_offset[0], cols + tile_offset[1]
+        )
+
+    return cell_stats, pair_stats
+
+
+def _get_label_stats_geometry(stats):
+    """Get the centroid and the largest distance from it of every label from its statistics
+
+    Args:
+        stats (numpy.ndarray):
+            labels x 7 matrix of statistics, as returned by `_get_label_stats`
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - labels x 2 matrix of centroids, which are the same as those regionprops computes
+        - largest infinity norm distance between each label's centroid and its pixels
+    """
+
+    centroids = stats[:, 1:3] / stats[:, 0:1]
+
+    # the farthest pixels of a label lie on its bounding box
+    max_distances = np.max(np.abs(np.stack([stats[:, 3] - centroids[:, 0],
+                                            stats[:, 4] - centroids[:, 0],
+                                            stats[:, 5] - centroids[:, 1],
+                                            stats[:, 6] - centroids[:, 1]], axis=1)), axis=1)
+
+    return centroids, max_distances
+
+
+def _get_tiled_nuclear_overlap(cell_ids, cell_stats, pair_cell_ids, pair_nuc_ids, pair_stats,
+                               nuc_ids, nuc_stats):
+    """Build the cell/nucleus overlap table from the statistics of each (cell, nucleus) pair
+
+    Args:
+        cell_ids (numpy.ndarray):
+            sorted cell labels
+        cell_stats (numpy.ndarray):
+            statistics of each cell, as returned by `_get_label_stats`
+        pair_cell_ids (numpy.ndarray):
+            cell label of each pair, 0 for nuclear pixels outside of every cell
+        pair_nuc_ids (numpy.ndarray):
+            nuclear label of each pair
+        pair_stats (numpy.ndarray):
+            statistics of each pair
+        nuc_ids (numpy.ndarray):
+            sorted nuclear labels
+        nuc_stats (numpy.ndarray):
+            statistics of each nucleus
+
+    Returns:
+        ark.utils.segmentation_utils.NuclearOverlap:
+            the overlap table
+    """
+
+    # the pixels each cell shares with each nucleus are the sizes of their pairs
+    in_cell = pair_cell_ids > 0
+
+    return segmentation_utils.NuclearOverlap.from_overlap_counts(
+        cell_ids, cell_stats[:, 0], nuc_ids, nuc_stats[:, 0],
+        coo_matrix((pair_stats[in_cell, 0],
+                    (np.searchsorted(cell_ids, pair_cell_ids[in_cell]),
+                     np.searchsorted(nuc_ids, pair_nuc_ids[in_cell]))),
+                   shape=(len(cell_ids), len(nuc_ids)))
+    )
+
+
+def _quantify_tile(label_window, window_offset, image_tile, label_sets, regionprops_features,
+                   extraction, nuclear_splits=None, engine='numpy', **kwargs):
+    """Extract the partial signal of every label in a tile, and the morphology of the labels
+    which are entirely inside its window
+
+    Args:
+        label_window (xarray.DataArray):
+            rows x columns x compartment window of the segmentation labels, which starts at the
+            tile and extends past it by the halo
+        window_offset (tuple):
+            row and column of the window's first pixel in the full label image
+        image_tile (xarray.DataArray):
+            rows x columns x channels imaging data of the tile, None to only compute morphology
+        label_sets (list):
+            dicts with the `compartment` of the labels, the sorted `signal_ids` in the tile with
+            their global `centroids` and `max_distances`, and the sorted `morphology_ids` to
+            compute regionprops for
+        regionprops_features (list):
+            morphology features for regionprops to extract for each label
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        nuclear_splits (tuple):
+            split cells, their nuclei and the new labels of the split nuclei, as returned by
+            `NuclearOverlap.get_split_nuclei`, if large nuclei are split
+        engine (str):
+            engine running the extraction function, either 'numpy' or 'numba'
+        **kwargs:
+            arbitrary keyword arguments
+
+    Returns:
+        list:
+            for each label set, the signal_ids x channels matrix of partial counts (or None) and
+            the regionprops table of the morphology_ids, in the coordinates of the full label
+            image
+    """
+
+    extraction_func = signal_extraction.get_fov_extraction_function(extraction, engine)
+
+    results = []
+
+    for label_set in label_sets:
+        label_image = label_window.loc[:, :, label_set['compartment']].values
+
+        if label_set['compartment'] == 'nuclear' and nuclear_splits is not None:
+            label_image = segmentation_utils.relabel_split_nuclei(
+                label_window.loc[:, :, 'whole_cell'].values, label_image, *nuclear_splits
+            )
+
+        counts = None
+        if image_tile is not None:
+            # the centroids are shifted into the tile, which keeps the distances exact
+            counts = extraction_func(
+                label_image[:image_tile.shape[0], :image_tile.shape[1]], image_tile,
+                label_set['signal_ids'],
+                **dict(kwargs, centroid=label_set['centroids'] - np.array(window_offset),
+                       max_distance=label_set['max_distances'])
+            )
+
+        # only compute the morphology of the labels owned by this window
+        morphology_ids = label_set['morphology_ids']
+        if len(morphology_ids) > 0:
+            positions = np.searchsorted(morphology_ids, label_image)
+            positions[positions == len(morphology_ids)] = 0
+            label_image = np.where(morphology_ids[positions] == label_image, label_image, 0)
+        else:
+            label_image = np.zeros_like(label_image)
+
+        props = pd.DataFrame(regionprops_table(label_image, regionprops_features))
+
+        # shift the coordinates of the morphology from the window to the full label image
+        for column in props.columns:
+            prop, _, dim = column.rpartition('-')
+            if prop in ['bbox', 'centroid'] and dim.isdigit():
+                props[column] += window_offset[int(dim) % 2]
+
+        results.append((counts, props))
+
+    return results
+
+
+def _get_tile_bounds(shape, tile_size):
+    """Split an image into a grid of tiles
+
+    Args:
+        shape (tuple):
+            number of rows and columns of the image
+        tile_size (int):
+            number of rows and columns of each tile, except those on the bottom and right edges
+
+    Returns:
+        list:
+            (first row, last row + 1, first column, last column + 1) of each tile, in row major
+            order
+    """
+
+    return [(row, min(row + tile_size, shape[0]), col, min(col + tile_size, shape[1]))
+            for row in range(0, shape[0], tile_size)
+            for col in range(0, shape[1], tile_size)]
+
+
+def compute_marker_counts_tiled(input_images, segmentation_labels, tile_size=1024, halo=64,
+                                nuclear_counts=False, regionprops_features=None,
+                                split_large_nuclei=False, extraction='total_intensity',
+                                n_workers=None, executor=None, engine='numpy', **kwargs):
+    """Extract single cell protein expression data tile by tile, for label images which are too
+    large to hold in memory with every channel at once
+
+    Only a tile of the labels and imaging data is read at a time, through positional indexing,
+    so the inputs can be lazily loaded xarrays, e.g. backed by dask or memory mapped files. The
+    signal of cells which cross tile boundaries is summed over the tiles. The morphology of each
+    cell is computed by the tile its bounding box starts in, using a window extended past the
+    tile by the halo, or from its own bounding box if it doesn't fit in that window. The result
+    is the same as that of `compute_marker_counts` on the whole image, up to the order in which
+    floating point counts are summed.
+
+    Args:
+        input_images (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        segmentation_labels (xarray.DataArray):
+            rows x columns x compartment matrix of masks
+        tile_size (int):
+            number of rows and columns of each tile
+        halo (int):
+            number of pixels the morphology window extends past each tile, cells spanning more
+            than this past a tile boundary have their morphology computed separately
+        nuclear_counts (bool):
+            boolean flag to determine whether nuclear counts are returned
+        regionprops_features (list):
+            morphology features for regionprops to extract for each cell
+        split_large_nuclei (bool):
+            controls whether nuclei which have portions outside of the cell will get relabeled
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        n_workers (int):
+            number of processes to spread the tiles across, if None tiles are processed serially
+        executor (concurrent.futures.Executor):
+            optional executor to submit each tile to instead of creating a process pool
+        engine (str):
+            engine running the extraction function, either 'numpy' or 'numba', see
+            `compute_marker_counts`
+        **kwargs:
+            arbitrary keyword arguments
+
+    Returns:
+        xarray.DataArray:
+            xarray containing segmented data of cells x markers
+    """
+
+    signal_extraction.verify_extraction(extraction)
+
+    misc_utils.verify_in_list(engine=engine, engine_options=signal_extraction.EXTRACTION_ENGINES)
+
+    if tile_size <= 0 or halo < 0:
+        raise ValueError("tile_size must be positive and halo can't be negative")
+
+    # the statistics of the parts of a cell in each tile can't be combined into the cell's own
+    if kwargs.get('intensity_stats'):
+        raise ValueError("intensity_stats aren't supported by tiled quantification")
+
+    # membrane rings of cells crossing tile boundaries depend on the neighboring tiles
+    if kwargs.get('derived_compartments'):
+        raise ValueError("derived_compartments aren't supported by tiled quantification")
+
+    if kwargs.get('qc_stats'):
+        raise ValueError("qc_stats aren't supported by tiled quantification")
+
+    if isinstance(extraction, dict):
+        misc_utils.verify_in_list(extraction_channels=list(extraction),
+                                  image_channels=input_images.channels.values)
+
+    if nuclear_counts:
+        misc_utils.verify_in_list(
+            nuclear_label='nuclear',
+            compartment_names=segmentation_labels.compartments.values
+        )
+
+    if input_images.shape[:2] != segmentation_labels.shape[:2]:
+        raise ValueError("input_images and segmentation_labels must have the same shape")
+
+    regionprops_features, regionprops_names = _get_regionprops_features(regionprops_features)
+
+    image_shape = segmentation_labels.shape[:2]
+    tile_bounds = _get_tile_bounds(image_shape, tile_size)
+
+    # first pass over the labels, to find the size, centroid and extent of every label
+    tile_stats = list(_imap_in_order(
+        _compute_tile_label_stats,
+        (dict(label_tile=segmentation_labels[row_start:row_end, col_start:col_end, :],
+              tile_offset=(row_start, col_start), nuclear_counts=nuclear_counts)
+         for row_start, row_end, col_start, col_end in tile_bounds),
+        n_workers=n_workers, executor=executor
+    ))
+
+    cell_keys, cell_stats = _combine_label_stats(
+        np.concatenate([tile_cell[0] for tile_cell, _ in tile_stats]),
+        np.concatenate([tile_cell[1] for tile_cell, _ in tile_stats])
+    )
+    unique_cell_ids = cell_keys[:, 0]
+
+    # the ids of each label set which appear in each tile
+    tile_ids = [[tile_cell[0][:, 0]] for tile_cell, _ in tile_stats]
+    label_stats = [('whole_cell', unique_cell_ids, cell_stats)]
+
+    nuclear_overlap = None
+    nuclear_splits = None
+    if nuclear_counts:
+        pair_keys, pair_stats = _combine_label_stats(
+            np.concatenate([tile_pairs[0] for _, tile_pairs in tile_stats]),
+            np.concatenate([tile_pairs[1] for _, tile_pairs in tile_stats])
+        )
+
+        pair_nuc_ids = pair_keys[:, 1]
+        nuc_keys, nuc_stats = _combine_label_stats(pair_nuc_ids[:, np.newaxis], pair_stats)
+        unique_nuc_ids = nuc_keys[:, 0]
+
+        nuclear_overlap = _get_tiled_nuclear_overlap(unique_cell_ids, cell_stats, pair_keys[:, 0],
+                                                     pair_nuc_ids, pair_stats, unique_nuc_ids,
+                                                     nuc_stats)
+
+        if split_large_nuclei:
+            max_nuc_id = unique_nuc_ids[-1] if len(unique_nuc_ids) > 0 else 0
+            nuclear_splits = nuclear_overlap.get_split_nuclei(unique_cell_ids,
+                                                              max_nuc_id=max_nuc_id)
+
+            # each relabeled nucleus is made up of (cell, nucleus) pairs
+            pair_nuc_ids = segmentation_utils.relabel_split_nuclei(
+                pair_keys[:, 0], pair_keys[:, 1], *nuclear_splits
+            )
+            nuc_keys, nuc_stats = _combine_label_stats(pair_nuc_ids[:, np.newaxis], pair_stats)
+
+            # like split_large_nuclei, drop the small nuclei left over
+            large_nucs = nuc_stats[:, 0] >= 5
+            nuc_keys, nuc_stats = nuc_keys[large_nucs], nuc_stats[large_nucs]
+            unique_nuc_ids = nuc_keys[:, 0]
+
+            kept_pairs = np.isin(pair_nuc_ids, unique_nuc_ids)
+            pair_keys, pair_stats = pair_keys[kept_pairs], pair_stats[kept_pairs]
+            pair_nuc_ids = pair_nuc_ids[kept_pairs]
+
+            nuclear_overlap = _get_tiled_nuclear_overlap(unique_cell_ids, cell_stats,
+                                                         pair_keys[:, 0], pair_nuc_ids,
+                                                         pair_stats, unique_nuc_ids, nuc_stats)
+
+        for ids, (_, tile_pairs) in zip(tile_ids, tile_stats):
+            tile_nuc_ids = tile_pairs[0][:, 1]
+            if nuclear_splits is not None:
+                tile_nuc_ids = segmentation_utils.relabel_split_nuclei(
+                    tile_pairs[0][:, 0], tile_nuc_ids, *nuclear_splits
+                )
+            ids.append(np.intersect1d(tile_nuc_ids, unique_nuc_ids))
+
+        label_stats.append(('nuclear', unique_nuc_ids, nuc_stats))
+
+    # each label's morphology is computed by the tile its bounding box starts in, if it fits in
+    # that tile's window, otherwise from a window of its own bounding box
+    grid_cols = len(range(0, image_shape[1], tile_size))
+    label_geometry = []
+    tile_morphology_ids = [[] for _ in tile_bounds]
+    own_windows = []
+    for compartment_index, (compartment, ids, stats) in enumerate(label_stats):
+        centroids, max_distances = _get_label_stats_geometry(stats)
+        label_geometry.append((centroids, max_distances))
+
+        owner_rows, owner_cols = stats[:, 3] // tile_size, stats[:, 5] // tile_size
+        fits = np.logical_and(stats[:, 4] < (owner_rows + 1) * tile_size + halo,
+                              stats[:, 6] < (owner_cols + 1) * tile_size + halo)
+        owners = owner_rows * grid_cols + owner_cols
+
+        for tile_index, morphology_ids in enumerate(tile_morphology_ids):
+            morphology_ids.append(ids[np.logical_and(fits, owners == tile_index)])
+
+        for label_index in np.flatnonzero(~fits):
+            own_windows.append((compartment_index, ids[label_index], stats[label_index, 3:]))
+
+    def get_label_sets(ids_in_tile, morphology_ids):
+        label_sets = []
+        for (compartment, ids, _), (centroids, max_distances), signal_ids, owned_ids in \
+                zip(label_stats, label_geometry, ids_in_tile, morphology_ids):
+            positions = np.searchsorted(ids, signal_ids)
+            label_sets.append(dict(compartment=compartment, signal_ids=signal_ids,
+                                   centroids=centroids[positions],
+                                   max_distances=max_distances[positions],
+                                   morphology_ids=owned_ids))
+        return label_sets
+
+    empty_ids = np.zeros(0, dtype=unique_cell_ids.dtype)
+    task_kwargs = [
+        dict(label_window=segmentation_labels[row_start:row_end + halo,
+                                              col_start:col_end + halo, :],
+             window_offset=(row_start, col_start),
+             image_tile=input_images[row_start:row_end, col_start:col_end, :],
+             label_sets=get_label_sets(ids_in_tile, morphology_ids))
+        for (row_start, row_end, col_start, col_end), ids_in_tile, morphology_ids
+        in zip(tile_bounds, tile_ids, tile_morphology_ids)
+    ]
+    for compartment_index, label_id, (row_min, row_max, col_min, col_max) in own_windows:
+        morphology_ids = [empty_ids] * len(label_stats)
+        morphology_ids[compartment_index] = np.array([label_id])
+        task_kwargs.append(dict(
+            label_window=segmentation_labels[row_min:row_max + 1, col_min:col_max + 1, :],
+            window_offset=(row_min, col_min), image_tile=None,
+            label_sets=get_label_sets([empty_ids] * len(label_stats), morphology_ids)
+        ))
+
+    # second pass over the labels, along with the imaging data
+    label_set_counts = [np.zeros((len(ids), len(input_images.channels)))
+                        for _, ids, _ in label_stats]
+    label_set_props = [[] for _ in label_stats]
+    for task, results in zip(task_kwargs, _imap_in_order(
+            _quantify_tile,
+            (dict(task, regionprops_features=regionprops_features, extraction=extraction,
+                  nuclear_splits=nuclear_splits, engine=engine, **kwargs)
+             for task in task_kwargs),
+            n_workers=n_workers, executor=executor)):
+        for (counts, props), label_set, (_, ids, _), total_counts, all_props in zip(
+                results, task['label_sets'], label_stats, label_set_counts, label_set_props):
+            if counts is not None:
+                total_counts[np.searchsorted(ids, label_set['signal_ids'])] += counts
+            all_props.append(props)
+
+    # put the morphology in label order
+    label_set_props = [
+        pd.concat(props, ignore_index=True).sort_values(
+            settings.POST_CHANNEL_COL).reset_index(drop=True)
+        for props in label_set_props
+    ]
+
+    cell_data, *nuc_data = [
+        (ids, stats[:, 0], counts, props) for (_, ids, stats), counts, props
+        in zip(label_stats, label_set_counts, label_set_props)
+    ]
+
+    return _assemble_marker_counts(
+        segmentation_labels.compartments, input_images.channels.values, regionprops_names,
+        cell_data=cell_data, nuc_data=nuc_data[0] if nuclear_counts else None,
+        nuclear_overlap=nuclear_overlap
+    )
+
+
+def _compute_fov_cell_tables(fov, segmentation_label, image_data, nuclear_counts=False,
+                             split_large_nuclei=False, extraction='total_intensity',
+                             compact=False, qc_stats=False, **kwargs):
+    """Create the size normalized and arcsinh transformed cell tables of a single fov
+
+    Args:
+        fov (str):
+            name of the fov, added as the fov column
+        segmentation_label (xarray.DataArray):
+            rows x columns x compartment matrix of masks
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        nuclear_counts (bool):
+            boolean flag to determine whether nuclear counts are returned
+        split_large_nuclei (bool):
+            boolean flag to determine whether nuclei which are larger than their assigned cell
+            will get split into two different nuclear objects
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        compact (bool):
+            whether to return the tables in the compact schema of `compact_cell_table`
+        qc_stats (bool):
+            whether to also return the quality control summary of the fov, see
+            `compute_marker_counts`
+        **kwargs:
+            arbitrary keyword args
+
+    Returns:
+        tuple (pandas.DataFrame, pandas.DataFrame) or
+        tuple (pandas.DataFrame, pandas.DataFrame, pandas.DataFrame):
+        - marker counts per cell normalized by cell size
+        - arcsinh transformation of the above
+        - the quality control summary of each channel, if qc_stats is set
+    """
+
+    print("extracting data from {}".format(fov))
+
+    # extract the counts per cell for each marker
+    marker_counts = compute_marker_counts(image_data, segmentation_label,
+                                          nuclear_counts=nuclear_counts,
+                                          split_large_nuclei=split_large_nuclei,
+                                          extraction=extraction, qc_stats=qc_stats, **kwargs)
+
+    # normalize counts by cell size and arcsinh transform them, reusing the raw counts' memory
+    marker_counts_norm, marker_counts_arcsinh = segmentation_utils.size_norm_arcsinh_transform(
+        marker_counts, in_place=True, dtype='float32' if compact else None
+    )
+
+    # add data from each fov to array
+    normalized = pd.DataFrame(data=marker_counts_norm.loc['whole_cell', :, :].values,
+                              columns=marker_counts_norm.features)
+
+    arcsinh = pd.DataFrame(data=marker_counts_arcsinh.values[0, :, :],
+                           columns=marker_counts_arcsinh.features)
+
+    if nuclear_counts:
+        # append nuclear counts pandas array with modified column name
+        nuc_column_names = [feature + '_nuclear' for feature in marker_counts.features.values]
+
+        # add nuclear counts to size normalized data
+        normalized_nuc = pd.DataFrame(data=marker_counts_norm.loc['nuclear', :, :].values,
+                                      columns=nuc_column_names)
+        normalized = pd.concat((normalized, normalized_nuc), axis=1)
+
+        # add nuclear counts to arcsinh transformed data
+        arcsinh_nuc = pd.DataFrame(data=marker_counts_arcsinh.loc['nuclear', :, :].values,
+                                   columns=nuc_column_names)
+        arcsinh = pd.concat((arcsinh, arcsinh_nuc), axis=1)
+
+    # derived compartments only add their size and channels, their morphology is the cell's
+    derived_compartments = marker_counts.compartments.values[
+        len(segmentation_label.compartments):
+    ]
+    channel_features = list(marker_counts.features.values[
+        :list(marker_counts.features.values).index(settings.POST_CHANNEL_COL)
+    ])
+
+    for compartment in derived_compartments:
+        derived_column_names = [feature + '_' + compartment for feature in channel_features]
+
+        normalized = pd.concat((normalized, pd.DataFrame(
+            data=marker_counts_norm.loc[compartment, :, channel_features].values,
+            columns=derived_column_names
+        )), axis=1)
+        arcsinh = pd.concat((arcsinh, pd.DataFrame(
+            data=marker_counts_arcsinh.loc[compartment, :, channel_features].values,
+            columns=derived_column_names
+        )), axis=1)
+
+    # add column for current fov
+    normalized['fov'] = fov
+    arcsinh['fov'] = fov
+
+    if compact:
+        normalized, arcsinh = compact_cell_table(normalized), compact_cell_table(arcsinh)
+
+    if qc_stats:
+        fov_qc_stats = marker_counts.attrs['qc_stats']
+        fov_qc_stats.insert(0, 'fov', fov)
+
+        return normalized, arcsinh, fov_qc_stats
+
+    return normalized, arcsinh
+
+
+def compact_cell_table(cell_table):
+    """Convert a cell table to the compact schema, which stores the label and size columns of
+    every compartment as int32, every other numeric column as float32 and the fov column as a
+    categorical
+
+    Compact tables take about half the memory and can be used anywhere the full precision ones
+    can, e.g. by `spatial_analysis` and `visualize`.
+
+    Args:
+        cell_table (pandas.DataFrame):
+            size normalized or arcsinh transformed cell table
+
+    Returns:
+        pandas.DataFrame:
+            the cell table in the compact schema
+    """
+
+    int_columns = [settings.CELL_SIZE, settings.CELL_LABEL, settings.CELL_LABEL + '_nuclear']
+
+    dtypes = {}
+    for column, dtype in cell_table.dtypes.items():
+        if column == 'fov':
+            dtypes[column] = 'category'
+        elif column in int_columns or column.startswith(settings.CELL_SIZE + '_'):
+            dtypes[column] = 'int32'
+        elif np.issubdtype(dtype, np.number):
+            dtypes[column] = 'float32'
+
+    return cell_table.astype(dtypes, copy=False)
+
+
+def _imap_in_order(func, task_kwargs, n_workers=None, executor=None):
+    """Run func on each set of keyword arguments, optionally across a pool of processes
+
+    Args:
+        func (function):
+            module level function to run, so that it can be sent to worker processes
+        task_kwargs (iterable):
+            keyword argument dicts, one for each call of func. Consumed lazily, so that only the
+            arguments of the tasks in flight are held at once
+        n_workers (int):
+            number of worker processes to spawn if no executor is given, if None or 1 func is
+            run serially in the current process
+        executor (concurrent.futures.Executor):
+            optional existing executor to submit the tasks to, takes precedence over n_workers
+
+    Yields:
+        the result of each call of func, in the same order as task_kwargs
+    """
+
+    if executor is None and (n_workers is None or n_workers <= 1):
+        for kwargs in task_kwargs:
+            yield func(**kwargs)
+        return
+
+    if executor is None:
+        # forking a process whose numba threads are running deadlocks on exit, so the workers
+        # are spawned afresh
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            yield from _imap_in_order(func, task_kwargs, n_workers=n_workers, executor=pool)
+        return
+
+    # keep every worker busy without queueing up all of the tasks' arguments
+    max_pending = 2 * (n_workers if n_workers is not None else os.cpu_count() or 1)
+
+    # return results in submission order rather than completion order
+    pending = collections.deque()
+    for kwargs in task_kwargs:
+        pending.append(executor.submit(func, **kwargs))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def _collect_cell_tables(cell_tables, sink=None, qc_stats=False):
+    """Combine or stream out (size normalized, arcsinh transformed) cell table pairs
+
+    Args:
+        cell_tables (iterable):
+            tuple (pandas.DataFrame, pandas.DataFrame) of cell tables, e.g. one for each fov,
+            followed by their quality control summary if qc_stats is set
+        sink (ark.segmentation.cell_table_sinks.CellTableSink):
+            if provided, each pair is written to the sink as soon as it's available, and nothing
+            is kept in memory
+        qc_stats (bool):
+            whether the cell tables come with quality control summaries, which are combined too
+
+    Returns:
+        tuple (pandas.DataFrame, pandas.DataFrame) or None:
+        - the combined size normalized and arcsinh transformed tables, None if sink is provided.
+          If qc_stats is set, the combined quality control summary is added after the tables,
+          or returned on its own if sink is provided
+    """
+
+    qc_tables = []
+
+    def pop_qc_stats(cell_tables):
+        for tables in cell_tables:
+            if qc_stats:
+                qc_tables.append(tables[2])
+            yield tables[:2]
+
+    cell_tables = pop_qc_stats(cell_tables)
+
+    if sink is not None:
+        for normalized, arcsinh in cell_tables:
+            sink.write(normalized, arcsinh)
+        tables = None
+    else:
+        normalized_tables, arcsinh_tables = [], []
+        for normalized, arcsinh in cell_tables:
+            normalized_tables.append(normalized)
+            arcsinh_tables.append(arcsinh)
+
+        # concatenate once, rather than copying the combined table for every fov
+        if len(normalized_tables) == 0:
+            tables = pd.DataFrame(), pd.DataFrame()
+        else:
+            tables = _concat_cell_tables(normalized_tables), _concat_cell_tables(arcsinh_tables)
+
+    if not qc_stats:
+        return tables
+
+    qc_table = pd.concat(qc_tables, ignore_index=True) if len(qc_tables) > 0 \
+        else pd.DataFrame()
+
+    return qc_table if tables is None else tables + (qc_table,)
+
+
+def _concat_cell_tables(cell_tables):
+    """Concatenate cell tables, keeping the fov column of compact tables categorical
+
+    Args:
+        cell_tables (list):
+            the cell tables to combine
+
+    Returns:
+        pandas.DataFrame:
+            the combined cell table
+    """
+
+    fov_dtypes = [table['fov'].dtype for table in cell_tables if 'fov' in table.columns]
+
+    # categoricals only stay categorical through pd.concat if they share their categories
+    if len(fov_dtypes) > 0 and all(pd.api.types.is_categorical_dtype(dtype)
+                                   for dtype in fov_dtypes):
+        fov_categories = sorted(set().union(*(dtype.categories for dtype in fov_dtypes)))
+
+        for table in cell_tables:
+            if 'fov' in table.columns:
+                table['fov'] = table['fov'].cat.set_categories(fov_categories)
+
+    return pd.concat(cell_tables)
 
 
 def create_marker_count_matrices(segmentation_labels, image_data, nuclear_counts=False,
-                                 split_large_nuclei=False, extraction='total_intensity', **kwargs):
+                                 split_large_nuclei=False, extraction='total_intensity',
+                                 n_workers=None, executor=None, sink=None, compact=False,
+                                 qc_stats=False, **kwargs):
     """Create a matrix of cells by channels with the total counts of each marker in each cell.
 
     Args:
@@ -184,15 +1418,31 @@ def create_marker_count_matrices(segmentation_labels, image_data, nuclear_counts
         split_large_nuclei (bool):
             boolean flag to determine whether nuclei which are larger than their assigned cell
             will get split into two different nuclear objects
-        extraction (str):
-            extraction function used to compute marker counts.
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        n_workers (int):
+            number of processes to spread the fovs across, if None fovs are processed serially
+        executor (concurrent.futures.Executor):
+            optional executor to submit each fov to instead of creating a process pool
+        sink (ark.segmentation.cell_table_sinks.CellTableSink):
+            optional sink each fov's rows are written to as soon as they are computed, in which
+            case nothing is returned
+        compact (bool):
+            whether to return the tables in the compact schema of `compact_cell_table`, with
+            float32 channels and morphology, int32 labels and sizes and a categorical fov
+        qc_stats (bool):
+            whether to also return a quality control summary of every fov and channel, computed
+            from the images as they are extracted, see `compute_marker_counts`. With a sink,
+            only the summary is returned
         **kwargs:
             arbitrary keyword args
 
     Returns:
-        tuple (pandas.DataFrame, pandas.DataFrame):
+        tuple (pandas.DataFrame, pandas.DataFrame) or None:
         - marker counts per cell normalized by cell size
         - arcsinh transformation of the above
+        - the quality control summary, if qc_stats is set
     """
 
     if type(segmentation_labels) is not xr.DataArray:
@@ -207,73 +1457,115 @@ def create_marker_count_matrices(segmentation_labels, image_data, nuclear_counts
             compartment_names=segmentation_labels.compartments.values
         )
 
-    misc_utils.verify_in_list(
-        extraction=extraction,
-        extraction_options=list(extraction_function.keys())
-    )
+    signal_extraction.verify_extraction(extraction)
 
     misc_utils.verify_same_elements(segmentation_labels_fovs=segmentation_labels.fovs.values,
                                     img_data_fovs=image_data.fovs.values)
 
-    # initialize data frames
-    normalized_data = pd.DataFrame()
-    arcsinh_data = pd.DataFrame()
-
-    # loop over each fov in the dataset
-    for fov in segmentation_labels.fovs.values:
-        print("extracting data from {}".format(fov))
-
-        # current mask
-        segmentation_label = segmentation_labels.loc[fov, :, :, :]
-
-        # extract the counts per cell for each marker
-        marker_counts = compute_marker_counts(image_data.loc[fov, :, :, :], segmentation_label,
-                                              nuclear_counts=nuclear_counts,
-                                              split_large_nuclei=split_large_nuclei,
-                                              extraction=extraction, **kwargs)
-
-        # normalize counts by cell size
-        marker_counts_norm = segmentation_utils.transform_expression_matrix(marker_counts,
-                                                                            transform='size_norm')
-
-        # arcsinh transform the data
-        marker_counts_arcsinh = segmentation_utils.transform_expression_matrix(marker_counts_norm,
-                                                                               transform='arcsinh')
-
-        # add data from each fov to array
-        normalized = pd.DataFrame(data=marker_counts_norm.loc['whole_cell', :, :].values,
-                                  columns=marker_counts_norm.features)
+    # compute each fov's tables, in fov order
+    fov_tables = _imap_in_order(
+        _compute_fov_cell_tables,
+        (dict(fov=fov, segmentation_label=segmentation_labels.loc[fov, :, :, :],
+              image_data=image_data.loc[fov, :, :, :], nuclear_counts=nuclear_counts,
+              split_large_nuclei=split_large_nuclei, extraction=extraction, compact=compact,
+              qc_stats=qc_stats, **kwargs)
+         for fov in segmentation_labels.fovs.values),
+        n_workers=n_workers, executor=executor
+    )
 
-        arcsinh = pd.DataFrame(data=marker_counts_arcsinh.values[0, :, :],
-                               columns=marker_counts_arcsinh.features)
+    return _collect_cell_tables(fov_tables, sink=sink, qc_stats=qc_stats)
 
-        if nuclear_counts:
-            # append nuclear counts pandas array with modified column name
-            nuc_column_names = [feature + '_nuclear' for feature in marker_counts.features.values]
 
-            # add nuclear counts to size normalized data
-            normalized_nuc = pd.DataFrame(data=marker_counts_norm.loc['nuclear', :, :].values,
-                                          columns=nuc_column_names)
-            normalized = pd.concat((normalized, normalized_nuc), axis=1)
+def _generate_batch_cell_tables(segmentation_labels, tiff_dir, img_sub_folder, is_mibitiff,
+                                batch_names, batch_files, dtype, extraction,
+                                channel_at_a_time=False, channels=None, qc_stats=False,
+                                **kwargs):
+    """Load the images of a batch of fovs and compute their cell tables
 
-            # add nuclear counts to arcsinh transformed data
-            arcsinh_nuc = pd.DataFrame(data=marker_counts_arcsinh.loc['nuclear', :, :].values,
-                                       columns=nuc_column_names)
-            arcsinh = pd.concat((arcsinh, arcsinh_nuc), axis=1)
+    Args:
+        segmentation_labels (xarray.DataArray):
+            an xarray with the segmented data of the fovs in the batch
+        tiff_dir (str):
+            the name of the directory which contains the single_channel_inputs
+        img_sub_folder (str):
+            the name of the folder where the TIF images are located
+        is_mibitiff (bool):
+            a flag to indicate whether or not the base images are MIBItiffs
+        batch_names (list):
+            the fovs in the batch
+        batch_files (list):
+            the MIBItiff files of the fovs in the batch
+        dtype (str/type):
+            data type of base images
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        channel_at_a_time (bool):
+            whether to read and quantify one channel plane at a time rather than loading all of
+            the batch's images at once
+        channels (list):
+            optional channels to load and quantify, otherwise all channels are
+        qc_stats (bool):
+            whether to also return the quality control summary of the batch
+        **kwargs:
+            arbitrary keyword arguments for signal extraction
 
-        # add column for current fov
-        normalized['fov'] = fov
-        normalized_data = normalized_data.append(normalized)
+    Returns:
+        tuple (pandas.DataFrame, pandas.DataFrame):
+        - size normalized data
+        - arcsinh transformed data
+        - the quality control summary, if qc_stats is set
+    """
 
-        arcsinh['fov'] = fov
-        arcsinh_data = arcsinh_data.append(arcsinh)
+    if channel_at_a_time:
+        # planes are only read while each fov is being quantified
+        if is_mibitiff:
+            fov_planes = (load_utils.iter_imgs_from_mibitiff(data_dir=tiff_dir,
+                                                             mibitiff_file=fov_file,
+                                                             channels=channels, dtype=dtype)
+                          for fov_file in batch_files)
+        else:
+            fov_planes = (load_utils.iter_imgs_from_tree(data_dir=tiff_dir, fov=fov,
+                                                         img_sub_folder=img_sub_folder,
+                                                         channels=channels, dtype=dtype)
+                          for fov in batch_names)
+
+        fov_tables = (
+            _compute_fov_cell_tables(fov=fov,
+                                     segmentation_label=segmentation_labels.loc[fov, :, :, :],
+                                     image_data=image_planes, extraction=extraction,
+                                     qc_stats=qc_stats, **kwargs)
+            for fov, image_planes in zip(batch_names, fov_planes)
+        )
 
-    return normalized_data, arcsinh_data
+        return _collect_cell_tables(fov_tables, qc_stats=qc_stats)
+
+    # extract the image data for the batch
+    if is_mibitiff:
+        image_data = load_utils.load_imgs_from_mibitiff(data_dir=tiff_dir,
+                                                        mibitiff_files=batch_files,
+                                                        channels=channels, dtype=dtype)
+    else:
+        image_data = load_utils.load_imgs_from_tree(data_dir=tiff_dir,
+                                                    img_sub_folder=img_sub_folder,
+                                                    fovs=batch_names,
+                                                    channels=channels, dtype=dtype)
+
+    # segment the imaging data
+    return create_marker_count_matrices(
+        segmentation_labels=segmentation_labels,
+        image_data=image_data,
+        extraction=extraction,
+        qc_stats=qc_stats,
+        **kwargs
+    )
 
 
 def generate_cell_table(segmentation_labels, tiff_dir, img_sub_folder,
                         is_mibitiff=False, fovs=None, batch_size=5, dtype="int16",
-                        extraction='total_intensity', **kwargs):
+                        extraction='total_intensity', n_workers=None, executor=None, sink=None,
+                        channel_at_a_time=False, checkpoint_dir=None, compact=False,
+                        channels=None, qc_stats=False, **kwargs):
     """This function takes the segmented data and computes the expression matrices batch-wise
     while also validating inputs
 
@@ -290,18 +1582,46 @@ def generate_cell_table(segmentation_labels, tiff_dir, img_sub_folder,
             a flag to indicate whether or not the base images are MIBItiffs
         batch_size (int):
             how large we want each of the batches of fovs to be when computing, adjust as
-            necessary for speed and memory considerations
+            necessary for speed and memory considerations. Ignored when running in parallel,
+            where each worker loads and processes one fov at a time
         dtype (str/type):
             data type of base images
-        extraction (str):
-            extraction function used to compute marker counts.
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        n_workers (int):
+            number of processes to spread the fovs across, if None fovs are processed serially
+        executor (concurrent.futures.Executor):
+            optional executor to submit each fov to instead of creating a process pool
+        sink (ark.segmentation.cell_table_sinks.CellTableSink):
+            optional sink each batch's rows are written to as soon as they are computed, in
+            which case nothing is returned
+        channel_at_a_time (bool):
+            whether to read and quantify one channel plane at a time, from the tree TIFs or the
+            MIBItiff pages, so that peak image memory is a single plane regardless of plex
+        checkpoint_dir (str):
+            optional directory each fov's tables are saved to as soon as they are computed. If it
+            holds a checkpoint of an earlier run with the same parameters, the fovs that run
+            completed are read back instead of being computed again
+        compact (bool):
+            whether to return the tables in the compact schema of `compact_cell_table`, with
+            float32 channels and morphology, int32 labels and sizes and a categorical fov,
+            which takes about half the memory
+        channels (list):
+            optional channels to load and quantify, otherwise all channels are
+        qc_stats (bool):
+            whether to also return a quality control summary of every fov and channel, with
+            the total signal, the signal inside and outside of cells, the number of cells and
+            their size distribution. It is computed from the images as they are extracted,
+            rather than reading them again. With a sink, only the summary is returned
         **kwargs:
             arbitrary keyword arguments for signal extraction
 
     Returns:
-        tuple (pandas.DataFrame, pandas.DataFrame):å
+        tuple (pandas.DataFrame, pandas.DataFrame) or None:
         - size normalized data
         - arcsinh transformed data
+        - the quality control summary, if qc_stats is set
     """
 
     # if no fovs are specified, then load all the fovs
@@ -314,10 +1634,13 @@ def generate_cell_table(segmentation_labels, tiff_dir, img_sub_folder,
     # drop file extensions
     fovs = io_utils.remove_file_extensions(fovs)
 
-    misc_utils.verify_in_list(
-        extraction=extraction,
-        extraction_options=list(extraction_function.keys())
-    )
+    signal_extraction.verify_extraction(extraction)
+
+    if kwargs.get('nuclear_counts', False):
+        misc_utils.verify_in_list(
+            nuclear_label='nuclear',
+            compartment_names=segmentation_labels.compartments.values
+        )
 
     # check segmentation_labels for given fovs (img loaders will fail otherwise)
     misc_utils.verify_in_list(fovs=fovs,
@@ -330,46 +1653,214 @@ def generate_cell_table(segmentation_labels, tiff_dir, img_sub_folder,
     fovs.sort()
     filenames.sort()
 
-    # defined some vars for batch processing
-    cohort_len = len(fovs)
+    # only compute the fovs a previous run hasn't already checkpointed
+    pending_fovs, pending_files = fovs, filenames
+    if checkpoint_dir is not None:
+        checkpoint = cell_table_sinks.CellTableCheckpoint(checkpoint_dir, parameters=dict(
+            img_sub_folder=img_sub_folder, is_mibitiff=is_mibitiff, dtype=str(np.dtype(dtype)),
+            extraction=extraction, channels=channels, qc_stats=qc_stats, compact=compact,
+            **{key: value for key, value in kwargs.items()
+               if key not in ['morphology_cache', 'engine']}
+        ))
+
+        completed_fovs = checkpoint.completed_fovs
+        pending_fovs = [fov for fov in fovs if fov not in completed_fovs]
+        pending_files = [filename for filename in filenames
+                         if io_utils.remove_file_extensions([filename])[0] not in completed_fovs]
+
+    # defined some vars for batch processing, workers each get a single fov
+    cohort_len = len(pending_fovs)
+    if executor is not None or (n_workers is not None and n_workers > 1):
+        batch_size = 1
+
+    batch_names_list = [pending_fovs[i:i + batch_size] for i in range(0, cohort_len, batch_size)]
+    batch_files_list = [pending_files[i:i + batch_size] for i in range(0, cohort_len, batch_size)]
+
+    # each batch loads its own images, so only the labels get sent to workers
+    batch_tables = _imap_in_order(
+        _generate_batch_cell_tables,
+        (dict(segmentation_labels=segmentation_labels.loc[batch_names, :, :, :],
+              tiff_dir=tiff_dir, img_sub_folder=img_sub_folder, is_mibitiff=is_mibitiff,
+              batch_names=batch_names, batch_files=batch_files, dtype=dtype,
+              extraction=extraction, channel_at_a_time=channel_at_a_time, compact=compact,
+              channels=channels, qc_stats=qc_stats, **kwargs)
+         for batch_names, batch_files in zip(batch_names_list, batch_files_list)),
+        n_workers=n_workers, executor=executor
+    )
+
+    if checkpoint_dir is not None:
+        # save each batch as soon as it is done, then gather every fov from the checkpoint
+        for batch_names, tables in zip(batch_names_list, batch_tables):
+            checkpoint.write(batch_names, *tables)
+
+        batch_tables = (checkpoint.read(fov) for fov in fovs)
+
+        # the checkpoint holds the float32 values of a compact run, but is read back as float64
+        if compact:
+            batch_tables = ((compact_cell_table(tables[0]), compact_cell_table(tables[1])) +
+                            tables[2:] for tables in batch_tables)
+
+    return _collect_cell_tables(batch_tables, sink=sink, qc_stats=qc_stats)
+
+
+def _merge_channel_columns(cell_table, channel_table, channels, compartment_suffixes,
+                           last_channel, intensity_stats=None):
+    """Add the columns of new channels to a cell table, matching cells by fov and label
+
+    Args:
+        cell_table (pandas.DataFrame):
+            size normalized or arcsinh transformed cell table
+        channel_table (pandas.DataFrame):
+            cell table of the same cells, holding the new channels
+        channels (list):
+            the new channels
+        compartment_suffixes (list):
+            suffix of the columns of each compartment, e.g. '' for the whole cell and
+            '_nuclear' for the nuclei
+        last_channel (str):
+            the last of the existing channels, which the new channels are added after
+        intensity_stats (list):
+            optional intensity statistics of the cell tables, whose new channel columns are
+            added after those of last_channel in the compartments which have them
+
+    Returns:
+        pandas.DataFrame:
+            cell_table with the new channels after the existing channels of each compartment,
+            missing for any cell which isn't in channel_table
+    """
+
+    def get_cell_keys(table):
+        return pd.MultiIndex.from_arrays([table['fov'].astype(str).values,
+                                          table[settings.CELL_LABEL].values.astype('int64')])
+
+    columns = list(cell_table.columns)
+    new_columns = []
+
+    # the statistics columns of each channel are named like '<channel>_<stat>'
+    column_formats = ['%s'] + ['%s_' + stat for stat in (intensity_stats or [])]
+
+    for suffix in compartment_suffixes:
+        for column_format in column_formats:
+            # derived compartments don't have statistics columns
+            if column_format % last_channel + suffix not in columns:
+                continue
+
+            compartment_columns = [column_format % chan + suffix for chan in channels]
+
+            end_index = columns.index(column_format % last_channel + suffix) + 1
+            columns[end_index:end_index] = compartment_columns
+            new_columns += compartment_columns
+
+    channel_values = channel_table[new_columns]
+    channel_values.index = get_cell_keys(channel_table)
+    channel_values = channel_values.reindex(get_cell_keys(cell_table))
+    channel_values.index = cell_table.index
+
+    return pd.concat((cell_table, channel_values), axis=1)[columns]
+
+
+def add_channels_to_cell_table(cell_table_size_normalized, cell_table_arcsinh_transformed,
+                               segmentation_labels, tiff_dir, img_sub_folder, channels=None,
+                               is_mibitiff=False, dtype="int16", extraction='total_intensity',
+                               **kwargs):
+    """Quantify the channels which are missing from existing cell tables, and add their columns
 
-    # create the final dfs to store the processed data
-    combined_cell_table_size_normalized = pd.DataFrame()
-    combined_cell_table_arcsinh_transformed = pd.DataFrame()
+    Only the planes of the missing channels are read and extracted, and their columns are
+    matched to the existing rows by fov and label. Passing the `morphology_cache` and
+    `regionprops_features` of the original run reuses its morphology rather than computing it
+    again. Nuclear counts and derived compartments are extracted if the existing tables have
+    them, and the new columns follow the schema of the existing tables, full precision or
+    compact. The `intensity_stats` of the existing tables must be passed for the new channels
+    to get their statistics columns.
 
-    # iterate over all the batches
-    for batch_names, batch_files in zip(
-        [fovs[i:i + batch_size] for i in range(0, cohort_len, batch_size)],
-        [filenames[i:i + batch_size] for i in range(0, cohort_len, batch_size)]
-    ):
-        # and extract the image data for each batch
+    Args:
+        cell_table_size_normalized (pandas.DataFrame):
+            size normalized cell table, as returned by `generate_cell_table`
+        cell_table_arcsinh_transformed (pandas.DataFrame):
+            arcsinh transformed cell table of the same cells
+        segmentation_labels (xarray.DataArray):
+            an xarray with the segmented data of the fovs in the cell tables
+        tiff_dir (str):
+            the name of the directory which contains the single_channel_inputs
+        img_sub_folder (str):
+            the name of the folder where the TIF images are located
+        channels (list):
+            optional channels the cell tables should have, otherwise every channel of the first
+            fov's images. Those already in the cell tables are skipped
+        is_mibitiff (bool):
+            a flag to indicate whether or not the base images are MIBItiffs
+        dtype (str/type):
+            data type of base images
+        extraction (str or dict):
+            extraction function used to compute marker counts, or the extraction function of
+            each channel by channel name, see `compute_marker_counts`
+        **kwargs:
+            arbitrary keyword arguments for `generate_cell_table`
+
+    Returns:
+        tuple (pandas.DataFrame, pandas.DataFrame):
+        - size normalized data, with the new channels
+        - arcsinh transformed data, with the new channels
+
+    Raises:
+        ValueError:
+            Raised if the cell tables have no channel columns to add the new channels after, or
+            don't have the columns of the given `intensity_stats`
+    """
+
+    columns = list(cell_table_size_normalized.columns)
+    existing_channels = columns[columns.index(settings.PRE_CHANNEL_COL) + 1:
+                                columns.index(settings.POST_CHANNEL_COL)]
+
+    if len(existing_channels) == 0:
+        raise ValueError("The cell tables have no channel columns between %s and %s"
+                         % (settings.PRE_CHANNEL_COL, settings.POST_CHANNEL_COL))
+
+    fovs = list(pd.unique(cell_table_size_normalized['fov'].astype(str)))
+    filenames = io_utils.list_files(tiff_dir, substrs=fovs, exact_match=True)
+
+    if channels is None:
         if is_mibitiff:
-            image_data = load_utils.load_imgs_from_mibitiff(data_dir=tiff_dir,
-                                                            mibitiff_files=batch_files,
-                                                            dtype=dtype)
+            channel_tuples, _, _ = tiff_utils.read_mibitiff_header(
+                os.path.join(tiff_dir, filenames[0])
+            )
+            channels = [channel_tuple[1] for channel_tuple in channel_tuples]
         else:
-            image_data = load_utils.load_imgs_from_tree(data_dir=tiff_dir,
-                                                        img_sub_folder=img_sub_folder,
-                                                        fovs=batch_names,
-                                                        dtype=dtype)
-
-        # as well as the labels corresponding to each of them
-        current_labels = segmentation_labels.loc[batch_names, :, :, :]
-
-        # segment the imaging data
-        cell_table_size_normalized, cell_table_arcsinh_transformed = create_marker_count_matrices(
-            segmentation_labels=current_labels,
-            image_data=image_data,
-            extraction=extraction,
-            **kwargs
-        )
-
-        # now append to the final dfs to return
-        combined_cell_table_size_normalized = combined_cell_table_size_normalized.append(
-            cell_table_size_normalized
-        )
-        combined_cell_table_arcsinh_transformed = combined_cell_table_arcsinh_transformed.append(
-            cell_table_arcsinh_transformed
-        )
+            channels = io_utils.list_files(os.path.join(tiff_dir, fovs[0], img_sub_folder or ''),
+                                           substrs=['.tif', '.jpg', '.png'])
+            channels = sorted(io_utils.remove_file_extensions(channels))
+
+    new_channels = [chan for chan in channels if chan not in existing_channels]
+
+    if len(new_channels) == 0:
+        return cell_table_size_normalized, cell_table_arcsinh_transformed
+
+    # quantify the new channels in the compartments the existing ones were
+    compartment_suffixes = [column[len(settings.PRE_CHANNEL_COL):] for column in columns
+                            if column.startswith(settings.PRE_CHANNEL_COL)]
+    derived_compartments = [suffix[1:] for suffix in compartment_suffixes
+                            if suffix not in ['', '_nuclear']]
+
+    # the statistics are kept alongside the morphology, which derived compartments don't have
+    intensity_stats = kwargs.get('intensity_stats')
+    for stat in intensity_stats or []:
+        stat_columns = ['%s_%s%s' % (existing_channels[-1], stat, suffix)
+                        for suffix in compartment_suffixes
+                        if settings.CELL_LABEL + suffix in columns]
+        misc_utils.verify_in_list(intensity_stats_columns=stat_columns, cell_table_columns=columns)
+
+    kwargs['nuclear_counts'] = '_nuclear' in compartment_suffixes
+    kwargs['derived_compartments'] = derived_compartments if derived_compartments else None
+    compact = pd.api.types.is_categorical_dtype(cell_table_size_normalized['fov'])
+
+    new_normalized, new_arcsinh = generate_cell_table(
+        segmentation_labels, tiff_dir, img_sub_folder, is_mibitiff=is_mibitiff, fovs=fovs,
+        dtype=dtype, extraction=extraction, compact=compact, channels=new_channels, **kwargs
+    )
 
-    return combined_cell_table_size_normalized, combined_cell_table_arcsinh_transformed
+    return tuple(
+        _merge_channel_columns(cell_table, new_table, new_channels, compartment_suffixes,
+                               existing_channels[-1], intensity_stats=intensity_stats)
+        for cell_table, new_table in [(cell_table_size_normalized, new_normalized),
+                                      (cell_table_arcsinh_transformed, new_arcsinh)]
+    )
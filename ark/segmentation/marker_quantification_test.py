@@ -1,13 +1,20 @@
 import numpy as np
 import os
+import pandas as pd
 import pytest
+import subprocess
+import sys
 import tempfile
+import textwrap
+from concurrent.futures import ThreadPoolExecutor
+from scipy import ndimage
 
 import skimage.morphology as morph
 from skimage.morphology import erosion
 
-from ark.segmentation import marker_quantification
-from ark.utils import test_utils
+from ark.segmentation import (cell_table_sinks, marker_quantification, morphology_cache,
+                              signal_extraction)
+from ark.utils import segmentation_utils, test_utils
 
 import ark.settings as settings
 
@@ -68,6 +75,590 @@ def test_compute_marker_counts_base():
     )
 
 
+def test_compute_marker_counts_morphology_cache(monkeypatch):
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, cell_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )
+
+    input_images = test_utils.make_images_xarray(channel_data)
+
+    segmentation_labels, input_images = segmentation_labels[0], input_images[0]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = morphology_cache.MorphologyCache(temp_dir)
+
+        # the first run fills the cache, and later runs read from it
+        for extraction in ['total_intensity', 'total_intensity', 'center_weighting']:
+            cached = marker_quantification.compute_marker_counts(
+                input_images=input_images, segmentation_labels=segmentation_labels,
+                nuclear_counts=True, split_large_nuclei=True, extraction=extraction,
+                morphology_cache=cache
+            )
+
+            assert cached.equals(marker_quantification.compute_marker_counts(
+                input_images=input_images, segmentation_labels=segmentation_labels,
+                nuclear_counts=True, split_large_nuclei=True, extraction=extraction
+            ))
+
+        # the same labels are used for both compartments
+        assert len(os.listdir(temp_dir)) == 1
+        assert np.array_equal(cached.loc['whole_cell'].values, cached.loc['nuclear'].values)
+
+        uncached = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True
+        )
+
+        # runs which hit the cache don't index the label images
+        def index_label_image(label_index, label_image):
+            raise AssertionError("The label image was indexed")
+
+        monkeypatch.setattr(segmentation_utils.LabelIndex, '__init__', index_label_image)
+
+        assert uncached.equals(marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, morphology_cache=cache
+        ))
+
+
+def test_compute_marker_counts_label_indices():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    nuc_mask = np.expand_dims(erosion(cell_mask[0, :, :, 0], selem=morph.disk(1)), axis=0)
+    nuc_mask = np.expand_dims(nuc_mask, axis=-1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, nuc_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    label_indices = {
+        compartment: segmentation_utils.LabelIndex(segmentation_labels.loc[:, :, compartment])
+        for compartment in ['whole_cell', 'nuclear']
+    }
+
+    # prebuilt indices give the same result as indices built from the labels
+    for split_large_nuclei in [False, True]:
+        counts = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, split_large_nuclei=split_large_nuclei
+        )
+        counts_index = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, split_large_nuclei=split_large_nuclei,
+            label_indices=label_indices
+        )
+
+        assert counts.equals(counts_index)
+
+
+def test_compute_marker_counts_custom_extraction(monkeypatch):
+    monkeypatch.setattr(signal_extraction, 'extraction_function',
+                        dict(signal_extraction.extraction_function))
+    monkeypatch.setattr(signal_extraction, 'fov_extraction_function',
+                        dict(signal_extraction.fov_extraction_function))
+
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    nuc_mask = np.expand_dims(erosion(cell_mask[0, :, :, 0], selem=morph.disk(1)), axis=0)
+    nuc_mask = np.expand_dims(nuc_mask, axis=-1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, nuc_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            extraction='custom_intensity'
+        )
+
+    # a custom per-cell method gives the same counts as the builtin method it copies
+    signal_extraction.register_extraction('custom_intensity',
+                                          signal_extraction.total_intensity_extraction)
+
+    for extraction in ['total_intensity', 'custom_intensity']:
+        for channel_at_a_time in [False, True]:
+            images = input_images
+            if channel_at_a_time:
+                images = (input_images.loc[:, :, [chan]]
+                          for chan in input_images.channels.values)
+
+            counts = marker_quantification.compute_marker_counts(
+                input_images=images, segmentation_labels=segmentation_labels,
+                nuclear_counts=True, split_large_nuclei=True, extraction=extraction
+            )
+
+            if extraction == 'total_intensity' and not channel_at_a_time:
+                builtin_counts = counts
+            else:
+                assert np.allclose(counts.values, builtin_counts.values)
+
+
+def test_compute_marker_counts_intensity_stats():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    nuc_mask = np.expand_dims(erosion(cell_mask[0, :, :, 0], selem=morph.disk(1)), axis=0)
+    nuc_mask = np.expand_dims(nuc_mask, axis=-1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, nuc_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+    channel_names = input_images.channels.values
+
+    counts = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels, nuclear_counts=True
+    )
+    counts_stats = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels, nuclear_counts=True,
+        intensity_stats=['median', 'p90']
+    )
+
+    # the statistics are added after the other features, which are unchanged
+    stat_names = ['%s_%s' % (chan, stat) for stat in ['median', 'p90'] for chan in channel_names]
+    assert list(counts_stats.features.values) == list(counts.features.values) + stat_names
+    assert counts_stats.loc[:, :, counts.features].equals(counts)
+
+    cell_labels = segmentation_labels.loc[:, :, 'whole_cell'].values
+    for cell_id in counts_stats.cell_id.values:
+        cell_values = input_images.values[cell_labels == cell_id]
+
+        assert np.allclose(counts_stats.loc['whole_cell', cell_id, stat_names[:5]],
+                           np.median(cell_values, axis=0))
+        assert np.allclose(counts_stats.loc['whole_cell', cell_id, stat_names[5:]],
+                           np.percentile(cell_values, 90, axis=0))
+
+    # reading one channel plane at a time gives the same statistics
+    channel_planes = (input_images.loc[:, :, [chan]] for chan in channel_names)
+    counts_planes = marker_quantification.compute_marker_counts(
+        input_images=channel_planes, segmentation_labels=segmentation_labels,
+        nuclear_counts=True, intensity_stats=['median', 'p90']
+    )
+    assert counts_planes.equals(counts_stats)
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            intensity_stats=['max']
+        )
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            intensity_stats=['median']
+        )
+
+    # the statistics are neither size normalized nor arcsinh transformed
+    segmentation_labels = segmentation_labels.expand_dims(fovs=['fov0'])
+    input_images = input_images.expand_dims(fovs=['fov0'])
+    normalized, arcsinh = marker_quantification.create_marker_count_matrices(
+        segmentation_labels, input_images, nuclear_counts=True, intensity_stats=['median']
+    )
+
+    stat_names = ['%s_median' % chan for chan in channel_names]
+    stat_names += [name + '_nuclear' for name in stat_names]
+    assert np.array_equal(normalized[stat_names].values, arcsinh[stat_names].values)
+
+
+def test_compute_marker_counts_channel_extractions():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=cell_mask,
+        compartment_names=['whole_cell']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+    channel_names = input_images.channels.values
+
+    # the channels left out use the default extraction
+    channel_extractions = {channel_names[1]: 'positive_pixel',
+                           channel_names[3]: 'center_weighting'}
+
+    counts = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels,
+        extraction=channel_extractions
+    )
+
+    for extraction, chans in [('total_intensity', channel_names[[0, 2, 4]]),
+                              ('positive_pixel', channel_names[[1]]),
+                              ('center_weighting', channel_names[[3]])]:
+        method_counts = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            extraction=extraction
+        )
+        assert np.allclose(counts.loc[:, :, chans], method_counts.loc[:, :, chans])
+
+    # reading one channel plane at a time gives the same counts
+    channel_planes = (input_images.loc[:, :, [chan]] for chan in channel_names)
+    counts_planes = marker_quantification.compute_marker_counts(
+        input_images=channel_planes, segmentation_labels=segmentation_labels,
+        extraction=channel_extractions
+    )
+    assert counts_planes.equals(counts)
+
+    counts_tiled = marker_quantification.compute_marker_counts_tiled(
+        input_images=input_images, segmentation_labels=segmentation_labels, tile_size=16,
+        extraction={channel_names[1]: 'positive_pixel'}
+    )
+    assert np.allclose(counts_tiled.loc[:, :, channel_names[1]],
+                       counts.loc[:, :, channel_names[1]])
+
+    for bad_extraction in [{channel_names[0]: 'bad_extraction'}, {'bad_chan': 'total_intensity'}]:
+        with pytest.raises(ValueError):
+            marker_quantification.compute_marker_counts(
+                input_images=input_images, segmentation_labels=segmentation_labels,
+                extraction=bad_extraction
+            )
+
+        with pytest.raises(ValueError):
+            marker_quantification.compute_marker_counts_tiled(
+                input_images=input_images, segmentation_labels=segmentation_labels,
+                extraction=bad_extraction
+            )
+
+
+def test_compute_marker_counts_derived_compartments():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    nuc_mask = np.expand_dims(erosion(cell_mask[0, :, :, 0], selem=morph.disk(1)), axis=0)
+    nuc_mask = np.expand_dims(nuc_mask, axis=-1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, nuc_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    counts = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels, nuclear_counts=True,
+        derived_compartments=['cytoplasm', 'membrane2'], intensity_stats=['median']
+    )
+
+    assert list(counts.compartments.values) == ['whole_cell', 'nuclear', 'cytoplasm',
+                                                'membrane2']
+
+    # the derived compartments match extracting from label images of the compartments
+    cell_labels = cell_mask[0, :, :, 0]
+    ring = (ndimage.maximum_filter(cell_labels, 5, mode='constant') != cell_labels) | \
+        (ndimage.minimum_filter(cell_labels, 5, mode='constant') != cell_labels)
+    derived_labels = {'cytoplasm': np.where(nuc_mask[0, :, :, 0] == 0, cell_labels, 0),
+                      'membrane2': np.where(ring, cell_labels, 0)}
+
+    channel_features = counts.features.values[:list(counts.features.values).index('label')]
+    for compartment, labels in derived_labels.items():
+        derived_counts = marker_quantification.compute_marker_counts(
+            input_images=input_images, intensity_stats=['median'],
+            segmentation_labels=test_utils.make_labels_xarray(
+                label_data=labels[np.newaxis, :, :, np.newaxis], compartment_names=['whole_cell']
+            )[0]
+        )
+
+        # every cell keeps a row, with zeros if none of its pixels are in the compartment
+        derived_counts = derived_counts.reindex(cell_id=counts.cell_id, fill_value=0)
+        assert np.array_equal(counts.loc[compartment, :, channel_features],
+                              derived_counts.loc['whole_cell', :, channel_features])
+
+        stat_features = [feature for feature in counts.features.values
+                         if feature.endswith('_median')]
+        assert np.array_equal(counts.loc[compartment, :, stat_features],
+                              derived_counts.loc['whole_cell', :, stat_features])
+
+        # the rest of the morphology is the cell's
+        assert np.array_equal(counts.loc[compartment, :, 'area'],
+                              counts.loc['whole_cell', :, 'area'])
+
+    # reading one channel plane at a time gives the same counts
+    channel_planes = (input_images.loc[:, :, [chan]] for chan in input_images.channels.values)
+    counts_planes = marker_quantification.compute_marker_counts(
+        input_images=channel_planes, segmentation_labels=segmentation_labels,
+        nuclear_counts=True, derived_compartments=['cytoplasm', 'membrane2'],
+        intensity_stats=['median']
+    )
+    assert counts_planes.equals(counts)
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            derived_compartments=['membrane0']
+        )
+
+    # the cytoplasm needs nuclear labels
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels[..., :1],
+            derived_compartments=['cytoplasm']
+        )
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            derived_compartments=['membrane1']
+        )
+
+    # the cell tables get the size and channels of each derived compartment
+    normalized, arcsinh = marker_quantification.create_marker_count_matrices(
+        segmentation_labels.expand_dims(fovs=['fov0']), input_images.expand_dims(fovs=['fov0']),
+        derived_compartments=['cytoplasm', 'membrane2'], compact=True
+    )
+
+    derived_columns = ['%s_%s' % (feature, compartment)
+                       for compartment in ['cytoplasm', 'membrane2']
+                       for feature in ['cell_size'] + list(input_images.channels.values)]
+    assert list(normalized.columns[-len(derived_columns) - 1:]) == derived_columns + ['fov']
+    assert normalized['cell_size_membrane2'].dtype == np.int32
+
+    assert np.array_equal(normalized['cell_size_cytoplasm'],
+                          counts.loc['cytoplasm', :, 'cell_size'])
+    chan = input_images.channels.values[0]
+    cyto_sizes = counts.loc['cytoplasm', :, 'cell_size'].values
+    assert np.allclose(normalized[chan + '_cytoplasm'][cyto_sizes > 0],
+                       (counts.loc['cytoplasm', :, chan] / cyto_sizes)[cyto_sizes > 0])
+
+
+def test_compute_marker_counts_qc_stats():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=cell_mask,
+        compartment_names=['whole_cell']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    counts = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels, qc_stats=True
+    )
+    qc_stats = counts.attrs['qc_stats']
+
+    assert list(qc_stats['channel']) == list(input_images.channels.values)
+
+    cell_labels = cell_mask[0, :, :, 0]
+    total_intensity = input_images.values.sum(axis=(0, 1))
+    cell_intensity = input_images.values[cell_labels > 0].sum(axis=0)
+
+    assert np.allclose(qc_stats['total_intensity'], total_intensity)
+    assert np.allclose(qc_stats['cell_intensity'], cell_intensity)
+    assert np.allclose(qc_stats['background_intensity'], total_intensity - cell_intensity)
+    assert np.allclose(qc_stats['cell_fraction'][total_intensity > 0],
+                       (cell_intensity / total_intensity)[total_intensity > 0])
+
+    cell_sizes = counts.loc['whole_cell', :, 'cell_size'].values
+    assert np.all(qc_stats['cell_count'] == len(cell_sizes))
+    assert np.all(qc_stats['cell_size_median'] == np.median(cell_sizes))
+    assert np.all(qc_stats['cell_size_max'] == np.max(cell_sizes))
+
+    # reading one channel plane at a time gives the same summary
+    channel_planes = (input_images.loc[:, :, [chan]] for chan in input_images.channels.values)
+    counts_planes = marker_quantification.compute_marker_counts(
+        input_images=channel_planes, segmentation_labels=segmentation_labels, qc_stats=True
+    )
+    pd.testing.assert_frame_equal(counts_planes.attrs['qc_stats'], qc_stats)
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels, qc_stats=True
+        )
+
+
+def test_compute_marker_counts_engine(monkeypatch):
+    pytest.importorskip('numba')
+    from ark.segmentation import numba_extraction
+
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    nuc_mask = np.expand_dims(erosion(cell_mask[0, :, :, 0], selem=morph.disk(1)), axis=0)
+    nuc_mask = np.expand_dims(nuc_mask, axis=-1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, nuc_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    # the compiled extraction gives the same counts as numpy
+    for extraction in ['total_intensity', 'center_weighting', 'positive_pixel']:
+        counts = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, split_large_nuclei=True, extraction=extraction
+        )
+        counts_numba = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, split_large_nuclei=True, extraction=extraction,
+            engine='numba'
+        )
+        assert counts.equals(counts_numba)
+
+        tiled_numba = marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels, tile_size=16,
+            nuclear_counts=True, split_large_nuclei=True, extraction=extraction,
+            engine='numba'
+        )
+        assert np.allclose(tiled_numba.values, counts.values)
+
+    # the pixels of each label set are grouped once for all the channel planes
+    group_calls = []
+    group_label_pixels = signal_extraction.group_label_pixels
+
+    def record_group_label_pixels(*args):
+        group_calls.append(args)
+        return group_label_pixels(*args)
+
+    monkeypatch.setattr(signal_extraction, 'group_label_pixels', record_group_label_pixels)
+    monkeypatch.setattr(numba_extraction, 'group_label_pixels', record_group_label_pixels)
+
+    channel_planes = (input_images.loc[:, :, [chan]] for chan in input_images.channels.values)
+    planes_numba = marker_quantification.compute_marker_counts(
+        input_images=channel_planes, segmentation_labels=segmentation_labels,
+        nuclear_counts=True, engine='numba'
+    )
+
+    assert len(group_calls) == 2
+    assert planes_numba.equals(marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels, nuclear_counts=True
+    ))
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            engine='bad_engine'
+        )
+
+
+def test_compute_marker_counts_engine_workers():
+    pytest.importorskip('numba')
+
+    # worker processes started after a numba extraction in the same process must not hang,
+    # which is checked in a fresh interpreter so that a hang fails the test
+    script = textwrap.dedent('''
+        from ark.segmentation import marker_quantification
+        from ark.utils import test_utils
+
+        cell_mask, channel_data = test_utils.create_test_extraction_data()
+        segmentation_labels = test_utils.make_labels_xarray(
+            label_data=cell_mask, compartment_names=['whole_cell'])[0]
+        input_images = test_utils.make_images_xarray(channel_data)[0]
+
+        counts = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            engine='numba')
+        tiled_counts = marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels, tile_size=16,
+            n_workers=2)
+
+        assert abs(tiled_counts.values - counts.values).max() < 1e-6
+    ''')
+
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=300)
+
+
+def test_compute_marker_counts_tiled():
+    cell_mask, _ = test_utils.create_test_extraction_data()
+
+    # tile the sample cells across a larger image, with nuclei which stick out of their cells
+    cell_labels = np.zeros((80, 120), dtype='int16')
+    for i, (row, col) in enumerate([(0, 0), (0, 40), (0, 80), (40, 0), (40, 40), (40, 80)]):
+        cell_labels[row:row + 40, col:col + 40] = np.where(cell_mask[0, :, :, 0] > 0,
+                                                           cell_mask[0, :, :, 0] + 10 * i, 0)
+    nuc_labels = np.roll(erosion(cell_labels, selem=morph.disk(1)), 2, axis=1)
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.stack((cell_labels, nuc_labels), axis=-1)[np.newaxis, ...],
+        compartment_names=['whole_cell', 'nuclear']
+    )[0]
+
+    channel_data = np.random.randint(0, 20, (1, 80, 120, 3)).astype('int16')
+    input_images = test_utils.make_images_xarray(channel_data)[0]
+
+    for extraction in ['total_intensity', 'center_weighting', 'positive_pixel']:
+        whole_image = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, split_large_nuclei=True, extraction=extraction
+        )
+
+        # cells crossing tiles, and cells which don't fit in the halo
+        for tile_size, halo in [(16, 4), (30, 0), (200, 10)]:
+            tiled = marker_quantification.compute_marker_counts_tiled(
+                input_images=input_images, segmentation_labels=segmentation_labels,
+                tile_size=tile_size, halo=halo, nuclear_counts=True, split_large_nuclei=True,
+                extraction=extraction
+            )
+
+            assert np.array_equal(tiled.cell_id.values, whole_image.cell_id.values)
+            assert np.array_equal(tiled.features.values, whole_image.features.values)
+            assert np.allclose(tiled.values, whole_image.values)
+
+    # coordinate features are in the coordinates of the whole image
+    regionprops_features = ['label', 'area', 'bbox', 'centroid', 'major_axis_length']
+    whole_image = marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels,
+        regionprops_features=regionprops_features
+    )
+    tiled = marker_quantification.compute_marker_counts_tiled(
+        input_images=input_images, segmentation_labels=segmentation_labels, tile_size=16,
+        halo=4, regionprops_features=regionprops_features
+    )
+
+    assert 'bbox-3' in tiled.features.values
+    assert np.array_equal(tiled.features.values, whole_image.features.values)
+    assert np.allclose(tiled.values, whole_image.values)
+
+    # tiles can be spread across workers
+    tiled = marker_quantification.compute_marker_counts_tiled(
+        input_images=input_images, segmentation_labels=segmentation_labels, tile_size=32,
+        executor=ThreadPoolExecutor(max_workers=2)
+    )
+    assert np.allclose(tiled.values, marker_quantification.compute_marker_counts(
+        input_images=input_images, segmentation_labels=segmentation_labels).values)
+
+    with pytest.raises(ValueError):
+        marker_quantification.compute_marker_counts_tiled(
+            input_images=input_images, segmentation_labels=segmentation_labels, tile_size=0
+        )
+
+
+def test_compute_marker_counts_channel_planes():
+    cell_mask, channel_data = test_utils.create_test_extraction_data()
+
+    segmentation_labels = test_utils.make_labels_xarray(
+        label_data=np.concatenate((cell_mask, cell_mask), axis=-1),
+        compartment_names=['whole_cell', 'nuclear']
+    )
+
+    input_images = test_utils.make_images_xarray(channel_data)
+
+    segmentation_labels, input_images = segmentation_labels[0], input_images[0]
+
+    for extraction, kwargs in [('total_intensity', {}), ('center_weighting', {}),
+                               ('positive_pixel', {'threshold': np.arange(5)})]:
+        all_channels = marker_quantification.compute_marker_counts(
+            input_images=input_images, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, extraction=extraction, **kwargs
+        )
+
+        # reading one channel plane at a time gives the same result
+        channel_planes = (input_images.loc[:, :, [chan]] for chan in input_images.channels.values)
+        one_channel = marker_quantification.compute_marker_counts(
+            input_images=channel_planes, segmentation_labels=segmentation_labels,
+            nuclear_counts=True, extraction=extraction, **kwargs
+        )
+
+        assert all_channels.equals(one_channel)
+
+
 def test_compute_marker_counts_equal_masks():
     cell_mask, channel_data = test_utils.create_test_extraction_data()
 
@@ -252,6 +843,14 @@ def test_create_marker_count_matrices_base():
     assert np.array_equal(normalized['chan0'], np.repeat(1, len(normalized)))
     assert np.array_equal(normalized['chan1'], np.repeat(5, len(normalized)))
 
+    # fovs submitted to an executor are merged back in fov order
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        normalized_executor, _ = marker_quantification.create_marker_count_matrices(
+            segmentation_labels, channel_data, executor=executor
+        )
+
+    pd.testing.assert_frame_equal(normalized, normalized_executor)
+
     # error checking
     with pytest.raises(ValueError):
         # attempt to pass non-xarray for segmentation_labels
@@ -386,6 +985,33 @@ def test_generate_cell_data_tree_loading():
         assert norm_data.shape[0] > 0 and norm_data.shape[1] > 0
         assert arcsinh_data.shape[0] > 0 and arcsinh_data.shape[1] > 0
 
+        # spreading the fovs across processes gives the same tables in the same order
+        norm_data_parallel, arcsinh_data_parallel = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, n_workers=2)
+
+        pd.testing.assert_frame_equal(norm_data, norm_data_parallel)
+        pd.testing.assert_frame_equal(arcsinh_data, arcsinh_data_parallel)
+
+        # stream the tables to disk instead of returning them
+        sink_dir = os.path.join(temp_dir, "cell_tables")
+        os.mkdir(sink_dir)
+
+        with cell_table_sinks.CSVCellTableSink(sink_dir) as sink:
+            sink_output = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=2,
+                sink=sink)
+
+        assert sink_output is None
+
+        norm_data_sink, arcsinh_data_sink = cell_table_sinks.read_cell_tables(sink_dir)
+
+        pd.testing.assert_frame_equal(norm_data.reset_index(drop=True), norm_data_sink,
+                                      check_dtype=False)
+        pd.testing.assert_frame_equal(arcsinh_data.reset_index(drop=True), arcsinh_data_sink,
+                                      check_dtype=False)
+
         # generate sample norm and arcsinh data for a subset of fovs
         norm_data, arcsinh_data = marker_quantification.generate_cell_table(
             segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
@@ -403,6 +1029,345 @@ def test_generate_cell_data_tree_loading():
         assert arcsinh_data.shape[0] > 0 and arcsinh_data.shape[1] > 0
 
 
+def test_generate_cell_table_checkpoint(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(3, 3)
+
+        tiff_dir = os.path.join(temp_dir, "single_channel_inputs")
+        img_sub_folder = "TIFs"
+
+        os.mkdir(tiff_dir)
+        test_utils.create_paired_xarray_fovs(
+            base_dir=tiff_dir,
+            fov_names=fovs,
+            channel_names=chans,
+            img_shape=(40, 40),
+            sub_dir=img_sub_folder,
+            dtype="int16"
+        )
+
+        cell_mask, _ = test_utils.create_test_extraction_data()
+
+        # fov2 has no cells
+        cell_masks = np.zeros((3, 40, 40, 1), dtype="int16")
+        cell_masks[0, :, :, 0] = cell_mask[0, :, :, 0]
+        cell_masks[1, 5:, 5:, 0] = cell_mask[0, :-5, :-5, 0]
+
+        segmentation_masks = test_utils.make_labels_xarray(
+            label_data=cell_masks,
+            compartment_names=['whole_cell']
+        )
+
+        norm_data, arcsinh_data = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=1)
+
+        checkpoint_dir = os.path.join(temp_dir, "checkpoint")
+        compute_fov_cell_tables = marker_quantification._compute_fov_cell_tables
+        computed_fovs = []
+
+        def crash_on_fov1(fov, *args, **kwargs):
+            if fov == 'fov1':
+                raise RuntimeError("crash")
+            computed_fovs.append(fov)
+            return compute_fov_cell_tables(fov, *args, **kwargs)
+
+        # fovs finished before the crash are kept
+        monkeypatch.setattr(marker_quantification, '_compute_fov_cell_tables', crash_on_fov1)
+        with pytest.raises(RuntimeError):
+            marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=1,
+                checkpoint_dir=checkpoint_dir)
+
+        assert computed_fovs == ['fov0']
+
+        # a rerun with other parameters can't use the checkpoint
+        with pytest.raises(ValueError):
+            marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=1,
+                checkpoint_dir=checkpoint_dir, extraction='center_weighting')
+
+        # resuming only computes the remaining fovs
+        def record_fov(fov, *args, **kwargs):
+            computed_fovs.append(fov)
+            return compute_fov_cell_tables(fov, *args, **kwargs)
+
+        computed_fovs = []
+        monkeypatch.setattr(marker_quantification, '_compute_fov_cell_tables', record_fov)
+        norm_data_resumed, arcsinh_data_resumed = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=2,
+            checkpoint_dir=checkpoint_dir)
+
+        assert computed_fovs == ['fov1', 'fov2']
+
+        pd.testing.assert_frame_equal(norm_data, norm_data_resumed)
+        pd.testing.assert_frame_equal(arcsinh_data, arcsinh_data_resumed)
+
+        # a finished run is read straight from the checkpoint
+        computed_fovs = []
+        norm_data_resumed, _ = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, is_mibitiff=False, fovs=None, batch_size=2,
+            checkpoint_dir=checkpoint_dir)
+
+        assert computed_fovs == []
+        pd.testing.assert_frame_equal(norm_data, norm_data_resumed)
+
+
+def test_generate_cell_table_qc_stats():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(3, 3)
+
+        tiff_dir = os.path.join(temp_dir, "single_channel_inputs")
+        img_sub_folder = "TIFs"
+
+        os.mkdir(tiff_dir)
+        test_utils.create_paired_xarray_fovs(
+            base_dir=tiff_dir,
+            fov_names=fovs,
+            channel_names=chans,
+            img_shape=(40, 40),
+            sub_dir=img_sub_folder,
+            dtype="int16"
+        )
+
+        cell_mask, _ = test_utils.create_test_extraction_data()
+
+        # fov2 has no cells
+        cell_masks = np.zeros((3, 40, 40, 1), dtype="int16")
+        cell_masks[0, :, :, 0] = cell_mask[0, :, :, 0]
+        cell_masks[1, 5:, 5:, 0] = cell_mask[0, :-5, :-5, 0]
+
+        segmentation_masks = test_utils.make_labels_xarray(
+            label_data=cell_masks,
+            compartment_names=['whole_cell']
+        )
+
+        norm_data, arcsinh_data = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, batch_size=2)
+
+        # the cell tables are unchanged, with a summary row for each fov and channel
+        norm_qc, arcsinh_qc, qc_stats = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, batch_size=2, qc_stats=True)
+
+        pd.testing.assert_frame_equal(norm_data, norm_qc)
+        pd.testing.assert_frame_equal(arcsinh_data, arcsinh_qc)
+
+        assert list(qc_stats['fov']) == [fov for fov in fovs for _ in chans]
+        assert list(qc_stats['channel']) == chans * len(fovs)
+
+        fov_cell_counts = [len(np.unique(cell_masks[i][cell_masks[i] > 0])) for i in range(3)]
+        assert list(qc_stats.groupby('fov')['cell_count'].first()) == fov_cell_counts
+        assert np.all(qc_stats.loc[qc_stats['fov'] == 'fov2', 'cell_intensity'] == 0)
+
+        for channel_at_a_time in [False, True]:
+            _, _, qc_stats_planes = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, batch_size=2, qc_stats=True,
+                channel_at_a_time=channel_at_a_time, n_workers=1)
+            pd.testing.assert_frame_equal(qc_stats_planes, qc_stats)
+
+        # the summary is checkpointed with the cell tables
+        checkpoint_dir = os.path.join(temp_dir, "checkpoint")
+        for _ in range(2):
+            checkpoint_tables = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, batch_size=2, qc_stats=True,
+                checkpoint_dir=checkpoint_dir)
+            pd.testing.assert_frame_equal(checkpoint_tables[2], qc_stats)
+
+        # with a sink, only the summary is returned
+        save_dir = os.path.join(temp_dir, "cell_tables")
+        os.mkdir(save_dir)
+        with cell_table_sinks.CSVCellTableSink(save_dir) as sink:
+            sink_qc_stats = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, batch_size=2, qc_stats=True, sink=sink)
+
+        pd.testing.assert_frame_equal(sink_qc_stats, qc_stats)
+
+
+def test_generate_cell_table_compact():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(3, 3)
+
+        tiff_dir = os.path.join(temp_dir, "single_channel_inputs")
+        img_sub_folder = "TIFs"
+
+        os.mkdir(tiff_dir)
+        test_utils.create_paired_xarray_fovs(
+            base_dir=tiff_dir,
+            fov_names=fovs,
+            channel_names=chans,
+            img_shape=(40, 40),
+            sub_dir=img_sub_folder,
+            dtype="int16"
+        )
+
+        cell_mask, _ = test_utils.create_test_extraction_data()
+
+        cell_masks = np.zeros((3, 40, 40, 2), dtype="int16")
+        cell_masks[0, :, :, 0] = cell_mask[0, :, :, 0]
+        cell_masks[1, 5:, 5:, 0] = cell_mask[0, :-5, :-5, 0]
+        cell_masks[2, 10:, 10:, 0] = cell_mask[0, :-10, :-10, 0]
+        cell_masks[..., 1] = cell_masks[..., 0]
+
+        segmentation_masks = test_utils.make_labels_xarray(
+            label_data=cell_masks,
+            compartment_names=['whole_cell', 'nuclear']
+        )
+
+        full_tables = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, fovs=None, batch_size=2, nuclear_counts=True)
+
+        checkpoint_dir = os.path.join(temp_dir, "checkpoint")
+
+        # tables read back from a checkpoint are compacted too
+        for _ in range(2):
+            compact_tables = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, fovs=None, batch_size=2, nuclear_counts=True,
+                checkpoint_dir=checkpoint_dir, compact=True)
+
+            for full_table, compact_table in zip(full_tables, compact_tables):
+                assert list(compact_table.columns) == list(full_table.columns)
+
+                # the fov stays categorical across batches
+                assert pd.api.types.is_categorical_dtype(compact_table['fov'])
+                assert np.array_equal(compact_table['fov'].astype(str), full_table['fov'])
+
+                for column in ['label', 'cell_size', 'label_nuclear', 'cell_size_nuclear']:
+                    assert compact_table[column].dtype == np.int32
+                    assert np.array_equal(compact_table[column], full_table[column])
+
+                float_columns = [column for column in full_table.columns
+                                 if column not in ['fov', 'label', 'cell_size',
+                                                   'label_nuclear', 'cell_size_nuclear']]
+                assert np.all(compact_table[float_columns].dtypes == np.float32)
+                assert np.allclose(compact_table[float_columns], full_table[float_columns],
+                                   rtol=1e-6)
+
+        # the float32 values of a compact checkpoint can't be resumed at full precision
+        with pytest.raises(ValueError):
+            marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, fovs=None, batch_size=2, nuclear_counts=True,
+                checkpoint_dir=checkpoint_dir)
+
+
+def test_add_channels_to_cell_table():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(3, 3)
+
+        tiff_dir = os.path.join(temp_dir, "single_channel_inputs")
+        img_sub_folder = "TIFs"
+
+        os.mkdir(tiff_dir)
+        test_utils.create_paired_xarray_fovs(
+            base_dir=tiff_dir,
+            fov_names=fovs,
+            channel_names=chans,
+            img_shape=(40, 40),
+            sub_dir=img_sub_folder,
+            dtype="int16"
+        )
+
+        cell_mask, _ = test_utils.create_test_extraction_data()
+
+        cell_masks = np.zeros((3, 40, 40, 2), dtype="int16")
+        cell_masks[0, :, :, 0] = cell_mask[0, :, :, 0]
+        cell_masks[1, 5:, 5:, 0] = cell_mask[0, :-5, :-5, 0]
+        cell_masks[2, 10:, 10:, 0] = cell_mask[0, :-10, :-10, 0]
+        cell_masks[..., 1] = cell_masks[..., 0]
+
+        segmentation_masks = test_utils.make_labels_xarray(
+            label_data=cell_masks,
+            compartment_names=['whole_cell', 'nuclear']
+        )
+
+        for compact in [False, True]:
+            full_tables = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, nuclear_counts=True, compact=compact,
+                derived_compartments=['membrane1'])
+
+            # the derived compartments of the existing tables get the new channels too
+            partial_tables = marker_quantification.generate_cell_table(
+                segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, nuclear_counts=True, compact=compact,
+                derived_compartments=['membrane1'], channels=chans[:1])
+
+            assert chans[1] not in partial_tables[0].columns
+
+            # the new channels are matched to the existing rows, whatever their order
+            partial_tables = [table.iloc[::-1] for table in partial_tables]
+
+            added_tables = marker_quantification.add_channels_to_cell_table(
+                *partial_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder)
+
+            for full_table, added_table in zip(full_tables, added_tables):
+                assert added_table.equals(full_table.iloc[::-1])
+
+            # only the given channels are added
+            added_tables = marker_quantification.add_channels_to_cell_table(
+                *partial_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, channels=chans[:2])
+
+            for full_table, added_table in zip(full_tables, added_tables):
+                assert added_table.equals(full_table.iloc[::-1].drop(
+                    columns=[chans[2], chans[2] + '_nuclear', chans[2] + '_membrane1']))
+
+        # nothing is quantified if no channel is missing
+        same_tables = marker_quantification.add_channels_to_cell_table(
+            *full_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder)
+
+        assert same_tables[0] is full_tables[0] and same_tables[1] is full_tables[1]
+
+        # the statistics columns of the new channels follow those of the existing ones
+        stats_tables = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, nuclear_counts=True,
+            derived_compartments=['membrane1'], intensity_stats=['mean', 'p90'])
+
+        partial_tables = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, nuclear_counts=True,
+            derived_compartments=['membrane1'], intensity_stats=['mean', 'p90'],
+            channels=chans[:1])
+
+        added_tables = marker_quantification.add_channels_to_cell_table(
+            *partial_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, intensity_stats=['mean', 'p90'])
+
+        for stats_table, added_table in zip(stats_tables, added_tables):
+            assert added_table.equals(stats_table)
+
+        # the statistics must be in the existing tables
+        with pytest.raises(ValueError):
+            marker_quantification.add_channels_to_cell_table(
+                *partial_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder, intensity_stats=['median'])
+
+        # new channels are placed after the existing ones, so there must be some
+        no_channel_tables = [
+            table.drop(columns=[column for column in table.columns
+                                if column.startswith(tuple(chans))])
+            for table in full_tables
+        ]
+        with pytest.raises(ValueError):
+            marker_quantification.add_channels_to_cell_table(
+                *no_channel_tables, segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+                img_sub_folder=img_sub_folder)
+
+
 def test_generate_cell_data_mibitiff_loading():
     # is_mibitiff True case, load from mibitiff file structure
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -464,6 +1429,15 @@ def test_generate_cell_data_mibitiff_loading():
         assert norm_data.shape[0] > 0 and norm_data.shape[1] > 0
         assert arcsinh_data.shape[0] > 0 and arcsinh_data.shape[1] > 0
 
+        # reading one MIBItiff page at a time gives the same tables
+        channel_norm_data, channel_arcsinh_data = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=tiff_dir, is_mibitiff=True, fovs=fovs_subset_ext, batch_size=2,
+            channel_at_a_time=True)
+
+        pd.testing.assert_frame_equal(norm_data, channel_norm_data)
+        pd.testing.assert_frame_equal(arcsinh_data, channel_arcsinh_data)
+
 
 def test_generate_cell_data_extractions():
     with tempfile.TemporaryDirectory() as temp_dir:
@@ -521,3 +1495,12 @@ def test_generate_cell_data_extractions():
 
         assert np.all(positive_pixel_data.iloc[:4][['chan0', 'chan1']].values == 0)
         assert np.all(positive_pixel_data.iloc[4:][chans].values == 1)
+
+        # reading one channel at a time gives the same tables
+        channel_norm_data, _ = marker_quantification.generate_cell_table(
+            segmentation_labels=segmentation_masks, tiff_dir=tiff_dir,
+            img_sub_folder=img_sub_folder, is_mibitiff=False, batch_size=2,
+            channel_at_a_time=True
+        )
+
+        pd.testing.assert_frame_equal(default_norm_data, channel_norm_data)
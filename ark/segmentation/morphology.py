@@ -0,0 +1,180 @@
+import numpy as np
+from skimage import measure
+
+from ark.utils import segmentation_utils
+
+
+# features computed for every label at once, any other feature is computed by regionprops
+VECTORIZED_PROPERTIES = ['label', 'area', 'bbox', 'bbox_area', 'centroid', 'eccentricity',
+                         'major_axis_length', 'minor_axis_length', 'perimeter']
+
+# weights of each border pixel configuration in skimage's perimeter, with 4-connectivity
+_PERIMETER_WEIGHTS = np.zeros(50)
+_PERIMETER_WEIGHTS[[5, 7, 15, 17, 25, 27]] = 1
+_PERIMETER_WEIGHTS[[21, 33]] = np.sqrt(2)
+_PERIMETER_WEIGHTS[[13, 23]] = (1 + np.sqrt(2)) / 2
+
+
+def _get_label_perimeters(label_image, label_ids):
+    """Compute the perimeter of every label like `skimage.measure.perimeter`, by classifying the
+    border pixels of all labels at once
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of labels
+        label_ids (numpy.ndarray):
+            sorted nonzero labels of label_image
+
+    Returns:
+        numpy.ndarray:
+            perimeter of each label, ordered as label_ids
+    """
+
+    padded = np.pad(label_image, 1, mode='constant')
+
+    # border pixels have a 4-connected neighbor with another label
+    labels = padded[1:-1, 1:-1]
+    border = labels > 0
+    border &= ((padded[:-2, 1:-1] != labels) | (padded[2:, 1:-1] != labels) |
+               (padded[1:-1, :-2] != labels) | (padded[1:-1, 2:] != labels))
+
+    border_rows, border_cols = np.nonzero(border)
+    border_labels = labels[border_rows, border_cols]
+    padded_border = np.pad(border, 1, mode='constant')
+
+    # the configuration of each border pixel is the weighted count of the border pixels of the
+    # same label around it, 2 for each edge neighbor and 10 for each corner neighbor
+    configurations = np.ones(len(border_rows), dtype='int64')
+    for row_offset in [-1, 0, 1]:
+        for col_offset in [-1, 0, 1]:
+            if row_offset == 0 and col_offset == 0:
+                continue
+
+            rows, cols = border_rows + 1 + row_offset, border_cols + 1 + col_offset
+            same_border = (padded[rows, cols] == border_labels) & padded_border[rows, cols]
+            configurations += same_border * (10 if row_offset and col_offset else 2)
+
+    # weigh the histogram of configurations of each label, as skimage does
+    positions = np.searchsorted(label_ids, border_labels)
+    histograms = np.bincount(positions * len(_PERIMETER_WEIGHTS) + configurations,
+                             minlength=len(label_ids) * len(_PERIMETER_WEIGHTS))
+
+    return histograms.reshape(len(label_ids), -1) @ _PERIMETER_WEIGHTS
+
+
+def _get_vectorized_properties(label_image, properties, label_index):
+    """Compute the vectorized regionprops features of every label
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of labels
+        properties (list):
+            features to compute, all in VECTORIZED_PROPERTIES
+        label_index (ark.utils.segmentation_utils.LabelIndex):
+            index of label_image
+
+    Returns:
+        dict:
+            the columns of each feature, named like regionprops_table names them
+    """
+
+    label_ids, label_sizes = label_index.label_ids, label_index.label_sizes
+    starts = label_index.indptr[:-1]
+
+    if len(label_ids) == 0:
+        return measure.regionprops_table(label_image, properties=properties)
+
+    rows, cols = np.divmod(label_index.pixel_indices, label_image.shape[1])
+    owners = np.repeat(np.arange(len(label_ids)), label_sizes)
+
+    columns = {}
+
+    if 'bbox' in properties or 'bbox_area' in properties:
+        # reduceat works on the runs of pixels of each label, which are never empty
+        min_rows, min_cols = np.minimum.reduceat(rows, starts), np.minimum.reduceat(cols, starts)
+        max_rows = np.maximum.reduceat(rows, starts) + 1
+        max_cols = np.maximum.reduceat(cols, starts) + 1
+
+        for i, bound in enumerate([min_rows, min_cols, max_rows, max_cols]):
+            columns['bbox-%d' % i] = bound
+
+        columns['bbox_area'] = (max_rows - min_rows) * (max_cols - min_cols)
+
+    centroid_rows = np.add.reduceat(rows, starts) / label_sizes
+    centroid_cols = np.add.reduceat(cols, starts) / label_sizes
+    columns['centroid-0'], columns['centroid-1'] = centroid_rows, centroid_cols
+
+    if any(prop in properties
+           for prop in ['eccentricity', 'major_axis_length', 'minor_axis_length']):
+        # second order central moments of each label, normalized by its area
+        row_dists = rows - centroid_rows[owners]
+        col_dists = cols - centroid_cols[owners]
+        row_var = np.add.reduceat(row_dists ** 2, starts) / label_sizes
+        col_var = np.add.reduceat(col_dists ** 2, starts) / label_sizes
+        covar = np.add.reduceat(row_dists * col_dists, starts) / label_sizes
+
+        # the inertia tensor has the same eigenvalues as the covariance matrix in 2D
+        mean_var = (row_var + col_var) / 2
+        spread = np.sqrt(((row_var - col_var) / 2) ** 2 + covar ** 2)
+        major_eigvals = np.clip(mean_var + spread, 0, None)
+        minor_eigvals = np.clip(mean_var - spread, 0, None)
+
+        columns['major_axis_length'] = 4 * np.sqrt(major_eigvals)
+        columns['minor_axis_length'] = 4 * np.sqrt(minor_eigvals)
+        columns['eccentricity'] = np.sqrt(
+            1 - np.divide(minor_eigvals, major_eigvals, out=np.ones(len(label_ids)),
+                          where=major_eigvals > 0)
+        )
+
+    if 'perimeter' in properties:
+        columns['perimeter'] = _get_label_perimeters(label_image, label_ids)
+
+    columns['label'] = label_ids
+    columns['area'] = label_sizes
+
+    return columns
+
+
+def regionprops_table(label_image, properties, label_index=None):
+    """Compute the morphology of every label, like `skimage.measure.regionprops_table`
+
+    The features in VECTORIZED_PROPERTIES are computed for all labels at once from the pixels of
+    each label in the label index, any other feature is computed by regionprops.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of labels
+        properties (list):
+            morphology features to compute for each label
+        label_index (ark.utils.segmentation_utils.LabelIndex):
+            optional prebuilt index of label_image
+
+    Returns:
+        dict:
+            the columns of each feature, named and ordered like regionprops_table returns them,
+            with one row per label sorted by label
+    """
+
+    label_image = np.asarray(label_image)
+
+    if label_index is None:
+        label_index = segmentation_utils.LabelIndex(label_image)
+
+    vectorized_properties = [prop for prop in properties if prop in VECTORIZED_PROPERTIES]
+    other_properties = [prop for prop in properties if prop not in VECTORIZED_PROPERTIES]
+
+    columns = _get_vectorized_properties(label_image, vectorized_properties, label_index)
+
+    if len(other_properties) > 0:
+        # regionprops returns its rows sorted by label too
+        columns.update(measure.regionprops_table(label_image,
+                                                 properties=['label'] + other_properties))
+
+    # put the columns of each feature in the requested order, features with several values
+    # have a column for each, suffixed by the index of the value
+    table = {}
+    for prop in properties:
+        table.update((name, values) for name, values in columns.items()
+                     if name == prop or name.startswith(prop + '-'))
+
+    return table
@@ -0,0 +1,183 @@
+import collections
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from ark.utils import io_utils
+
+
+# bump whenever the contents of the cached entries change, so that stale entries are never read
+CACHE_FORMAT_VERSION = 1
+
+# the per-label morphology of one label image, as used by marker quantification
+LabelMorphology = collections.namedtuple(
+    'LabelMorphology', ['label_ids', 'label_sizes', 'props', 'pixel_indices', 'positions']
+)
+
+
+class MorphologyCache(object):
+    """On-disk cache of the morphology of label images, so that quantifying the same
+    segmentation again (e.g. with another extraction method or threshold) skips regionprops.
+
+    Entries are keyed by a hash of the label image contents and the requested regionprops
+    features, and hold the label ids and sizes, the regionprops table, and the flat pixel
+    indices of each label. When the cache grows past max_size, the least recently used entries
+    are removed.
+
+    The cache only holds its directory and size budget, so it can be sent to worker processes,
+    which can share the same directory.
+
+    Args:
+        cache_dir (str):
+            directory to store the cache entries in, created if it doesn't exist
+        max_size (int):
+            size budget of the cache in bytes
+    """
+
+    def __init__(self, cache_dir, max_size=2 ** 30):
+        if max_size <= 0:
+            raise ValueError("Invalid value for max_size: must be positive")
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    @staticmethod
+    def get_key(label_image, regionprops_features):
+        """Hash a label image and the regionprops features computed for it
+
+        Args:
+            label_image (numpy.ndarray):
+                rows x columns matrix of labels
+            regionprops_features (list):
+                morphology features extracted by regionprops
+
+        Returns:
+            str:
+                hex digest identifying the cache entry
+        """
+
+        label_image = np.ascontiguousarray(label_image)
+
+        key_hash = hashlib.sha1()
+        key_hash.update(repr((CACHE_FORMAT_VERSION, label_image.shape, label_image.dtype.str,
+                              list(regionprops_features))).encode('utf-8'))
+        key_hash.update(label_image.data)
+
+        return key_hash.hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, label_image, regionprops_features):
+        """Look up the morphology of a label image
+
+        Args:
+            label_image (numpy.ndarray):
+                rows x columns matrix of labels
+            regionprops_features (list):
+                morphology features extracted by regionprops
+
+        Returns:
+            LabelMorphology or None:
+                the cached morphology, or None if it isn't in the cache
+        """
+
+        path = self._get_path(self.get_key(label_image, regionprops_features))
+
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                prop_names = entry['prop_names']
+                props = pd.DataFrame({
+                    name: entry['prop_%d' % i] for i, name in enumerate(prop_names)
+                }, columns=prop_names)
+
+                morphology = LabelMorphology(
+                    label_ids=entry['label_ids'], label_sizes=entry['label_sizes'], props=props,
+                    pixel_indices=entry['pixel_indices'], positions=entry['positions']
+                )
+
+            # mark the entry as recently used
+            os.utime(path)
+        except (OSError, KeyError, ValueError):
+            # missing, evicted by another process in the meantime, or unreadable
+            return None
+
+        return morphology
+
+    def put(self, label_image, regionprops_features, morphology):
+        """Store the morphology of a label image, evicting old entries if needed
+
+        Args:
+            label_image (numpy.ndarray):
+                rows x columns matrix of labels
+            regionprops_features (list):
+                morphology features extracted by regionprops
+            morphology (LabelMorphology):
+                morphology of label_image
+        """
+
+        path = self._get_path(self.get_key(label_image, regionprops_features))
+
+        entry = {
+            'label_ids': morphology.label_ids,
+            'label_sizes': morphology.label_sizes,
+            'pixel_indices': morphology.pixel_indices,
+            'positions': morphology.positions,
+            'prop_names': np.array(morphology.props.columns, dtype=str)
+        }
+        for i, name in enumerate(morphology.props.columns):
+            entry['prop_%d' % i] = morphology.props[name].values
+
+        # write to a temporary file first, so readers never see a partial entry
+        def write_entry(tmp_path):
+            with open(tmp_path, 'wb') as tmp_file:
+                np.savez(tmp_file, **entry)
+
+        io_utils.write_atomic(path, write_entry)
+
+        self._evict(keep=path)
+
+    def _evict(self, keep=None):
+        """Remove the least recently used entries until the cache fits in max_size
+
+        Args:
+            keep (str):
+                path of an entry which is never removed, e.g. the one just written
+        """
+
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            if not entry_name.endswith('.npz'):
+                continue
+
+            entry_path = os.path.join(self.cache_dir, entry_name)
+            try:
+                entry_stat = os.stat(entry_path)
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_path))
+
+        cache_size = sum(entry_size for _, entry_size, _ in entries)
+
+        for _, entry_size, entry_path in sorted(entries):
+            if cache_size <= self.max_size:
+                break
+            if entry_path == keep:
+                continue
+
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            cache_size -= entry_size
+
+    def clear(self):
+        """Remove every entry from the cache"""
+
+        for entry_name in os.listdir(self.cache_dir):
+            if entry_name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, entry_name))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ark.segmentation import morphology_cache
+
+
+def _make_morphology(num_labels):
+    label_ids = np.arange(1, num_labels + 1)
+
+    return morphology_cache.LabelMorphology(
+        label_ids=label_ids, label_sizes=label_ids * 2,
+        props=pd.DataFrame({'label': label_ids, 'area': label_ids * 2.0}),
+        pixel_indices=np.arange(num_labels * 3), positions=np.repeat(label_ids - 1, 3)
+    )
+
+
+def test_morphology_cache():
+    label_image = np.zeros((20, 20), dtype='int32')
+    label_image[:5, :5] = 1
+    label_image[10:15, 10:15] = 2
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with pytest.raises(ValueError):
+            morphology_cache.MorphologyCache(temp_dir, max_size=0)
+
+        cache = morphology_cache.MorphologyCache(os.path.join(temp_dir, 'cache'))
+        features = ['label', 'area']
+
+        assert cache.get(label_image, features) is None
+
+        morphology = _make_morphology(2)
+        cache.put(label_image, features, morphology)
+
+        cached = cache.get(label_image, features)
+        for field in ['label_ids', 'label_sizes', 'pixel_indices', 'positions']:
+            assert np.array_equal(getattr(cached, field), getattr(morphology, field))
+        pd.testing.assert_frame_equal(cached.props, morphology.props)
+
+        # other features, dtypes or label contents are separate entries
+        assert cache.get(label_image, ['label', 'area', 'perimeter']) is None
+        assert cache.get(label_image.astype('int64'), features) is None
+        label_image[0, 0] = 0
+        assert cache.get(label_image, features) is None
+
+        cache.clear()
+        assert len(os.listdir(os.path.join(temp_dir, 'cache'))) == 0
+
+
+def test_morphology_cache_eviction():
+    label_images = [np.full((10, 10), i, dtype='int32') for i in range(4)]
+    features = ['label', 'area']
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache = morphology_cache.MorphologyCache(temp_dir)
+
+        cache.put(label_images[0], features, _make_morphology(100))
+        entry_size = sum(os.path.getsize(os.path.join(temp_dir, entry))
+                         for entry in os.listdir(temp_dir))
+
+        # room for two entries
+        cache.max_size = entry_size * 2 + entry_size // 2
+        cache.put(label_images[1], features, _make_morphology(100))
+
+        # backdate the entries so that the access order is unambiguous
+        for i, entry in enumerate(sorted(os.listdir(temp_dir),
+                                         key=lambda e: os.path.getmtime(
+                                             os.path.join(temp_dir, e)))):
+            os.utime(os.path.join(temp_dir, entry), (i, i))
+
+        # using the first entry makes the second one the least recently used
+        assert cache.get(label_images[0], features) is not None
+
+        cache.put(label_images[2], features, _make_morphology(100))
+
+        assert len(os.listdir(temp_dir)) == 2
+        assert cache.get(label_images[0], features) is not None
+        assert cache.get(label_images[1], features) is None
+        assert cache.get(label_images[2], features) is not None
@@ -0,0 +1,41 @@
+import numpy as np
+from skimage.measure import label, regionprops_table
+
+from ark.segmentation import morphology
+from ark.utils import segmentation_utils
+
+
+def test_regionprops_table():
+    rng = np.random.default_rng(0)
+
+    # scattered labels, connected components, and a single line of pixels
+    label_images = [
+        np.where(rng.random((60, 50)) < 0.3, 0, rng.integers(0, 6, (60, 50))),
+        label(rng.random((60, 50)) > 0.5),
+        np.zeros((10, 10), dtype='int16')
+    ]
+    label_images[2][2:5, 3] = 7
+
+    properties = ['label', 'area', 'eccentricity', 'major_axis_length', 'minor_axis_length',
+                  'perimeter', 'centroid', 'bbox', 'bbox_area', 'solidity', 'moments_hu']
+
+    for label_image in label_images:
+        expected = regionprops_table(label_image, properties=properties)
+
+        for label_index in [None, segmentation_utils.LabelIndex(label_image)]:
+            table = morphology.regionprops_table(label_image, properties,
+                                                 label_index=label_index)
+
+            assert list(table.keys()) == list(expected.keys())
+            for name in expected:
+                assert np.allclose(table[name], expected[name])
+
+    # the columns follow the order of the features
+    table = morphology.regionprops_table(label_images[0], ['centroid', 'solidity', 'label'])
+    assert list(table.keys()) == ['centroid-0', 'centroid-1', 'solidity', 'label']
+
+    # images without any labels give empty columns
+    table = morphology.regionprops_table(np.zeros((5, 5), dtype='int16'),
+                                         ['label', 'area', 'perimeter', 'centroid'])
+    assert list(table.keys()) == ['label', 'area', 'perimeter', 'centroid-0', 'centroid-1']
+    assert all(len(values) == 0 for values in table.values())
@@ -0,0 +1,172 @@
+import numba
+import numpy as np
+
+from ark.segmentation.signal_extraction import group_label_pixels, _get_channel_matrix
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _positive_pixels_kernel(channel_matrix, pixel_indices, indptr, thresholds):
+    counts = np.zeros((len(indptr) - 1, channel_matrix.shape[1]))
+
+    for cell in numba.prange(len(indptr) - 1):
+        for pixel in pixel_indices[indptr[cell]:indptr[cell + 1]]:
+            for chan in range(channel_matrix.shape[1]):
+                if channel_matrix[pixel, chan] > thresholds[chan]:
+                    counts[cell, chan] += 1
+
+    return counts
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _center_weighting_kernel(channel_matrix, pixel_indices, indptr, num_cols, centroids,
+                             max_distances, compute_max_distances):
+    counts = np.zeros((len(indptr) - 1, channel_matrix.shape[1]))
+
+    for cell in numba.prange(len(indptr) - 1):
+        cell_pixels = pixel_indices[indptr[cell]:indptr[cell + 1]]
+
+        # compute the distance box-level from the cell's center outward
+        distances = np.empty(len(cell_pixels))
+        for i in range(len(cell_pixels)):
+            distances[i] = max(abs(cell_pixels[i] // num_cols - centroids[cell, 0]),
+                               abs(cell_pixels[i] % num_cols - centroids[cell, 1]))
+
+        max_distance = max_distances[cell]
+        if compute_max_distances:
+            max_distance = 0.0
+            for i in range(len(cell_pixels)):
+                max_distance = max(max_distance, distances[i])
+
+        for i in range(len(cell_pixels)):
+            weight = 1 - (distances[i] / (max_distance + 1))
+            for chan in range(channel_matrix.shape[1]):
+                counts[cell, chan] += weight * channel_matrix[cell_pixels[i], chan]
+
+    return counts
+
+
+@numba.njit(parallel=True, nogil=True, cache=True)
+def _total_intensity_kernel(channel_matrix, pixel_indices, indptr):
+    counts = np.zeros((len(indptr) - 1, channel_matrix.shape[1]))
+
+    for cell in numba.prange(len(indptr) - 1):
+        for pixel in pixel_indices[indptr[cell]:indptr[cell + 1]]:
+            for chan in range(channel_matrix.shape[1]):
+                counts[cell, chan] += channel_matrix[pixel, chan]
+
+    return counts
+
+
+def _get_cell_pixels(label_image, cell_ids, kwargs):
+    """Get the pixels of each cell grouped together, so each cell can be processed independently
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        kwargs (dict):
+            keyword arguments of the extraction, the pixels are only grouped if they don't hold
+            the `label_pixels` grouped once for every channel
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - flat indices of the pixels of every cell, ordered by cell
+        - offsets into the above of the first pixel of each cell, followed by the pixel count
+    """
+
+    label_pixels = kwargs.get('label_pixels')
+    if label_pixels is not None:
+        return label_pixels
+
+    return group_label_pixels(label_image, cell_ids, kwargs.get('label_positions'))
+
+
+def positive_pixels_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Compiled equivalent of `signal_extraction.positive_pixels_fov_extraction`
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, as for the numpy engine
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, indptr = _get_cell_pixels(label_image, cell_ids, kwargs)
+    channel_matrix = _get_channel_matrix(image_data)
+
+    thresholds = np.broadcast_to(kwargs.get('threshold', 0), (channel_matrix.shape[1],))
+
+    return _positive_pixels_kernel(channel_matrix, pixel_indices, indptr,
+                                   np.ascontiguousarray(thresholds))
+
+
+def center_weighting_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Compiled equivalent of `signal_extraction.center_weighting_fov_extraction`
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, as for the numpy engine
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, indptr = _get_cell_pixels(label_image, cell_ids, kwargs)
+    channel_matrix = _get_channel_matrix(image_data)
+
+    centroids = np.reshape(kwargs.get('centroid'), (len(cell_ids), 2)).astype('float64')
+
+    max_distances = kwargs.get('max_distance')
+    compute_max_distances = max_distances is None
+    if compute_max_distances:
+        max_distances = np.zeros(len(cell_ids))
+
+    return _center_weighting_kernel(channel_matrix, pixel_indices, indptr, label_image.shape[1],
+                                    centroids, np.asarray(max_distances, dtype='float64'),
+                                    compute_max_distances)
+
+
+def total_intensity_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Compiled equivalent of `signal_extraction.total_intensity_fov_extraction`
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, as for the numpy engine
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, indptr = _get_cell_pixels(label_image, cell_ids, kwargs)
+
+    return _total_intensity_kernel(_get_channel_matrix(image_data), pixel_indices, indptr)
+
+
+fov_extraction_function = {
+    'positive_pixel': positive_pixels_fov_extraction,
+    'center_weighting': center_weighting_fov_extraction,
+    'total_intensity': total_intensity_fov_extraction,
+}
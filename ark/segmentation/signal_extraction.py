@@ -1,5 +1,10 @@
+import functools
+import warnings
+
 import numpy as np
 
+from ark.utils.misc_utils import verify_in_list
+
 
 def positive_pixels_extraction(cell_coords, image_data, **kwargs):
     """Extract channel counts by summing over the number of non-zero pixels in the cell.
@@ -78,8 +83,566 @@ def total_intensity_extraction(cell_coords, image_data, **kwargs):
     return channel_counts
 
 
+def get_label_positions(label_image, cell_ids, label_positions=None):
+    """Map each pixel belonging to one of cell_ids to the index of its cell in cell_ids
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        label_positions (tuple):
+            previously computed positions of the same labels, e.g. from a morphology cache,
+            which are returned as is
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - flat indices of the pixels belonging to one of cell_ids
+        - index into cell_ids of the cell each of these pixels belongs to
+    """
+
+    if label_positions is not None:
+        return label_positions
+
+    if len(cell_ids) == 0:
+        return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+
+    flat_labels = label_image.ravel()
+
+    # find the position each label would have in cell_ids, and keep the ones that match
+    positions = np.searchsorted(cell_ids, flat_labels)
+    positions[positions == len(cell_ids)] = 0
+    pixel_indices = np.flatnonzero(cell_ids[positions] == flat_labels)
+
+    return pixel_indices, positions[pixel_indices]
+
+
+def group_label_pixels(label_image, cell_ids, label_positions=None):
+    """Group the pixels of each cell together, so the pixels of each cell can be processed in
+    turn, as the compiled fov extraction functions do
+
+    The grouping doesn't depend on the channels, so it can be computed once for a label image
+    and passed to the extraction of each channel as `label_pixels`.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        label_positions (tuple):
+            precomputed output of `get_label_positions`, if available
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - flat indices of the pixels of every cell, ordered by cell and in row major order
+          within each cell
+        - offsets into the above of the first pixel of each cell, followed by the pixel count
+    """
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids, label_positions)
+
+    # the sort is stable, so every cell's pixels are summed in the same order as numpy does
+    order = np.argsort(positions, kind='stable')
+
+    indptr = np.zeros(len(cell_ids) + 1, dtype='int64')
+    np.cumsum(np.bincount(positions, minlength=len(cell_ids)), out=indptr[1:])
+
+    return pixel_indices[order].astype('int64', copy=False), indptr
+
+
+def _get_channel_matrix(image_data):
+    """Flatten rows x columns x channels image data into a pixels x channels matrix
+
+    Args:
+        image_data (xarray.DataArray or numpy.ndarray):
+            rows x columns x channels matrix of imaging data
+
+    Returns:
+        numpy.ndarray:
+            pixels x channels view of the imaging data
+    """
+
+    image_values = getattr(image_data, 'values', image_data)
+
+    return image_values.reshape(-1, image_values.shape[-1])
+
+
+def positive_pixels_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Extract channel counts for every cell in a fov by summing over the number of pixels
+    above threshold in each cell.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, `label_positions` can hold the precomputed
+            output of `get_label_positions`
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids,
+                                                   kwargs.get('label_positions'))
+    channel_matrix = _get_channel_matrix(image_data)
+
+    # broadcast the threshold so each channel can have its own
+    thresholds = np.broadcast_to(kwargs.get('threshold', 0), (channel_matrix.shape[1],))
+
+    channel_counts = np.zeros((len(cell_ids), channel_matrix.shape[1]))
+    for chan, thresh in enumerate(thresholds):
+        channel_counts[:, chan] = np.bincount(
+            positions, weights=channel_matrix[pixel_indices, chan] > thresh,
+            minlength=len(cell_ids)
+        )
+
+    return channel_counts
+
+
+def center_weighting_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Extract channel counts for every cell in a fov by summing over weighted expression values
+    based on distance from each cell's center.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, `centroid` must be a cells x 2 array ordered as cell_ids
+            and `label_positions` can hold the precomputed output of `get_label_positions`.
+            `max_distance` can give the largest distance of each cell's pixels from its center,
+            when these aren't all in label_image
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids,
+                                                   kwargs.get('label_positions'))
+    channel_matrix = _get_channel_matrix(image_data)
+
+    # compute the distance box-level from each cell's center outward
+    centroids = np.reshape(kwargs.get('centroid'), (len(cell_ids), 2))
+    pixel_rows, pixel_cols = np.unravel_index(pixel_indices, label_image.shape)
+    weights = np.maximum(np.abs(pixel_rows - centroids[positions, 0]),
+                         np.abs(pixel_cols - centroids[positions, 1]))
+
+    # center the weights around the middle value of each cell, whose pixels may not all be in
+    # label_image when quantifying a tile of a larger image
+    max_weights = kwargs.get('max_distance')
+    if max_weights is None:
+        max_weights = np.zeros(len(cell_ids))
+        np.maximum.at(max_weights, positions, weights)
+    weights = 1 - (weights / (max_weights[positions] + 1))
+
+    channel_counts = np.zeros((len(cell_ids), channel_matrix.shape[1]))
+    for chan in range(channel_matrix.shape[1]):
+        channel_counts[:, chan] = np.bincount(
+            positions, weights=weights * channel_matrix[pixel_indices, chan],
+            minlength=len(cell_ids)
+        )
+
+    return channel_counts
+
+
+def total_intensity_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+    """Extract channel counts for every cell in a fov via basic summation for each channel
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        **kwargs:
+            arbitrary keyword arguments, `label_positions` can hold the precomputed
+            output of `get_label_positions`
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids,
+                                                   kwargs.get('label_positions'))
+    channel_matrix = _get_channel_matrix(image_data)
+
+    # sum every channel over the pixels of each cell at once
+    channel_counts = np.zeros((len(cell_ids), channel_matrix.shape[1]))
+    for chan in range(channel_matrix.shape[1]):
+        channel_counts[:, chan] = np.bincount(
+            positions, weights=channel_matrix[pixel_indices, chan], minlength=len(cell_ids)
+        )
+
+    return channel_counts
+
+
+def get_intensity_stat_percentile(stat):
+    """Validate a per-cell intensity statistic, and get its percentile if it has one
+
+    Args:
+        stat (str):
+            one of INTENSITY_STATS, or 'p' followed by a percentile between 0 and 100, e.g. 'p90'
+
+    Returns:
+        float or None:
+            the percentile of the statistic, 50 for the median and None for the others
+
+    Raises:
+        ValueError:
+            Raised if stat isn't a valid statistic
+    """
+
+    if stat == 'median':
+        return 50.0
+
+    if stat in INTENSITY_STATS:
+        return None
+
+    try:
+        percentile = float(stat[1:]) if stat.startswith('p') else None
+    except ValueError:
+        percentile = None
+
+    if percentile is None or not 0 <= percentile <= 100:
+        raise ValueError("Invalid intensity statistic %s: must be one of %s, or 'p' followed by "
+                         "a percentile between 0 and 100" % (stat, INTENSITY_STATS))
+
+    return percentile
+
+
+def intensity_stats_fov_extraction(label_image, image_data, cell_ids, stats, **kwargs):
+    """Compute statistics of the pixel values of every cell in a fov, for each channel
+
+    Every statistic is computed from a single sort of each channel's values by cell and value.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        stats (list):
+            the statistics to compute, from INTENSITY_STATS or 'p' followed by a percentile
+        **kwargs:
+            arbitrary keyword arguments, `label_positions` can hold the precomputed
+            output of `get_label_positions`
+
+    Returns:
+        numpy.ndarray:
+            stats x cells x channels matrix of the statistics of each cell in cell_ids, 0 for
+            cells without any pixels
+    """
+
+    percentiles = [get_intensity_stat_percentile(stat) for stat in stats]
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids,
+                                                   kwargs.get('label_positions'))
+    channel_matrix = _get_channel_matrix(image_data)
+
+    cell_sizes = np.bincount(positions, minlength=len(cell_ids))
+    has_pixels = cell_sizes > 0
+    cell_starts = np.cumsum(cell_sizes) - cell_sizes
+
+    cell_stats = np.zeros((len(stats), len(cell_ids), channel_matrix.shape[1]))
+    for chan in range(channel_matrix.shape[1]):
+        values = channel_matrix[pixel_indices, chan].astype('float64')
+
+        means = np.divide(np.bincount(positions, weights=values, minlength=len(cell_ids)),
+                          cell_sizes, out=np.zeros(len(cell_ids)), where=has_pixels)
+
+        # group the values by cell, sorted within each cell
+        sorted_values = None
+        if any(percentile is not None for percentile in percentiles):
+            sorted_values = values[np.lexsort((values, positions))]
+
+        for stat_index, (stat, percentile) in enumerate(zip(stats, percentiles)):
+            if stat == 'mean':
+                cell_stat = means
+            elif stat == 'var':
+                cell_stat = np.divide(
+                    np.bincount(positions, weights=(values - means[positions]) ** 2,
+                                minlength=len(cell_ids)),
+                    cell_sizes, out=np.zeros(len(cell_ids)), where=has_pixels
+                )
+            else:
+                # interpolate linearly between the closest ranks, as numpy.percentile does
+                ranks = percentile / 100 * np.maximum(cell_sizes - 1, 0)
+                lower_ranks = np.floor(ranks).astype('int64')
+                upper_ranks = np.minimum(lower_ranks + 1, np.maximum(cell_sizes - 1, 0))
+
+                lower = sorted_values[(cell_starts + lower_ranks)[has_pixels]]
+                upper = sorted_values[(cell_starts + upper_ranks)[has_pixels]]
+
+                cell_stat = np.zeros(len(cell_ids))
+                cell_stat[has_pixels] = lower + (upper - lower) * (ranks - lower_ranks)[has_pixels]
+
+            cell_stats[stat_index, :, chan] = cell_stat
+
+    return cell_stats
+
+
+def _cell_by_cell_fov_extraction(label_image, image_data, cell_ids, extraction_func=None,
+                                 **kwargs):
+    """Run a per-cell extraction function over every cell in a fov, for extraction methods
+    without a whole-fov form
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        extraction_func (function):
+            per-cell extraction function, taking the coords of a cell, the imaging data and
+            keyword arguments
+        **kwargs:
+            arbitrary keyword arguments, `centroid` must be a cells x 2 array ordered as cell_ids
+            and `label_positions` can hold the precomputed output of `get_label_positions`
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    pixel_indices, positions = get_label_positions(label_image, cell_ids,
+                                                   kwargs.pop('label_positions', None))
+
+    # group the pixels of each cell together, in the order a scan of the image finds them
+    order = np.argsort(positions, kind='stable')
+    cell_coords = np.stack(np.unravel_index(pixel_indices[order], label_image.shape), axis=1)
+    cell_bounds = np.searchsorted(positions[order], np.arange(len(cell_ids) + 1))
+
+    centroids = kwargs.pop('centroid', None)
+    if centroids is not None:
+        centroids = np.reshape(centroids, (len(cell_ids), 2))
+
+    # the per-cell functions see every pixel of their cell, so have no use for max_distance
+    kwargs.pop('max_distance', None)
+
+    channel_counts = np.zeros((len(cell_ids), image_data.shape[-1]))
+    for cell in range(len(cell_ids)):
+        # cells can be missing from label_image when quantifying a tile of a larger image
+        if cell_bounds[cell] == cell_bounds[cell + 1]:
+            continue
+
+        if centroids is not None:
+            kwargs['centroid'] = centroids[cell:cell + 1]
+
+        channel_counts[cell] = extraction_func(
+            cell_coords[cell_bounds[cell]:cell_bounds[cell + 1]], image_data, **kwargs
+        )
+
+    return channel_counts
+
+
+def _per_channel_fov_extraction(label_image, image_data, cell_ids, channel_extractions=None,
+                                engine='numpy', **kwargs):
+    """Extract the channel counts of every cell in a fov, with each channel's own extraction
+    method
+
+    The pixels of the cells are found once and shared by every method, which each run on the
+    consecutive channels they were chosen for.
+
+    Args:
+        label_image (numpy.ndarray):
+            rows x columns matrix of cell labels
+        image_data (xarray.DataArray):
+            rows x columns x channels matrix of imaging data
+        cell_ids (numpy.ndarray):
+            sorted array of the cell labels to extract
+        channel_extractions (dict):
+            extraction method of each channel, the channels which aren't in it use
+            DEFAULT_EXTRACTION
+        engine (str):
+            engine running the extraction functions
+        **kwargs:
+            arbitrary keyword arguments, a channel specific `threshold` is matched to the
+            channels of each method
+
+    Returns:
+        numpy.ndarray:
+            cells x channels matrix of counts for each cell in cell_ids
+    """
+
+    methods = [channel_extractions.get(chan, DEFAULT_EXTRACTION)
+               for chan in image_data.channels.values]
+
+    kwargs['label_positions'] = get_label_positions(label_image, cell_ids,
+                                                    kwargs.get('label_positions'))
+
+    # the compiled methods all go through the pixels of each cell in turn
+    if engine == 'numba' and kwargs.get('label_pixels') is None:
+        kwargs['label_pixels'] = group_label_pixels(label_image, cell_ids,
+                                                    kwargs['label_positions'])
+
+    channel_counts = np.zeros((len(cell_ids), len(methods)))
+
+    run_start = 0
+    for run_end in range(1, len(methods) + 1):
+        if run_end < len(methods) and methods[run_end] == methods[run_start]:
+            continue
+
+        run_kwargs = dict(kwargs)
+        if np.ndim(kwargs.get('threshold', 0)) > 0:
+            run_kwargs['threshold'] = np.asarray(kwargs['threshold'])[run_start:run_end]
+
+        # slicing a run of channels gives a view of the image data
+        channel_counts[:, run_start:run_end] = get_fov_extraction_function(
+            methods[run_start], engine
+        )(label_image, image_data[..., run_start:run_end], cell_ids, **run_kwargs)
+
+        run_start = run_end
+
+    return channel_counts
+
+
 extraction_function = {
     'positive_pixel': positive_pixels_extraction,
     'center_weighting': center_weighting_extraction,
     'total_intensity': total_intensity_extraction,
 }
+
+# whole-fov counterparts of extraction_function, computing every cell at once
+fov_extraction_function = {
+    'positive_pixel': positive_pixels_fov_extraction,
+    'center_weighting': center_weighting_fov_extraction,
+    'total_intensity': total_intensity_fov_extraction,
+}
+
+
+def register_extraction(name, extraction_func=None, fov_extraction_func=None):
+    """Register a custom extraction method, usable as the `extraction` of the marker
+    quantification functions
+
+    A method registered with only a per-cell function is run cell by cell, a whole-fov function
+    computes every cell at once and is used whenever one is registered. Methods registered after
+    a process pool is started are only seen by its workers if the pool forks them.
+
+    When quantifying tiles of a larger image, the counts of each part of a cell are added up, so
+    methods have to be additive over the pixels of a cell to be used there.
+
+    Args:
+        name (str):
+            name of the extraction method
+        extraction_func (function):
+            per-cell extraction function, taking the (pixels x 2) coords of one cell, the
+            rows x columns x channels imaging data and keyword arguments, among them the
+            1 x 2 `centroid` of the cell. Returns the counts of each channel
+        fov_extraction_func (function):
+            whole-fov extraction function, taking the label image, the rows x columns x channels
+            imaging data, the sorted ids of the cells to extract and keyword arguments, among
+            them the cells x 2 `centroid` array and the precomputed `label_positions` (see
+            `get_label_positions`). Returns a cells x channels matrix of counts
+
+    Raises:
+        ValueError:
+            Raised if neither function is given
+    """
+
+    if extraction_func is None and fov_extraction_func is None:
+        raise ValueError("Either extraction_func or fov_extraction_func must be given")
+
+    extraction_function.pop(name, None)
+    fov_extraction_function.pop(name, None)
+
+    if extraction_func is not None:
+        extraction_function[name] = extraction_func
+
+    if fov_extraction_func is not None:
+        fov_extraction_function[name] = fov_extraction_func
+
+
+def get_extraction_methods():
+    """List the names of every registered extraction method
+
+    Returns:
+        list:
+            the extraction methods, whether registered per-cell, whole-fov or both
+    """
+
+    return list(extraction_function.keys()) + [
+        name for name in fov_extraction_function.keys() if name not in extraction_function
+    ]
+
+
+# extraction method of the channels which aren't given one
+DEFAULT_EXTRACTION = 'total_intensity'
+
+# per-cell statistics of the pixel values, besides percentiles given as e.g. 'p90'
+INTENSITY_STATS = ['mean', 'median', 'var']
+
+# engines the fov extraction functions can run on, numba compiles them and runs cells in parallel
+EXTRACTION_ENGINES = ['numpy', 'numba']
+
+
+def verify_extraction(extraction):
+    """Check that an extraction method, or each channel's extraction method, is registered
+
+    Args:
+        extraction (str or dict):
+            extraction method, or the extraction method of each channel by channel name
+
+    Raises:
+        ValueError:
+            Raised if any extraction method isn't registered
+    """
+
+    extraction_methods = extraction.values() if isinstance(extraction, dict) else [extraction]
+
+    for method in extraction_methods:
+        verify_in_list(extraction=method, extraction_options=get_extraction_methods())
+
+
+def get_fov_extraction_function(extraction, engine='numpy'):
+    """Look up the whole-fov extraction function of an extraction method for an engine
+
+    Methods without a whole-fov function run their per-cell function on each cell in turn.
+    The numba engine requires the optional `numba` package, without it the numpy engine is used
+    instead, with a warning. Custom methods always run on the numpy engine.
+
+    Args:
+        extraction (str or dict):
+            extraction method, one of `get_extraction_methods()`, or the extraction method of
+            each channel by channel name. Channels missing from it use DEFAULT_EXTRACTION
+        engine (str):
+            either 'numpy' or 'numba'
+
+    Returns:
+        function:
+            the fov extraction function
+    """
+
+    verify_extraction(extraction)
+    verify_in_list(engine=engine, engine_options=EXTRACTION_ENGINES)
+
+    if isinstance(extraction, dict):
+        return functools.partial(_per_channel_fov_extraction, channel_extractions=extraction,
+                                 engine=engine)
+
+    if extraction not in fov_extraction_function:
+        return functools.partial(_cell_by_cell_fov_extraction,
+                                 extraction_func=extraction_function[extraction])
+
+    if engine == 'numba':
+        try:
+            from ark.segmentation import numba_extraction
+        except ImportError:
+            warnings.warn("numba is not installed, falling back to the numpy engine")
+        else:
+            if extraction in numba_extraction.fov_extraction_function:
+                return numba_extraction.fov_extraction_function[extraction]
+
+    return fov_extraction_function[extraction]
@@ -1,4 +1,7 @@
+import sys
+
 import numpy as np
+import pytest
 import xarray as xr
 
 from ark.segmentation import signal_extraction
@@ -194,3 +197,282 @@ def test_total_intensity_extraction():
     # test signal counts for different channels
     assert np.all(channel_counts_1 == [250, 0])
     assert np.all(channel_counts_2 == [0, 2360])
+
+
+def test_fov_extractions():
+    # generate sample segmentation mask and channel data
+    sample_segmentation_mask, sample_channel_data = \
+        synthetic_spatial_datagen.generate_two_cell_chan_data(
+            size_img=(1024, 1024),
+            cell_radius=10,
+            nuc_radius=3,
+            memb_thickness=5,
+            nuc_signal_strength=10,
+            memb_signal_strength=100,
+            nuc_uncertainty_length=1,
+            memb_uncertainty_length=1
+        )
+
+    sample_segmentation_mask = sample_segmentation_mask.astype(np.int16)
+    image_data = xr.DataArray(sample_channel_data)
+
+    region_info = regionprops(sample_segmentation_mask)
+    cell_ids = np.array([region.label for region in region_info])
+    centroids = np.array([region.centroid for region in region_info])
+
+    kwarg_list = [{}, {'threshold': 10}, {'threshold': np.array([0, 10])}, {}]
+    extraction_list = ['total_intensity', 'positive_pixel', 'positive_pixel', 'center_weighting']
+
+    for extraction, kwargs in zip(extraction_list, kwarg_list):
+        fov_counts = signal_extraction.fov_extraction_function[extraction](
+            label_image=sample_segmentation_mask,
+            image_data=image_data,
+            cell_ids=cell_ids,
+            centroid=centroids,
+            **kwargs
+        )
+
+        assert fov_counts.shape == (len(cell_ids), image_data.shape[-1])
+
+        # the whole fov extraction matches the per cell extraction for every cell
+        for idx, region in enumerate(region_info):
+            cell_counts = signal_extraction.extraction_function[extraction](
+                cell_coords=region.coords,
+                image_data=image_data,
+                centroid=centroids[idx:idx + 1],
+                **kwargs
+            )
+
+            assert np.allclose(fov_counts[idx], cell_counts)
+
+    # cells missing from the label image get zero counts
+    fov_counts = signal_extraction.total_intensity_fov_extraction(
+        label_image=sample_segmentation_mask,
+        image_data=image_data,
+        cell_ids=np.array([1, 2, 7])
+    )
+
+    assert np.all(fov_counts[2] == 0)
+
+    # fovs without any cells give an empty matrix
+    fov_counts = signal_extraction.total_intensity_fov_extraction(
+        label_image=np.zeros_like(sample_segmentation_mask),
+        image_data=image_data,
+        cell_ids=np.array([], dtype='int')
+    )
+
+    assert fov_counts.shape == (0, image_data.shape[-1])
+
+
+def test_get_fov_extraction_function(monkeypatch):
+    rng = np.random.default_rng(0)
+
+    # random labels, so cells are scattered in pieces across the image
+    label_image = rng.integers(0, 40, (64, 48))
+    image_data = xr.DataArray(rng.integers(0, 20, (64, 48, 3)).astype('uint16'))
+    cell_ids = np.unique(label_image[label_image > 0])
+    centroids = rng.uniform(0, 48, (len(cell_ids), 2))
+
+    kwarg_list = [{}, {'threshold': 10}, {'threshold': np.array([0, 10, 5])}, {},
+                  {'max_distance': np.full(len(cell_ids), 80.0)}]
+    extraction_list = ['total_intensity', 'positive_pixel', 'positive_pixel', 'center_weighting',
+                       'center_weighting']
+
+    with pytest.raises(ValueError):
+        signal_extraction.get_fov_extraction_function('total_intensity', engine='bad_engine')
+
+    with pytest.raises(ValueError):
+        signal_extraction.get_fov_extraction_function('bad_extraction')
+
+    for extraction, kwargs in zip(extraction_list, kwarg_list):
+        numpy_func = signal_extraction.get_fov_extraction_function(extraction)
+        assert numpy_func is signal_extraction.fov_extraction_function[extraction]
+
+        numpy_counts = numpy_func(label_image, image_data, cell_ids, centroid=centroids,
+                                  **kwargs)
+
+        # without numba, the numpy functions are used instead
+        with monkeypatch.context() as m:
+            m.setitem(sys.modules, 'numba', None)
+            m.setitem(sys.modules, 'ark.segmentation.numba_extraction', None)
+            m.delattr('ark.segmentation.numba_extraction', raising=False)
+
+            with pytest.warns(UserWarning):
+                fallback_func = signal_extraction.get_fov_extraction_function(extraction,
+                                                                              engine='numba')
+            assert fallback_func is numpy_func
+
+        pytest.importorskip('numba')
+
+        numba_func = signal_extraction.get_fov_extraction_function(extraction, engine='numba')
+
+        # the compiled extraction sums each cell in the same order, whether the pixels come from
+        # a scan of the image or grouped by cell
+        for label_positions in [None, signal_extraction.get_label_positions(label_image,
+                                                                            cell_ids)]:
+            numba_counts = numba_func(label_image, image_data, cell_ids, centroid=centroids,
+                                      label_positions=label_positions, **kwargs)
+            assert np.array_equal(numba_counts, numpy_counts)
+
+        order = np.argsort(label_image.ravel(), kind='stable')
+        order = order[label_image.ravel()[order] > 0]
+        numba_counts = numba_func(
+            label_image, image_data, cell_ids, centroid=centroids,
+            label_positions=(order, np.searchsorted(cell_ids, label_image.ravel()[order])),
+            **kwargs
+        )
+        assert np.array_equal(numba_counts, numpy_counts)
+
+        # the pixels can be grouped once and shared by the extraction of every channel
+        numba_counts = numba_func(
+            label_image, image_data, cell_ids, centroid=centroids,
+            label_pixels=signal_extraction.group_label_pixels(label_image, cell_ids), **kwargs
+        )
+        assert np.array_equal(numba_counts, numpy_counts)
+
+
+def test_register_extraction(monkeypatch):
+    monkeypatch.setattr(signal_extraction, 'extraction_function',
+                        dict(signal_extraction.extraction_function))
+    monkeypatch.setattr(signal_extraction, 'fov_extraction_function',
+                        dict(signal_extraction.fov_extraction_function))
+
+    rng = np.random.default_rng(0)
+
+    label_image = rng.integers(0, 40, (64, 48))
+    image_data = xr.DataArray(rng.integers(0, 20, (64, 48, 3)).astype('uint16'))
+    cell_ids = np.append(np.unique(label_image[label_image > 0]), 50)
+    centroids = rng.uniform(0, 48, (len(cell_ids), 2))
+
+    def max_intensity_extraction(cell_coords, image_data, **kwargs):
+        return np.max(image_data.values[tuple(cell_coords.T)], axis=0)
+
+    def max_intensity_fov_extraction(label_image, image_data, cell_ids, **kwargs):
+        return np.zeros((len(cell_ids), image_data.shape[-1]))
+
+    with pytest.raises(ValueError):
+        signal_extraction.register_extraction('max_intensity')
+
+    # a method registered per-cell is run on each cell in turn
+    signal_extraction.register_extraction('max_intensity', max_intensity_extraction)
+    assert 'max_intensity' in signal_extraction.get_extraction_methods()
+
+    for engine in ['numpy', 'numba']:
+        extraction_func = signal_extraction.get_fov_extraction_function('max_intensity',
+                                                                        engine=engine)
+        counts = extraction_func(label_image, image_data, cell_ids, centroid=centroids)
+
+        assert counts.shape == (len(cell_ids), image_data.shape[-1])
+        for idx, cell_id in enumerate(cell_ids[:-1]):
+            assert np.array_equal(counts[idx],
+                                  np.max(image_data.values[label_image == cell_id], axis=0))
+
+        # cells missing from the label image get zero counts
+        assert np.all(counts[-1] == 0)
+
+    # the per-cell functions get the centroid of their own cell
+    centroid_counts = signal_extraction.get_fov_extraction_function('center_weighting')(
+        label_image, image_data, cell_ids[:-1], centroid=centroids[:-1]
+    )
+    signal_extraction.register_extraction(
+        'cell_center_weighting', signal_extraction.center_weighting_extraction
+    )
+    assert np.allclose(
+        signal_extraction.get_fov_extraction_function('cell_center_weighting')(
+            label_image, image_data, cell_ids[:-1], centroid=centroids[:-1]
+        ),
+        centroid_counts
+    )
+
+    # the whole-fov function is used whenever one is registered
+    signal_extraction.register_extraction('max_intensity', max_intensity_extraction,
+                                          max_intensity_fov_extraction)
+    assert signal_extraction.get_fov_extraction_function('max_intensity') is \
+        max_intensity_fov_extraction
+
+    signal_extraction.register_extraction('fov_max_intensity',
+                                          fov_extraction_func=max_intensity_fov_extraction)
+    assert 'fov_max_intensity' in signal_extraction.get_extraction_methods()
+    assert 'fov_max_intensity' not in signal_extraction.extraction_function
+
+    # registering a method again replaces both of its forms
+    signal_extraction.register_extraction('max_intensity', max_intensity_extraction)
+    assert 'max_intensity' not in signal_extraction.fov_extraction_function
+
+
+def test_per_channel_fov_extraction():
+    rng = np.random.default_rng(0)
+
+    label_image = rng.integers(0, 40, (64, 48))
+    channels = ['chan0', 'chan1', 'chan2', 'chan3']
+    image_data = xr.DataArray(rng.integers(0, 20, (64, 48, 4)).astype('uint16'),
+                              coords=[range(64), range(48), channels],
+                              dims=['rows', 'cols', 'channels'])
+    cell_ids = np.unique(label_image[label_image > 0])
+    threshold = np.array([0, 10, 5, 15])
+
+    # unlisted channels use the default extraction
+    channel_extractions = {'chan1': 'positive_pixel', 'chan2': 'positive_pixel'}
+
+    with pytest.raises(ValueError):
+        signal_extraction.get_fov_extraction_function({'chan1': 'bad_extraction'})
+
+    extraction_func = signal_extraction.get_fov_extraction_function(channel_extractions)
+    counts = extraction_func(label_image, image_data, cell_ids, threshold=threshold)
+
+    total_counts = signal_extraction.get_fov_extraction_function('total_intensity')(
+        label_image, image_data, cell_ids
+    )
+    positive_counts = signal_extraction.get_fov_extraction_function('positive_pixel')(
+        label_image, image_data, cell_ids, threshold=threshold
+    )
+
+    assert np.array_equal(counts[:, [0, 3]], total_counts[:, [0, 3]])
+    assert np.array_equal(counts[:, [1, 2]], positive_counts[:, [1, 2]])
+
+    # a single method for every channel gives the same counts as that method
+    extraction_func = signal_extraction.get_fov_extraction_function(
+        dict.fromkeys(channels, 'positive_pixel')
+    )
+    assert np.array_equal(
+        extraction_func(label_image, image_data, cell_ids, threshold=threshold), positive_counts
+    )
+
+
+def test_intensity_stats_fov_extraction():
+    rng = np.random.default_rng(0)
+
+    label_image = rng.integers(0, 40, (64, 48))
+    image_data = xr.DataArray(rng.integers(0, 20, (64, 48, 3)).astype('uint16'))
+    cell_ids = np.append(np.unique(label_image[label_image > 0]), 50)
+
+    stats = ['mean', 'median', 'var', 'p90', 'p0', 'p100', 'p12.5']
+    stat_funcs = [
+        np.mean, np.median, np.var, lambda values, axis: np.percentile(values, 90, axis=axis),
+        np.min, np.max, lambda values, axis: np.percentile(values, 12.5, axis=axis)
+    ]
+
+    for label_positions in [None, signal_extraction.get_label_positions(label_image, cell_ids)]:
+        cell_stats = signal_extraction.intensity_stats_fov_extraction(
+            label_image, image_data, cell_ids, stats, label_positions=label_positions
+        )
+
+        assert cell_stats.shape == (len(stats), len(cell_ids), image_data.shape[-1])
+
+        for stat_func, stat_values in zip(stat_funcs, cell_stats):
+            for cell_id, cell_values in zip(cell_ids[:-1], stat_values):
+                assert np.allclose(
+                    cell_values, stat_func(image_data.values[label_image == cell_id], axis=0)
+                )
+
+        # cells missing from the label image get zero statistics
+        assert np.all(cell_stats[:, -1] == 0)
+
+    assert signal_extraction.get_intensity_stat_percentile('median') == 50
+    assert signal_extraction.get_intensity_stat_percentile('p99.5') == 99.5
+    assert signal_extraction.get_intensity_stat_percentile('var') is None
+
+    for bad_stat in ['max', 'p', 'p101', 'pbad']:
+        with pytest.raises(ValueError):
+            signal_extraction.intensity_stats_fov_extraction(label_image, image_data, cell_ids,
+                                                             ['mean', bad_stat])
@@ -6,6 +6,7 @@ import xarray as xr
 
 from ark import settings
 from ark.utils.misc_utils import verify_in_list
+from ark.utils.segmentation_utils import LabelIndex
 
 
 def label_cells_by_cluster(fovs, all_data, label_maps, fov_col=settings.FOV_ID,
@@ -51,7 +52,7 @@ def label_cells_by_cluster(fovs, all_data, label_maps, fov_col=settings.FOV_ID,
                         dims=["fovs", "rows", "cols"])
 
 
-def relabel_segmentation(labeled_image, labels_dict):
+def relabel_segmentation(labeled_image, labels_dict, label_index=None):
     """Takes a labeled image and translates its labels according to a dictionary.
 
     Returns the relabeled array (according to the dictionary).
@@ -61,18 +62,25 @@ def relabel_segmentation(labeled_image, labels_dict):
             2D numpy array of labeled cell objects.
         labels_dict (dict):
             a mapping between labeled cells and their clusters.
+        label_index (ark.utils.segmentation_utils.LabelIndex):
+            optional prebuilt index of labeled_image
     Returns:
         numpy.ndarray:
             The relabeled array.
     """
 
+    if label_index is None:
+        label_index = LabelIndex(labeled_image)
+
     img = np.copy(labeled_image)
-    unique_cell_ids = np.unique(labeled_image)
-    unique_cell_ids = unique_cell_ids[np.nonzero(unique_cell_ids)]
 
     default_label = max(labels_dict.values()) + 1
-    for cell_id in unique_cell_ids:
-        img[labeled_image == cell_id] = labels_dict.get(cell_id, default_label)
+    new_labels = [labels_dict.get(cell_id, default_label) for cell_id in label_index.label_ids]
+
+    # write every cell's new label at once, through the index of its pixels
+    img.reshape(-1)[label_index.pixel_indices] = np.repeat(
+        np.array(new_labels, dtype=img.dtype), label_index.label_sizes
+    )
     return img
 
 
@@ -6,7 +6,7 @@ import pytest
 import pandas as pd
 import xarray as xr
 
-from ark.utils import data_utils, test_utils
+from ark.utils import data_utils, segmentation_utils, test_utils
 import skimage.io as io
 
 from ark.utils.data_utils import relabel_segmentation, label_cells_by_cluster
@@ -165,6 +165,13 @@ def test_relabel_segmentation():
 
     assert np.array_equal(img_arr * 10, res)
 
+    # a prebuilt index of the labels gives the same result, and background stays 0
+    img_arr[0, 0] = 0
+    label_index = segmentation_utils.LabelIndex(img_arr)
+    res = relabel_segmentation(img_arr, d, label_index=label_index)
+
+    assert np.array_equal(img_arr * 10, res)
+
 
 def test_label_cells_by_cluster():
     fovs = ['fov1', 'fov2', 'fov3']
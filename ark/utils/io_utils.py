@@ -1,5 +1,6 @@
 import os
 import pathlib
+import tempfile
 import warnings
 
 
@@ -200,3 +201,25 @@ def list_folders(dir_name, substrs=None):
                ])]
 
     return matches
+
+
+def write_atomic(path, write_func):
+    """Write a file through a temporary file in the same directory, so that the file at path is
+    either complete or missing, even if writing is interrupted
+
+    Args:
+        path (str):
+            path of the file to write
+        write_func (function):
+            function writing the file contents to the path it is given
+    """
+
+    tmp_fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    os.close(tmp_fd)
+
+    try:
+        write_func(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -177,3 +177,32 @@ def test_list_folders():
         # test substrs is list
         get_test_and_other = iou.list_folders(temp_dir, substrs=['test_', 'other'])
         assert get_test_and_other.sort() == dirnames[1:].sort()
+
+
+def test_write_atomic():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'test.txt')
+
+        def write_text(text):
+            def write_func(tmp_path):
+                with open(tmp_path, 'w') as tmp_file:
+                    tmp_file.write(text)
+            return write_func
+
+        iou.write_atomic(path, write_text('first'))
+        iou.write_atomic(path, write_text('second'))
+
+        with open(path, 'r') as test_file:
+            assert test_file.read() == 'second'
+
+        # an interrupted write leaves the existing file and no temporary file
+        def fail_write(tmp_path):
+            write_text('partial')(tmp_path)
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            iou.write_atomic(path, fail_write)
+
+        with open(path, 'r') as test_file:
+            assert test_file.read() == 'second'
+        assert os.listdir(temp_dir) == ['test.txt']
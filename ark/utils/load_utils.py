@@ -1,16 +1,267 @@
 import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import skimage.io as io
 import numpy as np
+import pandas as pd
 import xarray as xr
+from xarray.backends.common import BackendArray
+from xarray.core import indexing
 
-from ark.utils.tiff_utils import read_mibitiff
+from ark.utils.tiff_utils import (iter_mibitiff, read_mibitiff_header,
+                                  read_mibitiff_into, read_tiff, read_tiff_header)
 from ark.utils import io_utils as iou
 
+try:
+    from xarray.core.indexing import LazilyIndexedArray
+except ImportError:
+    # older versions of xarray
+    from xarray.core.indexing import LazilyOuterIndexedArray as LazilyIndexedArray
+
+
+def _read_img(path):
+    """Read an image file
+
+    Args:
+        path (str):
+            path of the image
+
+    Returns:
+        numpy.ndarray:
+            the image
+    """
+
+    # tiffs are read like their headers describe them
+    if _is_tiff(path):
+        return read_tiff(path)
+    return io.imread(path)
+
+
+def _is_tiff(path):
+    return path.lower().endswith(('.tif', '.tiff'))
+
+
+def _read_img_header(path):
+    """Read the shape, dtype and pages of an image file
+
+    Only the headers of tiffs are read, other images are decoded to find their shape.
+
+    Args:
+        path (str):
+            path of the image
+
+    Returns:
+        dict:
+            the `shape` and `dtype` of the image, its number of pages `n_pages`, and the
+            `channel_tuples` of its pages if it's a MIBItiff, otherwise None
+    """
+
+    if _is_tiff(path):
+        return read_tiff_header(path)
+
+    img = io.imread(path)
+    return {'shape': img.shape, 'dtype': img.dtype, 'n_pages': 1, 'channel_tuples': None}
+
+
+def _run_threaded(func, tasks, n_threads=None):
+    """Call func on each task, spreading the calls across threads
+
+    Image decoding and file I/O mostly release the GIL, so reading files in threads overlaps
+    both the storage latency and the decompression of each file.
+
+    Args:
+        func (function):
+            function called with the arguments of each task
+        tasks (list):
+            tuples of arguments of each call
+        n_threads (int):
+            number of threads to spread the calls across, if None calls are made serially
+    """
+
+    if n_threads is None or n_threads <= 1:
+        for task in tasks:
+            func(*task)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = [executor.submit(func, *task) for task in tasks]
+
+        # raise the error of the first failing task, in task order
+        for future in futures:
+            future.result()
+
+
+def _check_overflow(img):
+    """Check that the dtype an image was converted to wasn't too small for the range of its data
+
+    Args:
+        img (numpy.ndarray):
+            the converted image
+
+    Raises:
+        ValueError:
+            Raised if the image has negative values
+    """
+
+    if img.size > 0 and np.min(img) < 0:
+        raise ValueError("Integer overflow from loading TIF image, try a larger dtype")
+
+
+class _LazyImageArray(BackendArray):
+    """Images of a cohort, only decoding the blocks of the fovs and channels that are indexed
+
+    Wrapped in an xarray.DataArray, selecting fovs and channels stays lazy, and accessing the
+    values of the selection only reads the images it covers.
+
+    Args:
+        read_block (function):
+            called with a rows x cols x channels array, the index of a fov and an array of the
+            indices of the channels, fills the array with the images of those channels of the fov
+        shape (tuple):
+            fovs x rows x cols x channels shape of the cohort
+        dtype (str/type):
+            dtype of the images
+        n_threads (int):
+            number of threads reading blocks at once. If None, blocks are read one at a time
+        split_channels (bool):
+            whether each channel of a fov is read as a block of its own, otherwise all the
+            indexed channels of a fov are read as one block
+    """
+
+    def __init__(self, read_block, shape, dtype, n_threads=None, split_channels=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        self._read_block = read_block
+        self._n_threads = n_threads
+        self._split_channels = split_channels
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(key, self.shape,
+                                                  indexing.IndexingSupport.OUTER, self._getitem)
+
+    def _getitem(self, key):
+        # each dimension is indexed by an integer, a slice or an array of integers
+        fov_indices, row_indices, col_indices, channel_indices = [
+            np.atleast_1d(np.arange(size)[dim_key]) for size, dim_key in zip(self.shape, key)
+        ]
+
+        img_data = np.zeros((len(fov_indices), len(row_indices), len(col_indices),
+                             len(channel_indices)), dtype=self.dtype)
+
+        # whole images are decoded straight into their place
+        whole_imgs = (np.array_equal(row_indices, np.arange(self.shape[1]))
+                      and np.array_equal(col_indices, np.arange(self.shape[2])))
+
+        def read_block(index, fov, block_channels):
+            if whole_imgs:
+                self._read_block(img_data[index, :, :, block_channels], fov,
+                                 channel_indices[block_channels])
+                return
+
+            block = np.zeros(self.shape[1:3] + (len(channel_indices[block_channels]),),
+                             dtype=self.dtype)
+            self._read_block(block, fov, channel_indices[block_channels])
+            img_data[index, :, :, block_channels] = block[row_indices][:, col_indices]
+
+        if self._split_channels:
+            block_channels = [slice(i, i + 1) for i in range(len(channel_indices))]
+        else:
+            block_channels = [slice(None)]
+
+        _run_threaded(read_block,
+                      [(index, fov, channel_slice) for index, fov in enumerate(fov_indices)
+                       for channel_slice in block_channels],
+                      n_threads=self._n_threads)
+
+        # integer indices drop their dimension
+        return img_data[tuple(0 if isinstance(dim_key, (int, np.integer)) else slice(None)
+                              for dim_key in key)]
+
+
+def _make_image_xarray(read_block, shape, dtype, coords, dims, lazy=False, n_threads=None,
+                       split_channels=False):
+    """Read the images of a cohort into an xarray, or wrap them in a lazy one
+
+    Args:
+        read_block (function):
+            called with a rows x cols x channels array, the index of a fov and an array of the
+            indices of the channels, fills the array with the images of those channels of the fov
+        shape (tuple):
+            fovs x rows x cols x channels shape of the cohort
+        dtype (str/type):
+            dtype of the images
+        coords (list):
+            coordinates of each dimension
+        dims (list):
+            names of the dimensions
+        lazy (bool):
+            whether to only read the images when the values of the xarray are accessed
+        n_threads (int):
+            number of threads reading blocks at once. If None, blocks are read one at a time
+        split_channels (bool):
+            whether each channel of a fov is read as a block of its own
+
+    Returns:
+        xarray.DataArray:
+            xarray with shape [fovs, x_dim, y_dim, channels]
+    """
+
+    img_xr = xr.DataArray(
+        LazilyIndexedArray(_LazyImageArray(read_block, shape, dtype, n_threads=n_threads,
+                                           split_channels=split_channels)),
+        coords=coords, dims=dims
+    )
+
+    if not lazy:
+        img_xr.load()
+
+    return img_xr
+
+
+def get_image_metadata(data_dir, files, n_threads=None):
+    """Read the shape, dtype, page count and MIBItiff channels of a set of images from their
+    headers, e.g. to size the array they are loaded into before decoding any of them.
+
+    Args:
+        data_dir (str):
+            directory containing the images
+        files (list):
+            paths of the images relative to data_dir, e.g. ['fov1/TIFs/chan0.tif']
+        n_threads (int):
+            number of threads reading headers at once. If None, headers are read one at a time
+
+    Returns:
+        pandas.DataFrame:
+            table with a row for each file, in the order of files, and the columns `file`,
+            `shape`, `rows`, `cols`, `dtype`, `n_pages` and `channel_tuples`. `rows` and `cols`
+            are the last two dimensions of channels first images and the first two otherwise.
+    """
+
+    iou.validate_paths(data_dir)
+
+    headers = [None] * len(files)
+
+    def read_header(index, file):
+        headers[index] = _read_img_header(os.path.join(data_dir, file))
+
+    _run_threaded(read_header, list(enumerate(files)), n_threads=n_threads)
+
+    metadata = pd.DataFrame(headers, columns=['shape', 'dtype', 'n_pages', 'channel_tuples'])
+    metadata.insert(0, 'file', list(files))
+
+    # channels first images have fewer channels than rows, like load_imgs_from_dir expects
+    img_shapes = [shape[1:] if len(shape) == 3 and shape[0] == min(shape) else shape[:2]
+                  for shape in metadata['shape']]
+    metadata.insert(2, 'rows', [img_shape[0] for img_shape in img_shapes])
+    metadata.insert(3, 'cols', [img_shape[1] for img_shape in img_shapes])
+
+    return metadata
+
 
 def load_imgs_from_mibitiff(data_dir, mibitiff_files=None, channels=None, delimiter=None,
-                            dtype='int16'):
+                            dtype='int16', lazy=False):
     """Load images from a series of MIBItiff files.
 
     This function takes a set of MIBItiff files and load the images into an xarray. The type used
@@ -29,6 +280,10 @@ def load_imgs_from_mibitiff(data_dir, mibitiff_files=None, channels=None, delimi
             name. Defaults to None
         dtype (str/type):
             optional specifier of image type.  Overwritten with warning for float images
+        lazy (bool):
+            if True, the images are only read when the values of the xarray are accessed, and
+            only those of the accessed fovs and channels, e.g. by
+            `img_xr.loc[fovs, :, :, channels].values`
 
     Returns:
         xarray.DataArray:
@@ -51,10 +306,10 @@ def load_imgs_from_mibitiff(data_dir, mibitiff_files=None, channels=None, delimi
     mibitiff_files = [os.path.join(data_dir, mt_file)
                       for mt_file in mibitiff_files]
 
-    test_img = io.imread(mibitiff_files[0], plugin='tifffile')
+    # the output is sized from the first file's header, without decoding any of its pages
+    channel_tuples, img_shape, data_dtype = read_mibitiff_header(mibitiff_files[0])
 
     # check to make sure that float dtype was supplied if image data is float
-    data_dtype = test_img.dtype
     if np.issubdtype(data_dtype, np.floating):
         if not np.issubdtype(dtype, np.floating):
             warnings.warn(f"The supplied non-float dtype {dtype} was overwritten to {data_dtype}, "
@@ -63,30 +318,28 @@ def load_imgs_from_mibitiff(data_dir, mibitiff_files=None, channels=None, delimi
 
     # if no channels specified, get them from first MIBItiff file
     if channels is None:
-        _, channel_tuples = read_mibitiff(mibitiff_files[0])
         channels = [channel_tuple[1] for channel_tuple in channel_tuples]
 
     if len(channels) == 0:
         raise ValueError("No channels provided in channels list")
 
-    # extract images from MIBItiff file
-    img_data = []
-    for mibitiff_file in mibitiff_files:
-        img_data.append(read_mibitiff(mibitiff_file, channels)[0])
-    img_data = np.stack(img_data, axis=0)
-    img_data = img_data.astype(dtype)
+    # decode each page straight into its place, converting it to dtype one plane at a time
+    def read_block(fov_data, fov, channel_indices):
+        read_mibitiff_into(mibitiff_files[fov], fov_data,
+                           [channels[chan] for chan in channel_indices])
 
     # create xarray with image data
-    img_xr = xr.DataArray(img_data,
-                          coords=[fovs, range(img_data[0].data.shape[0]),
-                                  range(img_data[0].data.shape[1]), channels],
-                          dims=["fovs", "rows", "cols", "channels"])
+    img_xr = _make_image_xarray(
+        read_block, (len(mibitiff_files),) + img_shape + (len(channels),), dtype,
+        coords=[fovs, range(img_shape[0]), range(img_shape[1]), channels],
+        dims=["fovs", "rows", "cols", "channels"], lazy=lazy
+    )
 
     return img_xr
 
 
 def load_imgs_from_tree(data_dir, img_sub_folder=None, fovs=None, channels=None,
-                        dtype="int16", variable_sizes=False):
+                        dtype="int16", variable_sizes=False, n_threads=None, lazy=False):
     """Takes a set of imgs from a directory structure and loads them into an xarray.
 
     Args:
@@ -101,7 +354,15 @@ def load_imgs_from_tree(data_dir, img_sub_folder=None, fovs=None, channels=None,
         dtype (str/type):
             dtype of array which will be used to store values
         variable_sizes (bool):
-            if true, will pad loaded images with zeros to fit into array
+            if true, will pad loaded images with zeros to fit into array, which is 1024 x 1024
+            unless the headers of some fov's images are larger
+        n_threads (int):
+            number of threads decoding images at once, each straight into its place in the
+            array. If None, images are read one at a time
+        lazy (bool):
+            if True, the images are only read when the values of the xarray are accessed, and
+            only those of the accessed fovs and channels, e.g. by
+            `img_xr.loc[fovs, :, :, channels].values`
 
     Returns:
         xarray.DataArray:
@@ -123,9 +384,78 @@ def load_imgs_from_tree(data_dir, img_sub_folder=None, fovs=None, channels=None,
         img_sub_folder = ""
 
     # get imgs from first fov if no img names supplied
+    channels = _find_channel_files(os.path.join(data_dir, fovs[0], img_sub_folder), channels)
+
+    # the array is sized from the headers of the first channel of each fov, or of the first fov
+    # if they all have the same size
+    metadata = get_image_metadata(
+        data_dir,
+        [os.path.join(fov, img_sub_folder, channels[0])
+         for fov in (fovs if variable_sizes else fovs[:1])],
+        n_threads=n_threads
+    )
+
+    # check to make sure that float dtype was supplied if image data is float
+    data_dtype = metadata['dtype'][0]
+    if np.issubdtype(data_dtype, np.floating):
+        if not np.issubdtype(dtype, np.floating):
+            warnings.warn(f"The supplied non-float dtype {dtype} was overwritten to {data_dtype}, "
+                          f"because the loaded images are floats")
+            dtype = data_dtype
+
+    if variable_sizes:
+        # images are padded to 1024 x 1024, unless some fov is larger
+        img_shape = (max(1024, metadata['rows'].max()), max(1024, metadata['cols'].max()))
+    else:
+        img_shape = metadata['shape'][0][:2]
+
+    def read_block(fov_data, fov, channel_indices):
+        for i, img in enumerate(channel_indices):
+            temp_img = _read_img(os.path.join(data_dir, fovs[fov], img_sub_folder,
+                                              channels[img]))
+
+            if variable_sizes:
+                fov_data[:temp_img.shape[0], :temp_img.shape[1], i] = temp_img
+            else:
+                fov_data[:, :, i] = temp_img
+
+        # check to make sure that dtype wasn't too small for range of data
+        _check_overflow(fov_data)
+
+    # remove .tif or .tiff from image name
+    img_names = [os.path.splitext(img)[0] for img in channels]
+
+    img_xr = _make_image_xarray(
+        read_block, (len(fovs),) + img_shape + (len(channels),), dtype,
+        coords=[fovs, range(img_shape[0]), range(img_shape[1]), img_names],
+        dims=["fovs", "rows", "cols", "channels"], lazy=lazy, n_threads=n_threads,
+        split_channels=True
+    )
+
+    return img_xr
+
+
+def _find_channel_files(img_dir, channels=None):
+    """Find the image files of the channels within a fov's image directory
+
+    Args:
+        img_dir (str):
+            directory containing the channel images of a fov
+        channels (list):
+            optional list of imgs to load, with or without file extensions, otherwise all imgs
+            are loaded in alphabetical order
+
+    Returns:
+        list:
+            image file names of the channels
+
+    Raises:
+        ValueError:
+            Raised if no images are found
+    """
+
     if channels is None:
-        channels = iou.list_files(os.path.join(data_dir, fovs[0], img_sub_folder),
-                                  substrs=['.tif', '.jpg', '.png'])
+        channels = iou.list_files(img_dir, substrs=['.tif', '.jpg', '.png'])
 
         # if taking all channels from directory, sort them alphabetically
         channels.sort()
@@ -134,10 +464,7 @@ def load_imgs_from_tree(data_dir, img_sub_folder=None, fovs=None, channels=None,
         # need this to reorder channels back because list_files may mess up the ordering
         channels_no_delim = [img.split('.')[0] for img in channels]
 
-        all_channels = iou.list_files(
-            os.path.join(data_dir, fovs[0], img_sub_folder),
-            substrs=channels_no_delim, exact_match=True
-        )
+        all_channels = iou.list_files(img_dir, substrs=channels_no_delim, exact_match=True)
 
         # get the corresponding indices found in channels_no_delim
         channels_indices = [channels_no_delim.index(chan.split('.')[0]) for chan in all_channels]
@@ -148,54 +475,109 @@ def load_imgs_from_tree(data_dir, img_sub_folder=None, fovs=None, channels=None,
     if len(channels) == 0:
         raise ValueError("No images found in designated folder")
 
-    test_img = io.imread(os.path.join(data_dir, fovs[0], img_sub_folder, channels[0]))
+    return channels
+
+
+def _make_channel_plane(img, channel_name, dtype):
+    """Convert a single channel image into a rows x columns x 1 xarray of the requested dtype
+
+    Args:
+        img (numpy.ndarray):
+            the loaded channel image
+        channel_name (str):
+            name of the channel
+        dtype (str/type):
+            dtype of array which will be used to store values. Overwritten with warning for
+            float images
+
+    Returns:
+        xarray.DataArray:
+            xarray with shape [x_dim, y_dim, 1]
+    """
 
     # check to make sure that float dtype was supplied if image data is float
-    data_dtype = test_img.dtype
-    if np.issubdtype(data_dtype, np.floating):
+    if np.issubdtype(img.dtype, np.floating):
         if not np.issubdtype(dtype, np.floating):
-            warnings.warn(f"The supplied non-float dtype {dtype} was overwritten to {data_dtype}, "
+            warnings.warn(f"The supplied non-float dtype {dtype} was overwritten to {img.dtype}, "
                           f"because the loaded images are floats")
-            dtype = data_dtype
+            dtype = img.dtype
 
-    if variable_sizes:
-        img_data = np.zeros((len(fovs), 1024, 1024, len(channels)), dtype=dtype)
-    else:
-        img_data = np.zeros((len(fovs), test_img.shape[0], test_img.shape[1], len(channels)),
-                            dtype=dtype)
-
-    for fov in range(len(fovs)):
-        for img in range(len(channels)):
-            if variable_sizes:
-                temp_img = io.imread(
-                    os.path.join(data_dir, fovs[fov], img_sub_folder, channels[img])
-                )
-                img_data[fov, :temp_img.shape[0], :temp_img.shape[1], img] = temp_img
-            else:
-                img_data[fov, :, :, img] = io.imread(os.path.join(data_dir, fovs[fov],
-                                                                  img_sub_folder, channels[img]))
+    img = img.astype(dtype)
 
     # check to make sure that dtype wasn't too small for range of data
-    if np.min(img_data) < 0:
+    if np.min(img) < 0:
         raise ValueError("Integer overflow from loading TIF image, try a larger dtype")
 
-    if variable_sizes:
-        row_coords, col_coords = range(1024), range(1024)
-    else:
-        row_coords, col_coords = range(test_img.shape[0]), range(test_img.shape[1])
+    return xr.DataArray(img[:, :, np.newaxis],
+                        coords=[range(img.shape[0]), range(img.shape[1]), [channel_name]],
+                        dims=["rows", "cols", "channels"])
 
-    # remove .tif or .tiff from image name
-    img_names = [os.path.splitext(img)[0] for img in channels]
 
-    img_xr = xr.DataArray(img_data, coords=[fovs, row_coords, col_coords, img_names],
-                          dims=["fovs", "rows", "cols", "channels"])
+def iter_imgs_from_mibitiff(data_dir, mibitiff_file, channels=None, dtype='int16'):
+    """Load the channels of a single MIBItiff file one at a time.
 
-    return img_xr
+    Only one channel plane is decoded and held in memory at a time, e.g. for channel at a time
+    quantification with `marker_quantification.compute_marker_counts`.
+
+    Args:
+        data_dir (str):
+            directory containing MIBItiffs
+        mibitiff_file (str):
+            the MIBItiff file to load
+        channels (list):
+            optional list of channels to load, otherwise all channels are loaded in page order
+        dtype (str/type):
+            optional specifier of image type.  Overwritten with warning for float images
+
+    Yields:
+        xarray.DataArray:
+            xarray with shape [x_dim, y_dim, 1] holding the next channel
+    """
+
+    iou.validate_paths(os.path.join(data_dir, mibitiff_file))
+
+    for (_, target), img in iter_mibitiff(os.path.join(data_dir, mibitiff_file), channels):
+        yield _make_channel_plane(img, target, dtype)
+
+
+def iter_imgs_from_tree(data_dir, fov, img_sub_folder=None, channels=None, dtype="int16"):
+    """Load the channel images of a single fov from a directory structure one at a time.
+
+    Only one channel image is read and held in memory at a time, e.g. for channel at a time
+    quantification with `marker_quantification.compute_marker_counts`.
+
+    Args:
+        data_dir (str):
+            directory containing folders of images
+        fov (str):
+            the folder to load imgs from
+        img_sub_folder (str):
+            optional name of image sub-folder within each fov
+        channels (list):
+            optional list of imgs to load, otherwise loads all imgs
+        dtype (str/type):
+            dtype of array which will be used to store values
+
+    Yields:
+        xarray.DataArray:
+            xarray with shape [x_dim, y_dim, 1] holding the next channel
+    """
+
+    if img_sub_folder is None:
+        # no img_sub_folder, change to empty string to read directly from base folder
+        img_sub_folder = ""
+
+    img_dir = os.path.join(data_dir, fov, img_sub_folder)
+    iou.validate_paths(img_dir)
+
+    for channel in _find_channel_files(img_dir, channels):
+        yield _make_channel_plane(_read_img(os.path.join(img_dir, channel)),
+                                  os.path.splitext(channel)[0], dtype)
 
 
 def load_imgs_from_dir(data_dir, files=None, delimiter=None, xr_dim_name='compartments',
                        xr_channel_names=None, dtype="int16", force_ints=False,
-                       channel_indices=None):
+                       channel_indices=None, n_threads=None, lazy=False):
     """Takes a set of images (possibly multitiffs) from a directory and loads them into an xarray.
 
     Args:
@@ -220,6 +602,12 @@ def load_imgs_from_dir(data_dir, files=None, delimiter=None, xr_dim_name='compar
             optional list of indices specifying which channels to load (by their indices).
             if None or empty, the function loads all channels.
             (Ignored if data is not multitiff).
+        n_threads (int):
+            number of threads decoding images at once, each straight into its place in the
+            array. If None, images are read one at a time
+        lazy (bool):
+            if True, the images are only read when the values of the xarray are accessed, and
+            only those of the accessed fovs, e.g. by `img_xr.loc[fovs].values`
 
     Returns:
         xarray.DataArray:
@@ -252,16 +640,18 @@ def load_imgs_from_dir(data_dir, files=None, delimiter=None, xr_dim_name='compar
     if len(imgs) == 0:
         raise ValueError(f"No images found in directory, {data_dir}")
 
-    test_img = io.imread(os.path.join(data_dir, imgs[0]))
+    # the array is sized from the header of the first image
+    test_metadata = get_image_metadata(data_dir, imgs[:1]).iloc[0]
+    test_shape = test_metadata['shape']
 
     # check data format
-    multitiff = test_img.ndim == 3
-    channels_first = multitiff and test_img.shape[0] == min(test_img.shape)
+    multitiff = len(test_shape) == 3
+    channels_first = multitiff and test_shape[0] == min(test_shape)
 
     # check to make sure all channel indices are valid given the shape of the image
     n_channels = 1
     if multitiff:
-        n_channels = test_img.shape[0] if channels_first else test_img.shape[2]
+        n_channels = test_shape[0] if channels_first else test_shape[2]
         if channel_indices:
             if max(channel_indices) >= n_channels or min(channel_indices) < 0:
                 raise ValueError(f'Invalid value for channel_indices. Indices should be'
@@ -273,7 +663,7 @@ def load_imgs_from_dir(data_dir, files=None, delimiter=None, xr_dim_name='compar
                          f' in the input data.')
 
     # check to make sure that float dtype was supplied if image data is float
-    data_dtype = test_img.dtype
+    data_dtype = test_metadata['dtype']
     if force_ints and np.issubdtype(dtype, np.integer):
         if not np.issubdtype(data_dtype, np.integer):
             warnings.warn(f"The loaded {data_dtype} images were forcefully "
@@ -284,41 +674,47 @@ def load_imgs_from_dir(data_dir, files=None, delimiter=None, xr_dim_name='compar
                           f"because the loaded images are floats")
             dtype = data_dtype
 
-    # extract data
-    img_data = []
-    for img in imgs:
-        v = io.imread(os.path.join(data_dir, img))
+    img_shape = (test_metadata['rows'], test_metadata['cols'])
+
+    if channel_indices and multitiff:
+        n_loaded_channels = len(channel_indices)
+    else:
+        n_loaded_channels = n_channels
+
+    loaded_shape = img_shape + (n_loaded_channels,)
+
+    # extract data, converting each image to dtype as it's copied into the array
+    def read_block(fov_data, fov, loaded_indices):
+        img = imgs[fov]
+        v = _read_img(os.path.join(data_dir, img))
         if not multitiff:
             v = np.expand_dims(v, axis=2)
         elif channels_first:
             # covert channels_first to be channels_last
             v = np.moveaxis(v, 0, -1)
-        img_data.append(v)
-    img_data = np.stack(img_data, axis=0)
 
-    img_data = img_data.astype(dtype)
+        if channel_indices and multitiff:
+            v = v[:, :, channel_indices]
 
-    if channel_indices and multitiff:
-        img_data = img_data[:, :, :, channel_indices]
+        if v.shape != loaded_shape:
+            raise ValueError(f"The shape of {img}, {v.shape}, doesn't match the shape of the "
+                             f"first image, {loaded_shape}")
 
-    # check to make sure that dtype wasn't too small for range of data
-    if np.min(img_data) < 0:
-        raise ValueError("Integer overflow from loading TIF image, try a larger dtype")
+        fov_data[...] = v[:, :, loaded_indices]
 
-    if channels_first:
-        row_coords, col_coords = range(test_img.shape[1]), range(test_img.shape[2])
-    else:
-        row_coords, col_coords = range(test_img.shape[0]), range(test_img.shape[1])
+        # check to make sure that dtype wasn't too small for range of data
+        _check_overflow(fov_data)
 
     # get fov name from imgs
     fovs = iou.remove_file_extensions(imgs)
     fovs = iou.extract_delimited_names(fovs, delimiter=delimiter)
 
     # create xarray with image data
-    img_xr = xr.DataArray(img_data,
-                          coords=[fovs, row_coords, col_coords,
-                                  xr_channel_names if xr_channel_names
-                                  else range(img_data.shape[3])],
-                          dims=["fovs", "rows", "cols", xr_dim_name])
+    img_xr = _make_image_xarray(
+        read_block, (len(imgs),) + loaded_shape, dtype,
+        coords=[fovs, range(img_shape[0]), range(img_shape[1]),
+                xr_channel_names if xr_channel_names else range(n_loaded_channels)],
+        dims=["fovs", "rows", "cols", xr_dim_name], lazy=lazy, n_threads=n_threads
+    )
 
     return img_xr
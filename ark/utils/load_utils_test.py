@@ -1,10 +1,42 @@
+import os
 import numpy as np
 import pytest
 import tempfile
 
+import skimage.io as io
+
 from ark.utils import load_utils, test_utils
 
 
+def test_get_image_metadata():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(num_fovs=2, num_chans=3)
+
+        test_utils.create_paired_xarray_fovs(temp_dir, fovs[:1], chans, img_shape=(10, 12),
+                                             mode='multitiff', dtype='int16')
+        test_utils.create_paired_xarray_fovs(temp_dir, fovs[1:], chans, img_shape=(10, 12),
+                                             mode='reverse_multitiff', dtype=np.float32)
+        io.imsave(os.path.join(temp_dir, 'label.tif'), np.zeros((6, 8), dtype='int32'),
+                  plugin='tifffile')
+
+        files = [f'{fovs[0]}.tiff', f'{fovs[1]}.tiff', 'label.tif']
+        metadata = load_utils.get_image_metadata(temp_dir, files, n_threads=2)
+
+        assert list(metadata.columns) == ['file', 'shape', 'rows', 'cols', 'dtype', 'n_pages',
+                                          'channel_tuples']
+        assert list(metadata['file']) == files
+        assert list(metadata['shape']) == [(10, 12, 3), (3, 10, 12), (6, 8)]
+        assert list(metadata['rows']) == [10, 10, 6]
+        assert list(metadata['cols']) == [12, 12, 8]
+        assert list(metadata['dtype']) == [np.dtype('int16'), np.dtype('float32'),
+                                           np.dtype('int32')]
+        assert metadata['channel_tuples'].isnull().all()
+
+        # errors name the file
+        with pytest.raises(FileNotFoundError, match='not_an_image'):
+            load_utils.get_image_metadata(temp_dir, ['not_an_image.tif'])
+
+
 def test_load_imgs_from_mibitiff():
     # invalid directory is provided
     with pytest.raises(ValueError):
@@ -77,6 +109,53 @@ def test_load_imgs_from_mibitiff():
             assert loaded_xr.equals(data_xr.loc[[fovs[-1]], :, :, :])
             assert np.issubdtype(loaded_xr.dtype, np.floating)
 
+        # test lazy loading
+        lazy_xr = load_utils.load_imgs_from_mibitiff(temp_dir, channels=channels,
+                                                     delimiter='_', lazy=True)
+
+        assert lazy_xr.shape == data_xr.shape
+        assert np.array_equal(lazy_xr.loc[fovs[1], :, :, channels[::-1]].values,
+                              data_xr.loc[fovs[1], :, :, channels[::-1]].values)
+        assert lazy_xr.equals(data_xr)
+
+
+def test_iter_imgs_from_mibitiff():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, channels = test_utils.gen_fov_chan_names(num_fovs=2, num_chans=3)
+
+        filelocs, data_xr = test_utils.create_paired_xarray_fovs(
+            temp_dir, fovs, channels, img_shape=(10, 10), mode='mibitiff', fills=True,
+            dtype=np.float32
+        )
+
+        # invalid file is provided
+        with pytest.raises(ValueError):
+            next(load_utils.iter_imgs_from_mibitiff(temp_dir, 'not_a_file.tiff'))
+
+        # each channel is loaded on its own, in page order
+        planes = list(load_utils.iter_imgs_from_mibitiff(temp_dir, f'{fovs[1]}.tiff',
+                                                         dtype=np.float32))
+
+        assert len(planes) == len(channels)
+        for chan, plane in zip(channels, planes):
+            assert plane.shape == (10, 10, 1)
+            assert plane.channels.values[0] == chan
+            assert np.array_equal(plane.values, data_xr.loc[fovs[1], :, :, [chan]].values)
+
+        # check loading of specific channels
+        planes = list(load_utils.iter_imgs_from_mibitiff(temp_dir, f'{fovs[1]}.tiff',
+                                                         channels=channels[1:],
+                                                         dtype=np.float32))
+
+        assert [plane.channels.values[0] for plane in planes] == channels[1:]
+
+        # test float overwrite
+        with pytest.warns(UserWarning):
+            plane = next(load_utils.iter_imgs_from_mibitiff(temp_dir, f'{fovs[1]}.tiff',
+                                                            dtype='int16'))
+
+            assert np.issubdtype(plane.dtype, np.floating)
+
 
 def test_load_imgs_from_tree():
     # invalid directory is provided
@@ -111,6 +190,13 @@ def test_load_imgs_from_tree():
 
         assert loaded_xr.equals(data_xr)
 
+        # check decoding the images in threads
+        loaded_xr = \
+            load_utils.load_imgs_from_tree(temp_dir, img_sub_folder="TIFs", dtype="int16",
+                                           n_threads=4)
+
+        assert loaded_xr.equals(data_xr)
+
         # check loading of specific files
         some_fovs = fovs[:2]
         some_imgs = imgs[:2]
@@ -137,6 +223,19 @@ def test_load_imgs_from_tree():
 
         assert loaded_xr.equals(data_xr)
 
+        # a file which can't be read raises the reader's own error, whether or not threads are used
+        bad_path = os.path.join(temp_dir, fovs[1], "TIFs", imgs[1])
+        with open(bad_path, 'w') as bad_file:
+            bad_file.write("not an image")
+
+        with pytest.raises(Exception) as read_err:
+            load_utils._read_img(bad_path)
+
+        for n_threads in [None, 4]:
+            with pytest.raises(type(read_err.value)):
+                load_utils.load_imgs_from_tree(temp_dir, img_sub_folder="TIFs", dtype="int16",
+                                               n_threads=n_threads)
+
     # test loading with data_xr containing float values
     with tempfile.TemporaryDirectory() as temp_dir:
         fovs, chans, imgs = test_utils.gen_fov_chan_names(num_fovs=1, num_chans=2,
@@ -172,6 +271,86 @@ def test_load_imgs_from_tree():
 
         assert loaded_xr.shape == (3, 1024, 1024, 3)
 
+        # the array grows to fit fovs larger than 1024 x 1024
+        large_img = np.ones((1030, 12), dtype='int16')
+        io.imsave(os.path.join(temp_dir, fovs[1], 'TIFs', f'{chans[0]}.tiff'), large_img,
+                  plugin='tifffile')
+
+        loaded_xr = \
+            load_utils.load_imgs_from_tree(temp_dir, img_sub_folder="TIFs", dtype="int16",
+                                           variable_sizes=True, n_threads=2)
+
+        assert loaded_xr.shape == (3, 1030, 1024, 3)
+        assert np.all(loaded_xr.loc[fovs[1], :, :11, chans[0]] == 1)
+        assert np.array_equal(loaded_xr.loc[fovs[0], :9, :9, :].values, data_xr[0].values)
+
+
+def test_load_imgs_from_tree_lazy(monkeypatch):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans, imgs = test_utils.gen_fov_chan_names(num_fovs=3, num_chans=3,
+                                                          return_imgs=True)
+
+        filelocs, data_xr = test_utils.create_paired_xarray_fovs(
+            temp_dir, fovs, chans, img_shape=(10, 12), fills=True, sub_dir="TIFs", dtype="int16"
+        )
+
+        read_paths = []
+        read_img = load_utils._read_img
+
+        def record_read_img(path):
+            read_paths.append(path)
+            return read_img(path)
+
+        monkeypatch.setattr(load_utils, '_read_img', record_read_img)
+
+        lazy_xr = load_utils.load_imgs_from_tree(temp_dir, img_sub_folder="TIFs",
+                                                 dtype="int16", lazy=True)
+
+        # no images are read until values are accessed
+        assert read_paths == []
+        assert lazy_xr.shape == data_xr.shape
+        assert lazy_xr.dtype == np.dtype('int16')
+
+        # only the images of the selected fovs and channels are read
+        selected_xr = lazy_xr.loc[fovs[1], 2:5, :, [chans[2], chans[0]]]
+        assert read_paths == []
+
+        assert np.array_equal(selected_xr.values,
+                              data_xr.loc[fovs[1], 2:5, :, [chans[2], chans[0]]].values)
+        assert sorted(read_paths) == sorted(
+            os.path.join(temp_dir, fovs[1], "TIFs", imgs[chan]) for chan in [0, 2]
+        )
+
+        assert lazy_xr.loc[:, :, :, chans[1]].equals(data_xr.loc[:, :, :, chans[1]])
+        assert lazy_xr.equals(data_xr)
+
+        # loading the values keeps them in memory
+        lazy_xr.load()
+        read_paths.clear()
+
+        assert lazy_xr.equals(data_xr)
+        assert read_paths == []
+
+
+def test_load_imgs_from_dir_lazy():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, channels = test_utils.gen_fov_chan_names(num_fovs=3, num_chans=5, use_delimiter=True)
+
+        _, data_xr = test_utils.create_paired_xarray_fovs(
+            temp_dir, fovs, channels, img_shape=(10, 10), mode='multitiff', delimiter='_',
+            fills=True, dtype=np.float32, channels_first=True
+        )
+
+        lazy_xr = load_utils.load_imgs_from_dir(temp_dir, xr_dim_name='channels',
+                                                delimiter='_', dtype=np.float32,
+                                                channel_indices=[0, 2, 3], lazy=True,
+                                                n_threads=2)
+
+        assert lazy_xr.shape == (3, 10, 10, 3)
+        assert np.array_equal(lazy_xr[[2, 0], :, :, [2, 1]].values,
+                              data_xr.values[[2, 0]][:, :, :, [3, 2]])
+        assert np.array_equal(lazy_xr.values, data_xr.values[:, :, :, [0, 2, 3]])
+
 
 def test_load_imgs_from_dir():
     # invalid directory is provided
@@ -268,6 +447,16 @@ def test_load_imgs_from_dir():
 
         assert loaded_xr.equals(data_xr[:, :, :, :3])
 
+        # test decoding the images in threads
+        loaded_xr = load_utils.load_imgs_from_dir(temp_dir,
+                                                  files=None,
+                                                  channel_indices=[0, 2],
+                                                  xr_dim_name='channels',
+                                                  delimiter='_',
+                                                  n_threads=2)
+
+        assert np.array_equal(loaded_xr.values, data_xr.values[:, :, :, [0, 2]])
+
         # test channels_first input
         fovs, channels = test_utils.gen_fov_chan_names(num_fovs=2, num_chans=5, use_delimiter=True)
 
@@ -293,3 +482,38 @@ def test_load_imgs_from_dir():
                                                   delimiter='_')
 
         assert loaded_xr.equals(data_xr)
+
+
+def test_iter_imgs_from_tree():
+    # invalid directory is provided
+    with pytest.raises(ValueError):
+        next(load_utils.iter_imgs_from_tree('not_a_dir', 'fov0', img_sub_folder="TIFs"))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans, imgs = test_utils.gen_fov_chan_names(num_fovs=2, num_chans=3,
+                                                          return_imgs=True)
+
+        filelocs, data_xr = test_utils.create_paired_xarray_fovs(
+            temp_dir, fovs, chans, img_shape=(10, 10), fills=True, sub_dir="TIFs",
+            dtype="int16"
+        )
+
+        # each channel is loaded on its own, in the same order as load_imgs_from_tree
+        planes = list(load_utils.iter_imgs_from_tree(temp_dir, fovs[1], img_sub_folder="TIFs",
+                                                     dtype="int16"))
+
+        assert len(planes) == len(chans)
+        for chan, plane in zip(chans, planes):
+            assert plane.shape == (10, 10, 1)
+            assert plane.channels.values[0] == chan
+            assert np.array_equal(plane.values, data_xr.loc[fovs[1], :, :, [chan]].values)
+
+        # check loading of specific files, with and without extensions
+        planes = list(load_utils.iter_imgs_from_tree(temp_dir, fovs[1], img_sub_folder="TIFs",
+                                                     channels=[chans[2], imgs[0]]))
+
+        assert [plane.channels.values[0] for plane in planes] == [chans[2], chans[0]]
+
+        with pytest.raises(ValueError):
+            # fov folder doesn't exist
+            next(load_utils.iter_imgs_from_tree(temp_dir, 'not_a_fov', img_sub_folder="TIFs"))
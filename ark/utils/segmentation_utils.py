@@ -4,6 +4,7 @@ import warnings
 import numpy as np
 import pandas as pd
 import skimage.io as io
+from scipy.sparse import coo_matrix
 from skimage.measure import regionprops_table
 from skimage.morphology import remove_small_objects
 from skimage.segmentation import find_boundaries
@@ -13,7 +14,8 @@ from ark.utils import plot_utils, io_utils, misc_utils
 import ark.settings as settings
 
 
-def find_nuclear_label_id(nuc_segmentation_labels, cell_coords):
+def find_nuclear_label_id(nuc_segmentation_labels, cell_coords=None, cell_index=None,
+                          cell_id=None):
     """Get the ID of the nuclear mask which has the greatest amount of overlap with a given cell
 
     Args:
@@ -21,6 +23,10 @@ def find_nuclear_label_id(nuc_segmentation_labels, cell_coords):
             predicted nuclear segmentations
         cell_coords (list):
             list of coords specifying pixels that belong to a cell
+        cell_index (LabelIndex):
+            prebuilt index of the cell segmentations, used with cell_id instead of cell_coords
+        cell_id (int):
+            label of the cell to look up in cell_index
 
     Returns:
         int or None:
@@ -28,7 +34,12 @@ def find_nuclear_label_id(nuc_segmentation_labels, cell_coords):
             If no matches found, returns None.
     """
 
-    ids, counts = np.unique(nuc_segmentation_labels[tuple(cell_coords.T)], return_counts=True)
+    if cell_coords is None:
+        cell_nuc_labels = nuc_segmentation_labels.ravel()[cell_index.get_pixel_indices(cell_id)]
+    else:
+        cell_nuc_labels = nuc_segmentation_labels[tuple(cell_coords.T)]
+
+    ids, counts = np.unique(cell_nuc_labels, return_counts=True)
 
     # Return nuclear ID with greatest overlap. If only 0, return None
     if ids[ids != 0].size == 0:
@@ -39,9 +50,532 @@ def find_nuclear_label_id(nuc_segmentation_labels, cell_coords):
     return nuclear_label_id
 
 
-def split_large_nuclei(cell_segmentation_labels, nuc_segmentation_labels, cell_ids, min_size=5):
+class LabelIndex(object):
+    """Index of the pixels belonging to each label of a label image, built with a single sort.
+
+    The flat indices of each label's pixels are stored contiguously in CSR form, so that once
+    the index is built, the pixels of any label can be looked up without scanning the image.
+
+    Args:
+        label_image (numpy.ndarray):
+            labeled image, with 0 as background
+
+    Attributes:
+        shape (tuple):
+            shape of the label image
+        label_ids (numpy.ndarray):
+            sorted nonzero labels
+        label_sizes (numpy.ndarray):
+            number of pixels in each label, ordered as label_ids
+        indptr (numpy.ndarray):
+            the pixels of label_ids[i] are pixel_indices[indptr[i]:indptr[i + 1]]
+        pixel_indices (numpy.ndarray):
+            flat indices of the labeled pixels grouped by label, in row major order within each
+            label
+    """
+
+    def __init__(self, label_image):
+        label_image = np.asarray(label_image)
+        flat_labels = label_image.ravel()
+
+        self.shape = label_image.shape
+
+        # a stable sort keeps the pixels of each label in row major order
+        order = np.argsort(flat_labels, kind='stable')
+        sorted_labels = flat_labels[order]
+
+        # skip the background, which sorts first
+        first_labeled = np.searchsorted(sorted_labels, 0, side='right')
+        self._pixel_indices = order[first_labeled:]
+        sorted_labels = sorted_labels[first_labeled:]
+
+        # each label's run of pixels starts where the sorted labels change
+        starts = np.flatnonzero(np.concatenate((np.ones(min(len(sorted_labels), 1), dtype='bool'),
+                                                sorted_labels[1:] != sorted_labels[:-1])))
+
+        self.label_ids = sorted_labels[starts]
+        self.indptr = np.append(starts, len(sorted_labels))
+        self.label_sizes = np.diff(self.indptr)
+
+        self._row_major_pixels = None
+        self._label_lookup = None
+
+    @classmethod
+    def from_positions(cls, shape, label_ids, label_sizes, pixel_indices, positions):
+        """Create the index from the pixels of the labels in row major order, as returned by
+        `get_positions`, e.g. when they were cached along with the morphology of the labels
+
+        The image isn't sorted, the pixels are only grouped by label once they're first looked up
+        by label.
+
+        Args:
+            shape (tuple):
+                shape of the label image
+            label_ids (numpy.ndarray):
+                sorted nonzero labels
+            label_sizes (numpy.ndarray):
+                number of pixels in each label, ordered as label_ids
+            pixel_indices (numpy.ndarray):
+                flat indices of the labeled pixels, in row major order
+            positions (numpy.ndarray):
+                index into label_ids of the label each of these pixels belongs to
+
+        Returns:
+            LabelIndex:
+                the index
+        """
+
+        label_index = cls.__new__(cls)
+
+        label_index.shape = tuple(shape)
+        label_index.label_ids, label_index.label_sizes = label_ids, label_sizes
+        label_index.indptr = np.concatenate(([0], np.cumsum(label_sizes)))
+
+        label_index._pixel_indices = None
+        label_index._row_major_pixels = (pixel_indices, positions)
+        label_index._label_lookup = None
+
+        return label_index
+
+    def __getstate__(self):
+        # the lookups filled in on demand are left out, so that equal indices pickle the same
+        state = dict(self.__dict__, _label_lookup=None)
+        if self._row_major_pixels is not None:
+            state['_pixel_indices'] = None
+
+        return state
+
+    @property
+    def pixel_indices(self):
+        if self._pixel_indices is None:
+            # a stable sort of the labeled pixels keeps each label's pixels in row major order
+            pixel_indices, positions = self._row_major_pixels
+            self._pixel_indices = pixel_indices[np.argsort(positions, kind='stable')]
+
+        return self._pixel_indices
+
+    def get_label_positions(self, label_ids):
+        """Get the index into self.label_ids of each of the supplied labels
+
+        Args:
+            label_ids (numpy.ndarray):
+                labels to look up, which must all be in the image
+
+        Returns:
+            numpy.ndarray:
+                index of each label
+        """
+
+        misc_utils.verify_in_list(label_ids=label_ids, image_label_ids=self.label_ids)
+
+        return np.searchsorted(self.label_ids, label_ids)
+
+    def get_pixel_indices(self, label_id):
+        """Get the flat indices of the pixels of a single label
+
+        Args:
+            label_id (int):
+                the label to look up
+
+        Returns:
+            numpy.ndarray:
+                flat indices of the label's pixels in row major order, empty if the label isn't
+                in the image
+        """
+
+        # hashed lookup, so that looking up many single labels doesn't search label_ids each time
+        if self._label_lookup is None:
+            self._label_lookup = dict(zip(self.label_ids.tolist(), range(len(self.label_ids))))
+
+        position = self._label_lookup.get(label_id)
+        if position is None:
+            return self.pixel_indices[:0]
+
+        return self.pixel_indices[self.indptr[position]:self.indptr[position + 1]]
+
+    def get_coords(self, label_id):
+        """Get the coordinates of the pixels of a single label, like regionprops' coords
+
+        Args:
+            label_id (int):
+                the label to look up
+
+        Returns:
+            numpy.ndarray:
+                pixels x dimensions matrix of coordinates
+        """
+
+        return np.stack(np.unravel_index(self.get_pixel_indices(label_id), self.shape), axis=-1)
+
+    def get_label_pixels(self, label_ids):
+        """Get the pixels of several labels at once
+
+        Args:
+            label_ids (numpy.ndarray):
+                labels to look up, which must all be in the image
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray):
+            - flat indices of the pixels of the labels, grouped by label
+            - index into label_ids of the label each of these pixels belongs to
+        """
+
+        positions = self.get_label_positions(label_ids)
+        sizes = self.label_sizes[positions]
+
+        # offset of each pixel within its label's run of pixel_indices
+        owners = np.repeat(np.arange(len(positions)), sizes)
+        offsets = np.arange(np.sum(sizes)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+
+        return self.pixel_indices[self.indptr[positions][owners] + offsets], owners
+
+    def get_image_positions(self):
+        """Get the index into self.label_ids of the label of every pixel
+
+        Returns:
+            numpy.ndarray:
+                flat array of each pixel's index into label_ids, -1 for background
+        """
+
+        positions = np.full(int(np.prod(self.shape)), -1, dtype='int64')
+
+        if self._row_major_pixels is not None:
+            pixel_indices, pixel_positions = self._row_major_pixels
+            positions[pixel_indices] = pixel_positions
+        else:
+            positions[self.pixel_indices] = np.repeat(np.arange(len(self.label_ids)),
+                                                      self.label_sizes)
+
+        return positions
+
+    def get_positions(self, cell_ids=None):
+        """Map each pixel belonging to one of cell_ids to the index of its cell in cell_ids,
+        like `signal_extraction.get_label_positions`
+
+        Args:
+            cell_ids (numpy.ndarray):
+                sorted array of the labels to look up, which may include labels which aren't in
+                the image. Defaults to label_ids
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray):
+            - flat indices of the pixels belonging to one of cell_ids, in row major order
+            - index into cell_ids of the label each of these pixels belongs to
+        """
+
+        image_positions = self.get_image_positions()
+
+        if cell_ids is not None:
+            # translate positions in label_ids into positions in cell_ids
+            cell_positions = np.searchsorted(cell_ids, self.label_ids)
+            cell_positions[cell_positions == len(cell_ids)] = 0
+            if len(cell_ids) > 0:
+                found = cell_ids[cell_positions] == self.label_ids
+            else:
+                found = np.zeros(len(self.label_ids), dtype='bool')
+            cell_positions[~found] = -1
+
+            labeled = image_positions >= 0
+            image_positions[labeled] = cell_positions[image_positions[labeled]]
+
+        pixel_indices = np.flatnonzero(image_positions >= 0)
+
+        return pixel_indices, image_positions[pixel_indices]
+
+
+class NuclearOverlap(object):
+    """Sparse cell x nucleus overlap table, computed in one pass over a pair of label images.
+
+    Args:
+        cell_segmentation_labels (numpy.ndarray):
+            predicted cell segmentations
+        nuc_segmentation_labels (numpy.ndarray):
+            predicted nuclear segmentations
+        cell_index (LabelIndex):
+            optional prebuilt index of cell_segmentation_labels
+        nuc_index (LabelIndex):
+            optional prebuilt index of nuc_segmentation_labels
+
+    Attributes:
+        cell_ids (numpy.ndarray):
+            sorted unique cell labels
+        nuc_ids (numpy.ndarray):
+            sorted unique nuclear labels
+        cell_sizes (numpy.ndarray):
+            number of pixels in each cell, ordered as cell_ids
+        nuc_sizes (numpy.ndarray):
+            number of pixels in each nucleus, ordered as nuc_ids
+        overlap_counts (scipy.sparse.csr_matrix):
+            cells x nuclei matrix of the number of pixels each cell shares with each nucleus
+    """
+
+    def __init__(self, cell_segmentation_labels, nuc_segmentation_labels, cell_index=None,
+                 nuc_index=None):
+        if cell_index is None:
+            cell_index = LabelIndex(cell_segmentation_labels)
+        if nuc_index is None:
+            nuc_index = LabelIndex(nuc_segmentation_labels)
+
+        self.cell_ids, self.cell_sizes = cell_index.label_ids, cell_index.label_sizes
+        self.nuc_ids, self.nuc_sizes = nuc_index.label_ids, nuc_index.label_sizes
+
+        cell_positions = cell_index.get_image_positions()
+        nuc_positions = nuc_index.get_image_positions()
+
+        # count the pixels shared by each cell and nucleus, duplicate entries get summed
+        overlapping = np.logical_and(cell_positions >= 0, nuc_positions >= 0)
+        self.overlap_counts = coo_matrix(
+            (np.ones(np.sum(overlapping), dtype='int64'),
+             (cell_positions[overlapping], nuc_positions[overlapping])),
+            shape=(len(self.cell_ids), len(self.nuc_ids))
+        ).tocsr()
+        self.overlap_counts.sort_indices()
+
+        self._best_positions, self._best_counts = self._find_best_overlaps()
+
+    @classmethod
+    def from_overlap_counts(cls, cell_ids, cell_sizes, nuc_ids, nuc_sizes, overlap_counts):
+        """Create the overlap table from counts which were already computed, e.g. by summing
+        the counts of the tiles of a label image
+
+        Args:
+            cell_ids (numpy.ndarray):
+                sorted unique cell labels
+            cell_sizes (numpy.ndarray):
+                number of pixels in each cell, ordered as cell_ids
+            nuc_ids (numpy.ndarray):
+                sorted unique nuclear labels
+            nuc_sizes (numpy.ndarray):
+                number of pixels in each nucleus, ordered as nuc_ids
+            overlap_counts (scipy.sparse.spmatrix):
+                cells x nuclei matrix of the number of pixels each cell shares with each nucleus
+
+        Returns:
+            NuclearOverlap:
+                the overlap table
+        """
+
+        nuclear_overlap = cls.__new__(cls)
+
+        nuclear_overlap.cell_ids, nuclear_overlap.cell_sizes = cell_ids, cell_sizes
+        nuclear_overlap.nuc_ids, nuclear_overlap.nuc_sizes = nuc_ids, nuc_sizes
+
+        nuclear_overlap.overlap_counts = overlap_counts.tocsr()
+        nuclear_overlap.overlap_counts.sum_duplicates()
+        nuclear_overlap.overlap_counts.sort_indices()
+
+        nuclear_overlap._best_positions, nuclear_overlap._best_counts = \
+            nuclear_overlap._find_best_overlaps()
+
+        return nuclear_overlap
+
+    def _find_best_overlaps(self):
+        """Find the nucleus with the greatest overlap for every cell
+
+        Ties are broken in favor of the smallest nuclear label, like `find_nuclear_label_id`
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray):
+            - index into nuc_ids of each cell's nucleus, -1 if the cell has no nucleus
+            - number of pixels each cell shares with its nucleus
+        """
+
+        indptr, indices, data = (self.overlap_counts.indptr, self.overlap_counts.indices,
+                                 self.overlap_counts.data)
+        row_lengths = np.diff(indptr)
+        has_nuc = row_lengths > 0
+
+        best_positions = np.full(len(self.cell_ids), -1, dtype='int64')
+        best_counts = np.zeros(len(self.cell_ids), dtype='int64')
+
+        if not np.any(has_nuc):
+            return best_positions, best_counts
+
+        # the rows of a csr matrix are contiguous, so reduce over the nonempty rows directly
+        best_counts[has_nuc] = np.maximum.reduceat(data, indptr[:-1][has_nuc])
+
+        # keep the first (smallest label) nucleus of each row which reaches the maximum
+        rows = np.repeat(np.arange(len(self.cell_ids)), row_lengths)
+        max_entries = np.flatnonzero(data == best_counts[rows])
+        best_rows, first_entries = np.unique(rows[max_entries], return_index=True)
+        best_positions[best_rows] = indices[max_entries[first_entries]]
+
+        return best_positions, best_counts
+
+    def _get_cell_positions(self, cell_ids):
+        """Get the index into self.cell_ids of each of the supplied cells
+
+        Args:
+            cell_ids (numpy.ndarray):
+                cell labels to look up, if None all cells are used
+
+        Returns:
+            numpy.ndarray:
+                index of each cell
+        """
+
+        if cell_ids is None:
+            return np.arange(len(self.cell_ids))
+
+        misc_utils.verify_in_list(cell_ids=cell_ids, segmentation_cell_ids=self.cell_ids)
+
+        return np.searchsorted(self.cell_ids, cell_ids)
+
+    def get_nuclear_label_ids(self, cell_ids=None):
+        """Get the ID of the nuclear mask which has the greatest amount of overlap with each cell
+
+        Args:
+            cell_ids (numpy.ndarray):
+                cells to get the nucleus of, defaults to all cells in cell_ids order
+
+        Returns:
+            numpy.ndarray:
+                nuclear label of each cell, 0 for cells which don't overlap any nucleus
+        """
+
+        best_positions = self._best_positions[self._get_cell_positions(cell_ids)]
+
+        nuc_label_ids = np.zeros(len(best_positions), dtype=self.nuc_ids.dtype)
+        nuc_label_ids[best_positions >= 0] = self.nuc_ids[best_positions[best_positions >= 0]]
+
+        return nuc_label_ids
+
+    def get_overlap_sizes(self, cell_ids=None):
+        """Get the number of pixels each cell shares with its nucleus, and the nucleus' size
+
+        Args:
+            cell_ids (numpy.ndarray):
+                cells to get the overlap of, defaults to all cells in cell_ids order
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray):
+            - number of pixels each cell shares with its nucleus
+            - number of pixels in each cell's nucleus, 0 if there's no nucleus
+        """
+
+        cell_positions = self._get_cell_positions(cell_ids)
+        best_positions = self._best_positions[cell_positions]
+
+        nuc_sizes = np.zeros(len(cell_positions), dtype='int64')
+        nuc_sizes[best_positions >= 0] = self.nuc_sizes[best_positions[best_positions >= 0]]
+
+        return self._best_counts[cell_positions], nuc_sizes
+
+    def get_overlap_fractions(self, cell_ids=None):
+        """Get the fraction of each cell covered by its nucleus, and of the nucleus in the cell
+
+        Args:
+            cell_ids (numpy.ndarray):
+                cells to get the overlap of, defaults to all cells in cell_ids order
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray):
+            - fraction of each cell's pixels which belong to its nucleus
+            - fraction of the nucleus' pixels which belong to the cell, 0 if there's no nucleus
+        """
+
+        cell_positions = self._get_cell_positions(cell_ids)
+        overlap_sizes, nuc_sizes = self.get_overlap_sizes(cell_ids)
+
+        cell_fraction = overlap_sizes / self.cell_sizes[cell_positions]
+
+        nuc_fraction = np.zeros(len(cell_positions))
+        nuc_fraction[nuc_sizes > 0] = overlap_sizes[nuc_sizes > 0] / nuc_sizes[nuc_sizes > 0]
+
+        return cell_fraction, nuc_fraction
+
+    def get_split_nuclei(self, cell_ids, max_nuc_id, min_size=5):
+        """Find the nuclei which extend outside of their cell, and the new label the part of
+        each of these nuclei inside the cell gets
+
+        Args:
+            cell_ids (numpy.ndarray):
+                the cells whose nuclei can get split, new labels are handed out in this order
+            max_nuc_id (int):
+                largest nuclear label, new labels start right after it
+            min_size (int):
+                number of pixels of nucleus that must be outside of cell in order to be
+                classified a new object
+
+        Returns:
+            tuple (numpy.ndarray, numpy.ndarray, numpy.ndarray):
+            - sorted labels of the cells whose nucleus gets split
+            - label of the nucleus of each of these cells
+            - new label of the part of each nucleus inside its cell
+        """
+
+        nuc_ids = self.get_nuclear_label_ids(cell_ids)
+        overlap_sizes, nuc_sizes = self.get_overlap_sizes(cell_ids)
+
+        # only split nuclei where a non-negligible part of the nucleus is outside of the cell
+        split = np.logical_and(nuc_ids != 0, nuc_sizes - overlap_sizes > min_size)
+
+        # new labels are handed out in cell_ids order
+        split_cells, split_nucs = np.asarray(cell_ids)[split], nuc_ids[split]
+        new_nuc_ids = max_nuc_id + 1 + np.arange(len(split_cells))
+
+        sort_order = np.argsort(split_cells)
+
+        return split_cells[sort_order], split_nucs[sort_order], new_nuc_ids[sort_order]
+
+
+def relabel_split_nuclei(cell_labels, nuc_labels, split_cells, split_nucs, new_nuc_ids,
+                         cell_index=None):
+    """Give the part of each split nucleus which lies inside its cell a new label
+
+    Args:
+        cell_labels (numpy.ndarray):
+            cell label of each pixel, either as a label image or as a flat array
+        nuc_labels (numpy.ndarray):
+            nuclear label of each pixel, with the same shape as cell_labels
+        split_cells (numpy.ndarray):
+            sorted labels of the cells whose nucleus gets split
+        split_nucs (numpy.ndarray):
+            label of the nucleus of each of these cells
+        new_nuc_ids (numpy.ndarray):
+            new label of the part of each nucleus inside its cell
+        cell_index (LabelIndex):
+            optional prebuilt index of cell_labels, so that only the pixels of the split cells
+            are visited
+
+    Returns:
+        numpy.ndarray:
+            relabeled copy of nuc_labels
+    """
+
+    nuc_labels_modified = np.copy(nuc_labels)
+
+    if len(split_cells) == 0:
+        return nuc_labels_modified
+
+    if cell_index is not None:
+        pixel_indices, owners = cell_index.get_label_pixels(split_cells)
+
+        # the flat view writes through to nuc_labels_modified
+        nuc_flat = nuc_labels_modified.reshape(-1)
+        relabel = nuc_flat[pixel_indices] == split_nucs[owners]
+        nuc_flat[pixel_indices[relabel]] = new_nuc_ids[owners[relabel]]
+
+        return nuc_labels_modified
+
+    # find the pixels of each split cell which belong to its nucleus
+    positions = np.searchsorted(split_cells, cell_labels)
+    positions[positions == len(split_cells)] = 0
+    relabel = np.logical_and(split_cells[positions] == cell_labels,
+                             split_nucs[positions] == nuc_labels)
+
+    nuc_labels_modified[relabel] = new_nuc_ids[positions[relabel]]
+
+    return nuc_labels_modified
+
+
+def split_large_nuclei(cell_segmentation_labels, nuc_segmentation_labels, cell_ids, min_size=5,
+                       nuclear_overlap=None, cell_index=None, nuc_index=None):
     """Splits nuclei that are bigger than the corresponding cell into multiple pieces
 
+    All nuclei are relabeled at once from the cell/nucleus overlap counts, instead of building
+    full image masks for each cell
+
     Args:
         cell_segmentation_labels (numpy.ndarray):
             predicted cell segmentations
@@ -52,43 +586,121 @@ def split_large_nuclei(cell_segmentation_labels, nuc_segmentation_labels, cell_i
         min_size (int):
             number of pixels of nucleus that must be outside of cell in order to be classified a
             new object. Nuclei with fewer than this many extra pixels will not be relabeled
+        nuclear_overlap (NuclearOverlap):
+            optional precomputed overlap of cell_segmentation_labels and nuc_segmentation_labels
+        cell_index (LabelIndex):
+            optional prebuilt index of cell_segmentation_labels
+        nuc_index (LabelIndex):
+            optional prebuilt index of nuc_segmentation_labels
 
     Returns:
         numpy.ndarray:
             modified nuclear segmentation mask
     """
 
-    nuc_labels_modified = np.copy(nuc_segmentation_labels)
-    max_nuc_id = np.max(nuc_segmentation_labels)
+    if nuc_index is not None:
+        max_nuc_id = nuc_index.label_ids[-1] if len(nuc_index.label_ids) > 0 else 0
+    else:
+        max_nuc_id = np.max(nuc_segmentation_labels)
 
-    cell_props = pd.DataFrame(regionprops_table(cell_segmentation_labels,
-                                                properties=['label', 'coords']))
+    if nuclear_overlap is None:
+        nuclear_overlap = NuclearOverlap(cell_segmentation_labels=cell_segmentation_labels,
+                                         nuc_segmentation_labels=nuc_segmentation_labels,
+                                         cell_index=cell_index, nuc_index=nuc_index)
 
-    for cell in cell_ids:
-        coords = cell_props.loc[cell_props['label'] == cell, 'coords'].values[0]
+    split_cells, split_nucs, new_nuc_ids = nuclear_overlap.get_split_nuclei(
+        cell_ids, max_nuc_id=max_nuc_id, min_size=min_size
+    )
 
-        nuc_id = find_nuclear_label_id(nuc_segmentation_labels=nuc_segmentation_labels,
-                                       cell_coords=coords)
+    # relabel nuclear counts within the cells
+    nuc_labels_modified = relabel_split_nuclei(cell_segmentation_labels, nuc_segmentation_labels,
+                                               split_cells, split_nucs, new_nuc_ids,
+                                               cell_index=cell_index)
 
-        # only proceed if there's a valid nuc_id
-        if nuc_id is not None:
-            # figure out if nuclear label is completely contained within cell label
-            cell_vals = nuc_segmentation_labels[tuple(coords.T)]
-            nuc_count = np.sum(cell_vals == nuc_id)
+    nuc_labels_modified = remove_small_objects(ar=nuc_labels_modified, min_size=5)
 
-            nuc_mask = nuc_segmentation_labels == nuc_id
+    return nuc_labels_modified
 
-            # only proceed if a non-negligible part of the nucleus is outside of the cell
-            if np.sum(nuc_mask) - nuc_count > min_size:
-                # relabel nuclear counts within the cell
-                cell_mask = cell_segmentation_labels == cell
-                new_nuc_mask = np.logical_and(cell_mask, nuc_mask)
-                max_nuc_id += 1
-                nuc_labels_modified[new_nuc_mask] = max_nuc_id
 
-    nuc_labels_modified = remove_small_objects(ar=nuc_labels_modified, min_size=5)
+def get_membrane_width(compartment):
+    """Validate a derived compartment, and get its ring width if it's a membrane
 
-    return nuc_labels_modified
+    Args:
+        compartment (str):
+            'cytoplasm', the pixels of each cell outside of any nucleus, or 'membrane' followed by
+            a width in pixels, e.g. 'membrane2', the pixels of each cell within that many pixels
+            of its boundary, diagonals included
+
+    Returns:
+        int or None:
+            the width of the membrane ring, None for the cytoplasm
+
+    Raises:
+        ValueError:
+            Raised if compartment isn't a valid derived compartment
+    """
+
+    if compartment == 'cytoplasm':
+        return None
+
+    prefix = 'membrane'
+    width = compartment[len(prefix):] if compartment.startswith(prefix) else ''
+
+    if not width.isdigit() or int(width) < 1:
+        raise ValueError("Invalid derived compartment %s: must be 'cytoplasm', or 'membrane' "
+                         "followed by a positive width in pixels" % compartment)
+
+    return int(width)
+
+
+def get_derived_compartment_positions(compartment, cell_labels, label_positions,
+                                      nuc_labels=None):
+    """Find the pixels of each cell which belong to a derived compartment, by filtering the
+    pixels of the cells rather than building a label image of the compartment
+
+    Args:
+        compartment (str):
+            derived compartment, see `get_membrane_width`
+        cell_labels (numpy.ndarray):
+            rows x columns matrix of cell labels
+        label_positions (tuple):
+            flat indices of the pixels of the cells, and the index of the cell of each, as
+            returned by `signal_extraction.get_label_positions`
+        nuc_labels (numpy.ndarray):
+            rows x columns matrix of nuclear labels, required for the cytoplasm
+
+    Returns:
+        tuple (numpy.ndarray, numpy.ndarray):
+        - flat indices of the pixels of the compartment, in the order of label_positions
+        - index of the cell of each of these pixels
+    """
+
+    pixel_indices, positions = label_positions
+    width = get_membrane_width(compartment)
+
+    if width is None:
+        if nuc_labels is None:
+            raise ValueError("The cytoplasm requires nuclear labels")
+
+        in_compartment = np.asarray(nuc_labels).ravel()[pixel_indices] == 0
+    else:
+        # a pixel is in the ring if another label, or the image edge, is within width pixels
+        cell_labels = np.asarray(cell_labels)
+        rows, cols = np.divmod(pixel_indices, cell_labels.shape[1])
+        own_labels = cell_labels.ravel()[pixel_indices]
+
+        in_compartment = np.zeros(len(pixel_indices), dtype='bool')
+        for row_offset in range(-width, width + 1):
+            for col_offset in range(-width, width + 1):
+                offset_rows, offset_cols = rows + row_offset, cols + col_offset
+                inside = (offset_rows >= 0) & (offset_rows < cell_labels.shape[0]) & \
+                    (offset_cols >= 0) & (offset_cols < cell_labels.shape[1])
+
+                offset_labels = cell_labels[np.clip(offset_rows, 0, cell_labels.shape[0] - 1),
+                                            np.clip(offset_cols, 0, cell_labels.shape[1] - 1)]
+                in_compartment |= ~inside | (offset_labels != own_labels)
+
+    return pixel_indices[in_compartment], positions[in_compartment]
 
 
 def transform_expression_matrix(cell_table, transform, transform_kwargs=None):
@@ -146,6 +758,80 @@ def transform_expression_matrix(cell_table, transform, transform_kwargs=None):
     return cell_table_transformed
 
 
+def size_norm_arcsinh_transform(cell_table, transform_kwargs=None, in_place=False, out=None,
+                                dtype=None, batch_size=4096):
+    """Size normalize an xarray of marker counts and arcsinh transform the result, in a single
+    pass over the channel data
+
+    Gives the same tables as `transform_expression_matrix` with 'size_norm' followed by
+    'arcsinh', while making at most one copy of the marker counts.
+
+    Args:
+        cell_table (xarray.DataArray):
+            xarray containing marker expression values
+        transform_kwargs (dict):
+            optional dictionary with additional settings for the arcsinh transform
+        in_place (bool):
+            whether to size normalize cell_table in place instead of a copy of it. Ignored if
+            dtype differs from the dtype of cell_table
+        out (numpy.ndarray):
+            optional buffer of the same shape as cell_table to write the arcsinh transformed
+            data to, which sets its dtype
+        dtype (str/type):
+            floating point data type of the transformed data, if None the dtype of cell_table
+        batch_size (int):
+            number of cells transformed at a time, so each batch stays in cache between steps
+
+    Returns:
+        tuple (xarray.DataArray, xarray.DataArray):
+        - xarray of counts per marker normalized by cell size
+        - arcsinh transformation of the above
+    """
+
+    if transform_kwargs is None:
+        transform_kwargs = {}
+
+    linear_factor = transform_kwargs.get('linear_factor', 100)
+
+    dtype = cell_table.dtype if dtype is None else np.dtype(dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise ValueError("dtype must be a floating point type")
+
+    normalized = cell_table.values
+    if not in_place or normalized.dtype != dtype:
+        normalized = normalized.astype(dtype)
+
+    if out is None:
+        out = np.empty_like(normalized)
+    elif out.shape != normalized.shape:
+        raise ValueError("out must have the same shape as cell_table")
+
+    # get start and end indices of channel data
+    channel_start = np.where(cell_table.features == settings.PRE_CHANNEL_COL)[0][0] + 1
+    channel_end = np.where(cell_table.features == settings.POST_CHANNEL_COL)[0][0]
+    size_index = np.where(cell_table.features == settings.CELL_SIZE)[0][0]
+
+    # only the channels are transformed, the other features are kept as is
+    out[..., :channel_start] = normalized[..., :channel_start]
+    out[..., channel_end:] = normalized[..., channel_end:]
+
+    for batch_start in range(0, normalized.shape[1], batch_size):
+        cells = slice(batch_start, batch_start + batch_size)
+
+        channel_values = normalized[:, cells, channel_start:channel_end]
+        cell_size = normalized[:, cells, size_index:size_index + 1]
+
+        # Only calculate where cell_size > 0
+        np.divide(channel_values, cell_size, out=channel_values, where=cell_size > 0)
+
+        # linearly scale the data then arcsinh transform it
+        arcsinh_values = out[:, cells, channel_start:channel_end]
+        np.multiply(channel_values, linear_factor, out=arcsinh_values)
+        np.arcsinh(arcsinh_values, out=arcsinh_values)
+
+    return cell_table.copy(deep=False, data=normalized), cell_table.copy(deep=False, data=out)
+
+
 def concatenate_csv(base_dir, csv_files, column_name="fov", column_values=None):
     """Take a list of CSV paths and concatenates them together,
     adding in the identifier in column_values
@@ -4,6 +4,7 @@ import pytest
 import tempfile
 import xarray as xr
 import os.path
+from scipy import ndimage
 from skimage.measure import regionprops
 import tempfile
 
@@ -53,6 +54,141 @@ def test_find_nuclear_mask_id():
         assert predicted_nuc == true_nuc_ids[idx]
 
 
+def test_label_index():
+    label_image = np.zeros((10, 12), dtype='int16')
+    label_image[1:4, 2:5] = 3
+    label_image[5:9, 6:11] = 1
+    label_image[0, 11] = 7
+
+    label_index = segmentation_utils.LabelIndex(label_image)
+
+    assert label_index.shape == (10, 12)
+    assert np.array_equal(label_index.label_ids, [1, 3, 7])
+    assert np.array_equal(label_index.label_sizes, [20, 9, 1])
+    assert np.array_equal(label_index.indptr, [0, 20, 29, 30])
+
+    # coords match those of regionprops, and missing labels have no pixels
+    for prop in regionprops(label_image):
+        assert np.array_equal(label_index.get_coords(prop.label), prop.coords)
+    assert len(label_index.get_pixel_indices(2)) == 0
+
+    pixel_indices, owners = label_index.get_label_pixels(np.array([7, 3]))
+    assert np.array_equal(label_image.ravel()[pixel_indices], np.array([7, 3])[owners])
+    assert len(pixel_indices) == 10
+
+    with pytest.raises(ValueError):
+        label_index.get_label_pixels(np.array([2]))
+
+    image_positions = label_index.get_image_positions()
+    assert np.array_equal(image_positions.reshape(label_image.shape) >= 0, label_image > 0)
+
+    # positions into a list of labels which includes labels missing from the image
+    pixel_indices, positions = label_index.get_positions(np.array([3, 4, 7]))
+    assert np.all(np.diff(pixel_indices) > 0)
+    assert np.array_equal(label_image.ravel()[pixel_indices], np.array([3, 4, 7])[positions])
+    assert len(pixel_indices) == 10
+
+    # an index of the pixels in row major order matches the one built from the image
+    positions_index = segmentation_utils.LabelIndex.from_positions(
+        label_image.shape, label_index.label_ids, label_index.label_sizes,
+        *label_index.get_positions()
+    )
+    assert np.array_equal(positions_index.get_image_positions(), image_positions)
+    assert np.array_equal(positions_index.indptr, label_index.indptr)
+    assert np.array_equal(positions_index.pixel_indices, label_index.pixel_indices)
+    assert np.array_equal(positions_index.get_coords(3), label_index.get_coords(3))
+
+    # empty images have no labels
+    empty_index = segmentation_utils.LabelIndex(np.zeros((3, 3), dtype='int'))
+    assert len(empty_index.label_ids) == 0
+    assert len(empty_index.get_positions()[0]) == 0
+
+
+def test_nuclear_overlap():
+    # create cell labels with 6 distinct cells
+    cell_labels = np.zeros((60, 10), dtype='int')
+    for i in range(6):
+        cell_labels[(i * 10):(i * 10 + 8), :8] = i + 1
+
+    # create nuc labels with varying degrees of overlap
+    nuc_labels = np.zeros((60, 10), dtype='int')
+
+    # perfect overlap
+    nuc_labels[:8, :8] = 1
+
+    # greater than majority overlap
+    nuc_labels[10:16, :6] = 2
+
+    # only partial overlap, with part of the nucleus outside of the cell
+    nuc_labels[20:23, :3] = 3
+    nuc_labels[20:23, 8:] = 3
+
+    # no overlap for cell 4
+
+    # two nuclei overlapping, larger nuc_id correct
+    nuc_labels[40:48, :2] = 5
+    nuc_labels[40:48, 2:8] = 20
+
+    # two nuclei with the same overlap, smaller nuc_id correct
+    nuc_labels[50:58, :1] = 21
+    nuc_labels[50:58, 1:2] = 6
+
+    overlap = segmentation_utils.NuclearOverlap(cell_segmentation_labels=cell_labels,
+                                                nuc_segmentation_labels=nuc_labels)
+
+    assert np.array_equal(overlap.cell_ids, np.arange(1, 7))
+    assert np.array_equal(overlap.nuc_ids, [1, 2, 3, 5, 6, 20, 21])
+    assert overlap.overlap_counts.shape == (6, 7)
+    assert overlap.overlap_counts[4, 3] == 16 and overlap.overlap_counts[4, 5] == 48
+
+    # check that predicted nuclear id is correct for all cells in image
+    assert np.array_equal(overlap.get_nuclear_label_ids(), [1, 2, 3, 0, 20, 6])
+
+    # check that the predictions match the per cell search, with coords or a label index
+    cell_props = regionprops(cell_labels)
+    cell_index = segmentation_utils.LabelIndex(cell_labels)
+    for prop, nuc_id in zip(cell_props, overlap.get_nuclear_label_ids()):
+        predicted_nuc = \
+            segmentation_utils.find_nuclear_label_id(nuc_segmentation_labels=nuc_labels,
+                                                     cell_coords=prop.coords)
+        assert (predicted_nuc or 0) == nuc_id
+
+        predicted_nuc = \
+            segmentation_utils.find_nuclear_label_id(nuc_segmentation_labels=nuc_labels,
+                                                     cell_index=cell_index, cell_id=prop.label)
+        assert (predicted_nuc or 0) == nuc_id
+
+    # subsets of cells can be looked up in any order
+    assert np.array_equal(overlap.get_nuclear_label_ids(np.array([5, 1])), [20, 1])
+
+    cell_fraction, nuc_fraction = overlap.get_overlap_fractions()
+    assert np.allclose(cell_fraction, [1, 36 / 64, 9 / 64, 0, 48 / 64, 8 / 64])
+    assert np.allclose(nuc_fraction, [1, 1, 9 / 15, 0, 1, 1])
+
+    with pytest.raises(ValueError):
+        overlap.get_nuclear_label_ids(np.array([7]))
+
+    # the same table can be built from precomputed counts
+    count_overlap = segmentation_utils.NuclearOverlap.from_overlap_counts(
+        overlap.cell_ids, overlap.cell_sizes, overlap.nuc_ids, overlap.nuc_sizes,
+        overlap.overlap_counts.tocoo()
+    )
+    assert np.array_equal(count_overlap.get_nuclear_label_ids(), overlap.get_nuclear_label_ids())
+    assert np.array_equal(count_overlap.get_overlap_sizes(), overlap.get_overlap_sizes())
+
+    # only nucleus 3 sticks out of its cell by more than min_size pixels
+    split_cells, split_nucs, new_nuc_ids = overlap.get_split_nuclei(overlap.cell_ids,
+                                                                    max_nuc_id=21, min_size=5)
+    assert np.array_equal(split_cells, [3])
+    assert np.array_equal(split_nucs, [3])
+    assert np.array_equal(new_nuc_ids, [22])
+
+    relabeled = segmentation_utils.relabel_split_nuclei(cell_labels, nuc_labels, split_cells,
+                                                        split_nucs, new_nuc_ids)
+    assert np.all(relabeled[20:23, :3] == 22) and np.all(relabeled[20:23, 8:] == 3)
+    assert np.array_equal(relabeled[nuc_labels != 3], nuc_labels[nuc_labels != 3])
+
+
 def test_split_large_nuclei():
     cell_mask, _ = test_utils.create_test_extraction_data()
     cell_mask = cell_mask[0, :, :, 0]
@@ -107,8 +243,83 @@ def test_split_large_nuclei():
     # the labels are different
     assert nuc_5_inner_val != nuc_5_outer_val
 
+    # a precomputed overlap gives the same result, and new labels follow the cell_ids order
+    overlap = segmentation_utils.NuclearOverlap(cell_segmentation_labels=cell_mask,
+                                                nuc_segmentation_labels=nuc_mask)
+    split_mask_overlap = segmentation_utils.split_large_nuclei(
+        nuc_segmentation_labels=nuc_mask, cell_segmentation_labels=cell_mask,
+        cell_ids=np.array([1, 2, 3, 5]), nuclear_overlap=overlap
+    )
+    assert np.array_equal(split_mask, split_mask_overlap)
+
+    split_mask_reversed = segmentation_utils.split_large_nuclei(
+        nuc_segmentation_labels=nuc_mask, cell_segmentation_labels=cell_mask,
+        cell_ids=np.array([5, 3, 2, 1]), nuclear_overlap=overlap
+    )
+    assert np.unique(split_mask_reversed[nuc_5_inner]) == np.unique(split_mask[nuc_3_inner])
+    assert np.unique(split_mask_reversed[nuc_3_inner]) == np.unique(split_mask[nuc_5_inner])
+
+    # prebuilt label indices give the same result
+    split_mask_index = segmentation_utils.split_large_nuclei(
+        nuc_segmentation_labels=nuc_mask, cell_segmentation_labels=cell_mask,
+        cell_ids=np.array([1, 2, 3, 5]),
+        cell_index=segmentation_utils.LabelIndex(cell_mask),
+        nuc_index=segmentation_utils.LabelIndex(nuc_mask)
+    )
+    assert np.array_equal(split_mask, split_mask_index)
+
 
 # TODO: refactor to avoid code reuse
+def test_get_membrane_width():
+    assert segmentation_utils.get_membrane_width('cytoplasm') is None
+    assert segmentation_utils.get_membrane_width('membrane1') == 1
+    assert segmentation_utils.get_membrane_width('membrane12') == 12
+
+    for compartment in ['membrane', 'membrane0', 'membrane-1', 'membrane1.5', 'nuclear']:
+        with pytest.raises(ValueError):
+            segmentation_utils.get_membrane_width(compartment)
+
+
+def test_get_derived_compartment_positions():
+    cell_labels, _ = test_utils.create_test_extraction_data()
+    cell_labels = cell_labels[0, :, :, 0]
+
+    # nuclei cover the middle of some of the cells
+    nuc_labels = np.zeros(cell_labels.shape, dtype='int')
+    nuc_labels[10:30, 10:30] = cell_labels[10:30, 10:30]
+
+    cell_index = segmentation_utils.LabelIndex(cell_labels)
+    positions = np.repeat(np.arange(len(cell_index.label_ids)), cell_index.label_sizes)
+    label_positions = (cell_index.pixel_indices, positions)
+
+    cyto_indices, cyto_positions = segmentation_utils.get_derived_compartment_positions(
+        'cytoplasm', cell_labels, label_positions, nuc_labels=nuc_labels
+    )
+
+    cyto_labels = np.where(nuc_labels == 0, cell_labels, 0).ravel()
+    assert np.array_equal(np.sort(cyto_indices), np.flatnonzero(cyto_labels))
+    assert np.array_equal(cell_index.label_ids[cyto_positions], cyto_labels[cyto_indices])
+
+    with pytest.raises(ValueError):
+        segmentation_utils.get_derived_compartment_positions('cytoplasm', cell_labels,
+                                                             label_positions)
+
+    for width in [1, 3]:
+        ring_indices, ring_positions = segmentation_utils.get_derived_compartment_positions(
+            'membrane%d' % width, cell_labels, label_positions
+        )
+
+        # ring pixels have another label, or the image edge, in their neighborhood
+        footprint_size = 2 * width + 1
+        ring = (ndimage.maximum_filter(cell_labels, footprint_size, mode='constant') !=
+                cell_labels) | \
+            (ndimage.minimum_filter(cell_labels, footprint_size, mode='constant') != cell_labels)
+        ring_labels = np.where(ring, cell_labels, 0).ravel()
+
+        assert np.array_equal(np.sort(ring_indices), np.flatnonzero(ring_labels))
+        assert np.array_equal(cell_index.label_ids[ring_positions], ring_labels[ring_indices])
+
+
 def test_transform_expression_matrix():
     # create expression matrix
     cell_data = np.random.choice([0, 1, 2, 3, 4], 70, replace=True)
@@ -205,6 +416,72 @@ def test_transform_expression_matrix_multiple_compartments():
         assert np.array_equal(arcsinh_data.loc[:, cell, modified_cols].values, arcsinh_vals)
 
 
+def test_size_norm_arcsinh_transform():
+    # create expression matrix
+    cell_data = np.random.choice([0, 1, 2, 3, 4], 140, replace=True)
+    cell_data = cell_data.reshape((2, 10, 7)).astype('float')
+
+    coords = [['whole_cell', 'nuclear'], list(range(10)),
+              [settings.CELL_SIZE, 'chan1', 'chan2', 'chan3', 'label', 'morph_1', 'morph_2']]
+    dims = ['compartments', 'cell_id', 'features']
+
+    cell_data = xr.DataArray(cell_data, coords=coords, dims=dims)
+
+    # the fused transform matches the two separate transforms
+    normalized_data = segmentation_utils.transform_expression_matrix(cell_data,
+                                                                     transform='size_norm')
+    arcsinh_data = segmentation_utils.transform_expression_matrix(normalized_data,
+                                                                  transform='arcsinh')
+
+    # only cells with a size are transformed, the others are kept as is
+    has_size = cell_data.values[:, :, 0] > 0
+
+    for batch_size in [3, 4096]:
+        fused_normalized, fused_arcsinh = segmentation_utils.size_norm_arcsinh_transform(
+            cell_data, batch_size=batch_size
+        )
+
+        assert np.array_equal(fused_normalized.values[has_size],
+                              normalized_data.values[has_size])
+        assert np.array_equal(fused_arcsinh.values[has_size], arcsinh_data.values[has_size])
+        assert np.array_equal(fused_normalized.values[~has_size],
+                              cell_data.values[~has_size])
+
+    # the input is left untouched unless transformed in place
+    assert not np.array_equal(fused_normalized.values, cell_data.values)
+
+    raw_data = cell_data.copy()
+    out = np.zeros(cell_data.shape)
+    fused_normalized, fused_arcsinh = segmentation_utils.size_norm_arcsinh_transform(
+        raw_data, in_place=True, out=out
+    )
+
+    assert np.shares_memory(fused_normalized.values, raw_data.values)
+    assert np.shares_memory(fused_arcsinh.values, out)
+    assert np.array_equal(out[has_size], arcsinh_data.values[has_size])
+
+    # the transform can be computed in float32
+    fused_normalized, fused_arcsinh = segmentation_utils.size_norm_arcsinh_transform(
+        cell_data, transform_kwargs={'linear_factor': 1}, in_place=True, dtype='float32'
+    )
+
+    assert fused_normalized.dtype == np.float32 and fused_arcsinh.dtype == np.float32
+    assert cell_data.dtype == np.float64
+    assert np.allclose(fused_normalized.values[has_size], normalized_data.values[has_size])
+    assert np.allclose(
+        fused_arcsinh.values[has_size],
+        segmentation_utils.transform_expression_matrix(
+            normalized_data, transform='arcsinh', transform_kwargs={'linear_factor': 1}
+        ).values[has_size]
+    )
+
+    with pytest.raises(ValueError):
+        segmentation_utils.size_norm_arcsinh_transform(cell_data, dtype='int32')
+
+    with pytest.raises(ValueError):
+        segmentation_utils.size_norm_arcsinh_transform(cell_data, out=np.zeros((2, 10, 6)))
+
+
 def test_save_segmentation_labels():
     channel_xr = test_utils.make_images_xarray(np.zeros((2, 50, 50, 3)))
     chan_sub = channel_xr.channels.values[:2]
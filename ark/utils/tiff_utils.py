@@ -3,6 +3,15 @@ import numpy as np
 from skimage.external.tifffile import TiffFile, TiffWriter
 import json
 import datetime
+import functools
+import os
+
+
+# suffix replacing the extension of a MIBItiff file in the name of its page index sidecar
+MIBITIFF_INDEX_SUFFIX = '_page_index.json'
+
+# number of MIBItiff file versions whose page indices are kept in memory
+MIBITIFF_INDEX_CACHE_SIZE = 512
 
 
 def read_mibitiff(file, channels=None):
@@ -21,32 +30,297 @@ def read_mibitiff(file, channels=None):
     """
     return_channels = []
     img_data = []
+    for channel_tuple, page_data in iter_mibitiff(file, channels):
+        return_channels.append(channel_tuple)
+        img_data.append(page_data)
+
+    return np.stack(img_data, axis=2), return_channels
+
+
+def iter_mibitiff(file, channels=None):
+    """ Reads MIBI data from an IonpathMIBI TIFF file one channel at a time.
+
+    Only the current channel's page is decoded, so only a single image plane is held in memory.
+
+    Args:
+        file (str): The string path or an open file object to a MIBItiff file.
+        channels (list): Targets to load. If None, all targets/channels are loaded
+
+    Yields:
+        tuple (tuple, np.ndarray):
+        - channel data, as a (mass, target) tuple
+        - image data of the channel
+    """
     with TiffFile(file) as tif:
+        index = get_mibitiff_index(file, tif=tif)
+
+        for page_number, channel_tuple in enumerate(index.channel_tuples):
+
+            # only load supplied channels
+            if channels is not None and channel_tuple[1] not in channels:
+                continue
+
+            # read channel and image data
+            yield channel_tuple, tif.pages[page_number].asarray()
+
+
+def read_tiff(file):
+    """ Reads the image of a tiff file, as `skimage.io.imread` reads it with the tifffile plugin
+
+    Args:
+        file (str): The string path or an open file object to a tiff file.
+
+    Returns:
+        numpy.ndarray:
+            the image, with the shape and data type given by `read_tiff_header`
+    """
+    with TiffFile(file) as tif:
+        return tif.asarray()
+
+
+def read_tiff_header(file):
+    """ Reads the shape, data type and pages of a tiff file from its header and tags, without
+    decoding any of its pages
+
+    Args:
+        file (str): The string path or an open file object to a tiff file.
+
+    Returns:
+        dict:
+            the `shape` and `dtype` of the image `read_tiff` returns, the number of pages
+            `n_pages`, and the (mass, target) `channel_tuples` of each page if the file is a
+            MIBItiff, otherwise None
+    """
+    with TiffFile(file) as tif:
+        series = tif.series[0]
+
+        channel_tuples = None
+        if _is_mibitiff(tif):
+            channel_tuples = get_mibitiff_index(file, tif=tif).channel_tuples
+
+        return {'shape': tuple(series.shape), 'dtype': np.dtype(series.dtype),
+                'n_pages': len(tif.pages), 'channel_tuples': channel_tuples}
+
+
+class MibitiffIndex(object):
+    """Index of the pages of a MIBItiff file, so channels can be found without parsing the
+    description of every page
+
+    Args:
+        channel_tuples (list):
+            channel data of each page, as a (mass, target) tuple
+        shape (tuple):
+            shape of each channel's image
+        dtype (numpy.dtype):
+            data type of the images
+
+    Attributes:
+        channel_tuples (list):
+            channel data of each page, as a (mass, target) tuple
+        shape (tuple):
+            shape of each channel's image
+        dtype (numpy.dtype):
+            data type of the images
+    """
+
+    def __init__(self, channel_tuples, shape, dtype):
+        self.channel_tuples = [tuple(channel_tuple) for channel_tuple in channel_tuples]
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        self._page_numbers = {target: i for i, (_, target) in enumerate(self.channel_tuples)}
+
+    @classmethod
+    def from_tiff(cls, tif):
+        """Build the index of an opened MIBItiff file
+
+        Args:
+            tif (TiffFile): opened MIBItiff file
+
+        Returns:
+            MibitiffIndex:
+                the index of the file
+        """
 
         # make sure it's a mibitiff
         _check_version(tif)
 
-        for page in tif.pages:
+        return cls([_get_channel_tuple(page) for page in tif.pages], tif.pages[0].shape,
+                   tif.pages[0].dtype)
 
-            # get tags as json
-            description = json.loads(
-                page.tags['image_description'].value.decode('utf-8')
-            )
+    def get_page_numbers(self, channels):
+        """Get the page of each of the supplied channels
 
-            # only load supplied channels
-            if channels is not None and description['channel.target'] not in channels:
-                continue
+        Args:
+            channels (list): Targets to look up
 
-            # read channel data
-            return_channels.append((
-                description['channel.mass'],
-                description['channel.target']
-            ))
+        Returns:
+            list:
+                page number of each channel
 
-            # read image data
-            img_data.append(page.asarray())
+        Raises:
+            ValueError:
+                Raised if any of the channels isn't in the file
+        """
 
-    return np.stack(img_data, axis=2), return_channels
+        missing = [target for target in channels if target not in self._page_numbers]
+        if len(missing) > 0:
+            raise ValueError('Channels %s are missing from the MIBItiff' % missing)
+
+        return [self._page_numbers[target] for target in channels]
+
+    def to_dict(self):
+        """dict: json serializable contents of the index"""
+
+        return {'channel_tuples': [list(channel_tuple) for channel_tuple in self.channel_tuples],
+                'shape': list(self.shape), 'dtype': self.dtype.str}
+
+
+def _get_file_key(file):
+    """Identify a version of a file by its path, size and modification time"""
+
+    file_stat = os.stat(file)
+    return os.path.abspath(file), file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _get_index_sidecar_path(file):
+    return os.path.splitext(file)[0] + MIBITIFF_INDEX_SUFFIX
+
+
+def get_mibitiff_index(file, tif=None):
+    """ Gets the page index of a MIBItiff file.
+
+    The indices of the most recently read file paths are cached in memory, and read from the
+    file's sidecar written by `write_mibitiff_index` if it has one, until the file changes.
+
+    Args:
+        file (str): The string path or an open file object to a MIBItiff file.
+        tif (TiffFile): the open file object, if it's already read as a TiffFile
+
+    Returns:
+        MibitiffIndex:
+            the index of the file
+    """
+    if not isinstance(file, str):
+        if tif is not None:
+            return MibitiffIndex.from_tiff(tif)
+
+        with TiffFile(file) as tif:
+            return MibitiffIndex.from_tiff(tif)
+
+    return _get_cached_mibitiff_index(*_get_file_key(file))
+
+
+@functools.lru_cache(maxsize=MIBITIFF_INDEX_CACHE_SIZE)
+def _get_cached_mibitiff_index(path, file_size, file_mtime_ns):
+    """Index a version of a MIBItiff file, from its sidecar if it's up to date
+
+    The most recently used indices are cached by the path, size and modification time of the
+    file, so a changed file is indexed again.
+
+    Args:
+        path (str): absolute path of the MIBItiff file
+        file_size (int): size of the file in bytes
+        file_mtime_ns (int): modification time of the file in nanoseconds
+
+    Returns:
+        MibitiffIndex:
+            the index of the file
+    """
+    sidecar_path = _get_index_sidecar_path(path)
+    if os.path.exists(sidecar_path):
+        with open(sidecar_path, 'r') as sidecar_file:
+            sidecar = json.load(sidecar_file)
+
+        # the sidecar only applies to the version of the file it was written for
+        if sidecar['file_size'] == file_size and sidecar['file_mtime_ns'] == file_mtime_ns:
+            return MibitiffIndex(**sidecar['index'])
+
+    with TiffFile(path) as tif:
+        return MibitiffIndex.from_tiff(tif)
+
+
+def write_mibitiff_index(file):
+    """ Saves the page index of a MIBItiff file in a sidecar file next to it, named after the
+    file with MIBITIFF_INDEX_SUFFIX replacing its extension, so later reads of the file find its
+    channels without parsing its pages
+
+    Args:
+        file (str): The string path to a MIBItiff file.
+
+    Returns:
+        str:
+            path of the sidecar file
+    """
+    index = get_mibitiff_index(file)
+    _, file_size, file_mtime_ns = _get_file_key(file)
+
+    sidecar_path = _get_index_sidecar_path(file)
+    with open(sidecar_path, 'w') as sidecar_file:
+        json.dump({'file_size': file_size, 'file_mtime_ns': file_mtime_ns,
+                   'index': index.to_dict()}, sidecar_file)
+
+    return sidecar_path
+
+
+def read_mibitiff_header(file):
+    """ Reads the channels, image shape and data type of a MIBItiff file, without decoding any
+    of its pages
+
+    Args:
+        file (str): The string path or an open file object to a MIBItiff file.
+
+    Returns:
+        tuple (list[tuple], tuple, numpy.dtype):
+        - channel data, as a (mass, target) tuple for each page
+        - shape of each channel's image
+        - data type of the images
+    """
+    index = get_mibitiff_index(file)
+
+    return index.channel_tuples, index.shape, index.dtype
+
+
+def read_mibitiff_into(file, out, channels):
+    """ Decodes the pages of a MIBItiff file straight into a preallocated array.
+
+    Each page is converted to the data type of out as it is copied into its channel's plane, so
+    only a single decoded page is held in memory besides out.
+
+    Args:
+        file (str): The string path or an open file object to a MIBItiff file.
+        out (np.ndarray): rows x columns x channels array the images are written to
+        channels (list): Targets to load, in the order of the channels of out
+
+    Raises:
+        ValueError:
+            Raised if any of the channels isn't in the file
+    """
+    with TiffFile(file) as tif:
+
+        # only the pages of the channels are decoded
+        page_numbers = get_mibitiff_index(file, tif=tif).get_page_numbers(channels)
+
+        for i, page_number in enumerate(page_numbers):
+            out[:, :, i] = tif.pages[page_number].asarray()
+
+
+def _get_channel_tuple(page):
+    """ Reads the channel of a MIBItiff page from its description tag
+
+    Args:
+        page (TiffPage): page of an opened MIBItiff file
+
+    Returns:
+        tuple:
+            channel data, as a (mass, target) tuple
+    """
+    # get tags as json
+    description = json.loads(
+        page.tags['image_description'].value.decode('utf-8')
+    )
+
+    return description['channel.mass'], description['channel.target']
 
 
 def _check_version(file):
@@ -58,11 +332,24 @@ def _check_version(file):
     Raises:
         ValueError
     """
-    filetype = file.pages[0].tags.get('software')
-    if not (filetype and filetype.value.decode('utf-8').startswith('IonpathMIBI')):
+    if not _is_mibitiff(file):
         raise ValueError('File is not of type IonpathMIBI...')
 
 
+def _is_mibitiff(file):
+    """ Checks whether file is MIBItiff
+
+    Args:
+        file (TiffFile): opened tiff file
+
+    Returns:
+        bool:
+            whether the file was written by the MIBI software
+    """
+    filetype = file.pages[0].tags.get('software')
+    return bool(filetype and filetype.value.decode('utf-8').startswith('IonpathMIBI'))
+
+
 _PREFIXED_METADATA_ATTRIBUTES = ('run', 'coordinates', 'size', 'slide',
                                  'fov_id', 'fov_name', 'folder', 'dwell',
                                  'scans', 'aperture', 'instrument', 'tissue',
@@ -37,6 +37,94 @@ def test_read_mibitiff():
             img_data, all_channels = tiff_utils.read_mibitiff(filepaths['test_fov'][0] + '.tiff')
 
 
+def test_read_mibitiff_header():
+    img_data, all_channels = tiff_utils.read_mibitiff(EXAMPLE_MIBITIFF_PATH)
+
+    channel_tuples, img_shape, dtype = tiff_utils.read_mibitiff_header(EXAMPLE_MIBITIFF_PATH)
+
+    assert channel_tuples == all_channels
+    assert img_shape == img_data.shape[:2]
+    assert dtype == img_data.dtype
+
+
+def test_read_mibitiff_into():
+    img_data, all_channels = tiff_utils.read_mibitiff(EXAMPLE_MIBITIFF_PATH)
+    channel_names = [chan_tup[1] for chan_tup in all_channels]
+
+    # channels are placed in the requested order, converted to the type of the output
+    channels = channel_names[2::-1]
+    out = np.zeros((1024, 1024, 3), dtype='float32')
+    tiff_utils.read_mibitiff_into(EXAMPLE_MIBITIFF_PATH, out, channels)
+
+    assert np.all(out == img_data[:, :, 2::-1].astype('float32'))
+
+    with pytest.raises(ValueError):
+        tiff_utils.read_mibitiff_into(EXAMPLE_MIBITIFF_PATH, out, channels[:2] + ['bad_chan'])
+
+
+def test_read_tiff_header():
+    header = tiff_utils.read_tiff_header(EXAMPLE_MIBITIFF_PATH)
+    _, all_channels = tiff_utils.read_mibitiff(EXAMPLE_MIBITIFF_PATH)
+
+    assert header['n_pages'] == len(all_channels)
+    assert header['channel_tuples'] == all_channels
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fovs, chans = test_utils.gen_fov_chan_names(1, 3)
+        filelocs, _ = test_utils.create_paired_xarray_fovs(temp_dir, fovs, chans,
+                                                           img_shape=(10, 12),
+                                                           mode='multitiff', dtype='float32')
+
+        header = tiff_utils.read_tiff_header(filelocs[fovs[0]])
+
+        assert header['shape'] == (10, 12, 3)
+        assert header['dtype'] == np.dtype('float32')
+        assert header['channel_tuples'] is None
+        assert tiff_utils.read_tiff(filelocs[fovs[0]]).shape == header['shape']
+
+
+def test_get_mibitiff_index():
+    _, all_channels = tiff_utils.read_mibitiff(EXAMPLE_MIBITIFF_PATH)
+    channel_names = [chan_tup[1] for chan_tup in all_channels]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        mibitiff_path = os.path.join(temp_dir, 'Point8.tif')
+        with open(EXAMPLE_MIBITIFF_PATH, 'rb') as src, open(mibitiff_path, 'wb') as dst:
+            dst.write(src.read())
+
+        index = tiff_utils.get_mibitiff_index(mibitiff_path)
+
+        assert index.channel_tuples == all_channels
+        assert index.shape == (1024, 1024)
+        assert index.get_page_numbers(channel_names[2::-1]) == [2, 1, 0]
+
+        with pytest.raises(ValueError):
+            index.get_page_numbers(['bad_chan'])
+
+        # the index is cached until the file changes, in a bounded cache
+        assert tiff_utils.get_mibitiff_index(mibitiff_path) is index
+        assert tiff_utils._get_cached_mibitiff_index.cache_info().maxsize == \
+            tiff_utils.MIBITIFF_INDEX_CACHE_SIZE
+
+        sidecar_path = tiff_utils.write_mibitiff_index(mibitiff_path)
+        assert sidecar_path == os.path.join(temp_dir, 'Point8_page_index.json')
+
+        # the sidecar is read back once the in-memory cache is gone
+        tiff_utils._get_cached_mibitiff_index.cache_clear()
+        sidecar_index = tiff_utils.get_mibitiff_index(mibitiff_path)
+
+        assert sidecar_index is not index
+        assert sidecar_index.to_dict() == index.to_dict()
+
+        # a stale sidecar is ignored
+        os.utime(mibitiff_path, ns=(0, 0))
+        assert tiff_utils.get_mibitiff_index(mibitiff_path).to_dict() == index.to_dict()
+
+        # open files are indexed without caching
+        with open(mibitiff_path, 'rb') as mibitiff_file:
+            assert tiff_utils.get_mibitiff_index(mibitiff_file).to_dict() == index.to_dict()
+
+
 # test write_mibitiff and verify with read_mibitiff
 # test utils uses write_mibitiff so we can just use that to test it
 def test_write_mibitiff():
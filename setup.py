@@ -34,6 +34,8 @@ setup(
                       'xarray>=0.12.3,<1',
                       'tqdm>=4.54.1,<5'],
     extras_require={
+        'parquet': ['pyarrow'],
+        'numba': ['numba'],
         'tests': ['pytest',
                   'pytest-cov',
                   'pytest-pycodestyle',